@@ -16,6 +16,12 @@
 # P4PPFLAGS - P4 pre processing flags
 # PDFLAGS - Program dependent flags for PD API generation
 # P4_tofino_ARCHITECTURE - tna/t2na/psa/v1model
+# P4C_SERVER_SOCKET (OPTIONAL) - Socket of a running "bf-p4c --server". When set,
+#   compilations are submitted to the server, or run locally if it is not running
+# P4C_MEMORY_ADMISSION (OPTIONAL) - Run the compilers only when there is enough memory
+#   for them, so that the build can run with -j<number of cores> without swapping
+# P4C_FANOUT (OPTIONAL) - Compile the program for tofino2, tofino2m and tofino2h,
+#   which share an architecture, with a single bf-p4c invocation
 #
 
 execute_process(
@@ -26,6 +32,28 @@ execute_process(
   OUTPUT_STRIP_TRAILING_WHITESPACE)
 set(PYTHON_SITE "${PYTHON_SITE}/site-packages")
 
+set(P4C_LAUNCHER_ENV "")
+if (P4C_SERVER_SOCKET)
+  list(APPEND P4C_LAUNCHER_ENV P4C_SERVER_SOCKET=${P4C_SERVER_SOCKET})
+endif()
+if (P4C_MEMORY_ADMISSION)
+  list(APPEND P4C_LAUNCHER_ENV P4C_MEMORY_ADMISSION=1)
+endif()
+if (P4C_LAUNCHER_ENV)
+  set(P4C_LAUNCHER ${CMAKE_COMMAND} -E env ${P4C_LAUNCHER_ENV})
+else()
+  set(P4C_LAUNCHER "")
+endif()
+
+# bf-p4c writes a depfile listing the P4 sources it includes, so that the
+# programs are rebuilt when any of them changes. Ninja always reads it,
+# the other generators since CMake 3.20.
+if (CMAKE_GENERATOR MATCHES "Ninja" OR NOT CMAKE_VERSION VERSION_LESS 3.20)
+  set(P4C_DEPFILE_SUPPORTED TRUE)
+else()
+  set(P4C_DEPFILE_SUPPORTED FALSE)
+endif()
+
 ###############################################################################
 # P4 Build with BFRT
 ###############################################################################
@@ -71,16 +99,30 @@ function(P4_BUILD_TARGET t arch target p4program)
     endif()
   endforeach()
 
+  set(depfile ${CMAKE_CURRENT_BINARY_DIR}/${t}/${target}.d)
+  set(depfile_option "")
+  if (P4C_DEPFILE_SUPPORTED)
+    set(depfile_option DEPFILE ${depfile})
+  endif()
+
   separate_arguments(COMPUTED_P4FLAGS UNIX_COMMAND ${P4FLAGS})
   separate_arguments(COMPUTED_P4PPFLAGS UNIX_COMMAND ${P4PPFLAGS})
-  # compile the p4 program
-  add_custom_command(OUTPUT ${output_files}
-    COMMAND ${P4C} --std ${P4_LANG} --target ${target} --arch ${arch} ${rt_commands} -o ${CMAKE_CURRENT_BINARY_DIR}/${t}/${target} ${COMPUTED_P4PPFLAGS} ${COMPUTED_P4FLAGS} ${P4FLAGS_INTERNAL} -g ${p4program}
+  # compile the p4 program; the depfile names manifest.json, the first output
+  add_custom_command(OUTPUT ${t}/${target}/manifest.json ${output_files}
+    COMMAND ${P4C_LAUNCHER} ${P4C} --std ${P4_LANG} --target ${target} --arch ${arch} ${rt_commands} -o ${CMAKE_CURRENT_BINARY_DIR}/${t}/${target} --depfile ${depfile} ${COMPUTED_P4PPFLAGS} ${COMPUTED_P4FLAGS} ${P4FLAGS_INTERNAL} -g ${p4program}
     COMMAND ${P4C-GEN-BFRT-CONF} --name ${t} --device ${chiptype} --testdir ./${t}/${target}
          --installdir share/${target}pd/${t} --pipe `${P4C-MANIFEST-CONFIG} --pipe ./${t}/${target}/manifest.json`
     DEPENDS ${p4program} bf-p4c
+    ${depfile_option}
   )
    add_custom_target(${t}-${target} DEPENDS ${depends_target} driver)
+  p4_install_target(${t} ${target})
+endfunction()
+
+#
+# Install the outputs of program t for target
+#
+function(P4_INSTALL_TARGET t target)
   # install generated conf file
   install(DIRECTORY ${CMAKE_CURRENT_BINARY_DIR}/${t}/${target}/ DESTINATION share/p4/targets/${target}
     FILES_MATCHING
@@ -103,6 +145,87 @@ function(P4_BUILD_TARGET t arch target p4program)
   )
 endfunction()
 
+#
+# Compile P4 example programs with BFRT for several targets that share an
+# architecture, with a single bf-p4c invocation ("--target tofino2,tofino2m").
+# bf-p4c compiles the targets concurrently, into ${t}/<target> as
+# P4_BUILD_TARGET does, and the same ${t}-<target> targets are created.
+#
+# p4_build_fanout_target (<program_name> <arch> <targets> <location>)
+# t - name of the p4 example program to build
+# arch - P4 architecture (t2na, etc.)
+# targets - List of target devices (tofino2, tofino2m, etc.)
+# location - directory of the P4 program
+# input_rt_list (OPTIONAL) - 5th param ARGV4. Array of runtime lists.
+#           Can be either or both "bfrt;p4rt"
+#
+function(P4_BUILD_FANOUT_TARGET t arch targets p4program)
+  set(input_rt_list ${ARGV4})
+  if ("${input_rt_list}" STREQUAL "")
+    set(input_rt_list "bfrt")
+  endif()
+  # bf-p4c replaces {target} in the output paths
+  set(rt_commands "")
+  foreach(rt in lists input_rt_list)
+    if (${rt} STREQUAL "bfrt")
+      set(rt_commands "${rt_commands}" "--bf-rt-schema" "${t}/{target}/bf-rt.json")
+    elseif (${rt} STREQUAL "p4rt")
+      set(rt_commands "${rt_commands}" "--p4runtime-files" "${t}/{target}/p4info.pb.txt")
+    endif()
+  endforeach()
+
+  set(output_files "")
+  set(conf_commands "")
+  foreach(target ${targets})
+    if (${target} STREQUAL "tofino2m" OR ${target} STREQUAL "tofino2h")
+      set(chiptype "tofino2")
+    else()
+      set(chiptype ${target})
+    endif()
+    foreach(rt in lists input_rt_list)
+      if (${rt} STREQUAL "bfrt")
+        set(output_files "${output_files}" "${t}/${target}/bf-rt.json")
+      elseif (${rt} STREQUAL "p4rt")
+        set(output_files "${output_files}" "${t}/${target}/p4info.pb.txt")
+      endif()
+    endforeach()
+    set(conf_commands ${conf_commands}
+      COMMAND ${P4C-GEN-BFRT-CONF} --name ${t} --device ${chiptype} --testdir ./${t}/${target}
+         --installdir share/${target}pd/${t} --pipe `${P4C-MANIFEST-CONFIG} --pipe ./${t}/${target}/manifest.json`)
+  endforeach()
+  string(REPLACE ";" "," target_list "${targets}")
+
+  # all the targets include the same sources, the depfile of the first one
+  # is enough
+  list(GET targets 0 first_target)
+  set(depfile_option "")
+  if (P4C_DEPFILE_SUPPORTED)
+    set(depfile_option DEPFILE ${CMAKE_CURRENT_BINARY_DIR}/${t}/${first_target}.d)
+  endif()
+
+  separate_arguments(COMPUTED_P4FLAGS UNIX_COMMAND ${P4FLAGS})
+  separate_arguments(COMPUTED_P4PPFLAGS UNIX_COMMAND ${P4PPFLAGS})
+  # compile the p4 program for all targets
+  add_custom_command(OUTPUT ${t}/${first_target}/manifest.json ${output_files}
+    COMMAND ${P4C_LAUNCHER} ${P4C} --std ${P4_LANG} --target ${target_list} --arch ${arch} ${rt_commands} -o ${CMAKE_CURRENT_BINARY_DIR}/${t}/{target} --depfile ${CMAKE_CURRENT_BINARY_DIR}/${t}/{target}.d ${COMPUTED_P4PPFLAGS} ${COMPUTED_P4FLAGS} ${P4FLAGS_INTERNAL} -g ${p4program}
+    ${conf_commands}
+    DEPENDS ${p4program} bf-p4c
+    ${depfile_option}
+  )
+  foreach(target ${targets})
+    set(depends_target "")
+    foreach(rt in lists input_rt_list)
+      if (${rt} STREQUAL "bfrt")
+        set(depends_target "${depends_target}" "${t}/${target}/bf-rt.json")
+      elseif (${rt} STREQUAL "p4rt")
+        set(depends_target "${depends_target}" "${t}/${target}/p4info.pb.txt")
+      endif()
+    endforeach()
+    add_custom_target(${t}-${target} DEPENDS ${depends_target} driver)
+    p4_install_target(${t} ${target})
+  endforeach()
+endfunction()
+
 #
 # Wrapper function for P4_BUILD_TARGET above
 # t - name of the p4 example program to build
@@ -115,14 +238,23 @@ function(P4_BUILD t location)
   if (TOFINO)
     p4_build_target(${t} ${P4_tofino_ARCHITECTURE} "tofino" ${CMAKE_CURRENT_SOURCE_DIR}/${location}/${t}/${t}.p4 ${input_rt_list})
   endif()
+  set(tofino2_targets "")
   if (TOFINO2)
-    p4_build_target(${t} ${P4_tofino2_ARCHITECTURE} "tofino2" ${CMAKE_CURRENT_SOURCE_DIR}/${location}/${t}/${t}.p4 ${input_rt_list})
+    list(APPEND tofino2_targets "tofino2")
   endif()
   if (TOFINO2M)
-    p4_build_target(${t} ${P4_tofino2_ARCHITECTURE} "tofino2m" ${CMAKE_CURRENT_SOURCE_DIR}/${location}/${t}/${t}.p4 ${input_rt_list})
+    list(APPEND tofino2_targets "tofino2m")
   endif()
   if (TOFINO2H)
-    p4_build_target(${t} ${P4_tofino2_ARCHITECTURE} "tofino2h" ${CMAKE_CURRENT_SOURCE_DIR}/${location}/${t}/${t}.p4 ${input_rt_list})
+    list(APPEND tofino2_targets "tofino2h")
+  endif()
+  list(LENGTH tofino2_targets num_tofino2_targets)
+  if (P4C_FANOUT AND num_tofino2_targets GREATER 1)
+    p4_build_fanout_target(${t} ${P4_tofino2_ARCHITECTURE} "${tofino2_targets}" ${CMAKE_CURRENT_SOURCE_DIR}/${location}/${t}/${t}.p4 ${input_rt_list})
+  else()
+    foreach(target ${tofino2_targets})
+      p4_build_target(${t} ${P4_tofino2_ARCHITECTURE} ${target} ${CMAKE_CURRENT_SOURCE_DIR}/${location}/${t}/${t}.p4 ${input_rt_list})
+    endforeach()
   endif()
   if (TOFINO3)
     p4_build_target(${t} ${P4_tofino3_ARCHITECTURE} "tofino3" ${CMAKE_CURRENT_SOURCE_DIR}/${location}/${t}/${t}.p4 ${input_rt_list})
@@ -153,10 +285,16 @@ function(P4_BUILD_PD_TARGET t arch target p4program)
   separate_arguments(COMPUTED_P4FLAGS UNIX_COMMAND ${P4FLAGS})
   separate_arguments(COMPUTED_P4PPFLAGS UNIX_COMMAND ${P4PPFLAGS})
   separate_arguments(COMPUTED_PDFLAGS UNIX_COMMAND ${PDFLAGS})
+  set(depfile ${CMAKE_CURRENT_BINARY_DIR}/${t}/${target}.d)
+  set(depfile_option "")
+  if (P4C_DEPFILE_SUPPORTED)
+    set(depfile_option DEPFILE ${depfile})
+  endif()
   # compile the p4 program
   add_custom_command(OUTPUT ${t}/${target}/manifest.json
-    COMMAND ${P4C} --std ${P4_LANG} --target ${target} --arch ${arch} --no-bf-rt-schema -o ${CMAKE_CURRENT_BINARY_DIR}/${t}/${target} ${COMPUTED_P4PPFLAGS} ${COMPUTED_P4FLAGS} ${P4FLAGS_INTERNAL} -g ${p4program}
+    COMMAND ${P4C_LAUNCHER} ${P4C} --std ${P4_LANG} --target ${target} --arch ${arch} --no-bf-rt-schema -o ${CMAKE_CURRENT_BINARY_DIR}/${t}/${target} --depfile ${depfile} ${COMPUTED_P4PPFLAGS} ${COMPUTED_P4FLAGS} ${P4FLAGS_INTERNAL} -g ${p4program}
     DEPENDS ${p4program} bf-p4c
+    ${depfile_option}
   )
 
   # generate pd.c, pd.h and pd thrift files
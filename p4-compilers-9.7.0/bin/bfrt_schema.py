@@ -18,10 +18,21 @@
 
 import argparse
 import jsl
-import json
 import jsonschema
+import os
 import sys
 
+# use the JSON layer of the driver when it is installed alongside
+_bin_dir = os.path.dirname(os.path.realpath(__file__))
+for _d in (_bin_dir, os.path.join(_bin_dir, '..', 'share', 'p4c')):
+    if os.path.isdir(os.path.join(_d, 'p4c_src')):
+        sys.path.insert(1, os.path.normpath(_d))
+        break
+try:
+    from p4c_src import jsonio as json
+except ImportError:
+    import json
+
 ########################################################
 #   Schema Version
 ########################################################
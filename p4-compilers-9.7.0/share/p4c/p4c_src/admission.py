@@ -0,0 +1,296 @@
+# Copyright 2013-2021 Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials,
+# and your use of them is governed by the express license under which they
+# were provided to you ("License"). Unless the License provides otherwise,
+# you may not use, modify, copy, publish, distribute, disclose or transmit this
+# software or the related documents without Intel's prior written permission.
+#
+# This software and the related documents are provided as is, with no
+# express or implied warranties, other than those that are expressly stated
+# in the License.
+
+"""
+Memory admission control for concurrent compilations (--memory-admission,
+or $P4C_MEMORY_ADMISSION=1).
+
+The compiler can use several GB. When many drivers run at once (make -j),
+each one asks to be admitted before running the compiler, and is admitted
+only when the memory it is expected to use fits in the memory available.
+
+The expected peak RSS of a compilation is learned: the peak RSS of the
+compiler is recorded per (source, target, arch) in memory-history.json in
+the cache directory. Programs compiled for the first time are expected to
+use $P4C_COMPILE_MEMORY MB (default DEFAULT_COMPILE_MEMORY_MB).
+
+Drivers coordinate through admission.json, locked with flock, in
+$P4C_ADMISSION_DIR (default DEFAULT_ADMISSION_DIR). The memory is shared by
+all the users of the host, so the default directory is too: it is created
+world writable and sticky like /tmp, and admission.json is readable and
+writable by all. The state is advisory; it only orders cooperating drivers.
+
+admission.json lists the admitted compilations with the memory reserved
+for them, and the waiting ones in arrival order, each under its ticket: a
+driver that compiles several backends concurrently holds one ticket per
+compiler it runs. A compilation is admitted when all those that arrived
+before it were, and MemAvailable covers its reservation plus what the
+admitted compilations have reserved but not allocated yet, the RSS of a
+driver being counted against the sum of the reservations of its tickets.
+One compilation is always admitted, however large. Entries of processes
+that no longer exist are dropped, so a driver that is killed does not hold
+memory forever.
+"""
+
+import fcntl
+import json
+import os
+import resource
+import sys
+import time
+
+DEFAULT_ADMISSION_DIR = '/tmp/bf-p4c-admission'
+DEFAULT_COMPILE_MEMORY_MB = 2048
+_STATE_FILE = 'admission.json'
+_HISTORY_FILE = 'memory-history.json'
+_POLL_INTERVAL = 0.5
+
+def enabled(option):
+    return option or os.environ.get('P4C_MEMORY_ADMISSION', '0') not in ('', '0')
+
+def default_admission_dir():
+    """
+    Return $P4C_ADMISSION_DIR, or DEFAULT_ADMISSION_DIR
+    """
+    return os.environ.get('P4C_ADMISSION_DIR') or DEFAULT_ADMISSION_DIR
+
+def default_history_file():
+    from p4c_src.cache import default_cache_dir
+    return os.path.join(default_cache_dir(), _HISTORY_FILE)
+
+def default_compile_memory():
+    """
+    Return the memory expected for an unknown program, in bytes
+    """
+    try:
+        mb = int(os.environ.get('P4C_COMPILE_MEMORY', DEFAULT_COMPILE_MEMORY_MB))
+    except ValueError:
+        mb = DEFAULT_COMPILE_MEMORY_MB
+    return mb * 1024 * 1024
+
+def _meminfo(field):
+    """
+    Return field from /proc/meminfo, in bytes, or None
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _shared_dir(path):
+    """
+    Create the directory path, writable by all users, unless it exists
+    """
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok = True)
+    try:
+        os.mkdir(path)
+    except FileExistsError:
+        return
+    os.chmod(path, 0o1777)
+
+def _open_shared(path):
+    """
+    Open the file path for reading and writing, creating it readable and
+    writable by all users
+    """
+    flags = os.O_RDWR | os.O_NOFOLLOW
+    while True:
+        try:
+            return os.open(path, flags)
+        except FileNotFoundError:
+            pass
+        try:
+            fd = os.open(path, flags | os.O_CREAT | os.O_EXCL, 0o666)
+        except FileExistsError:
+            # created by another driver meanwhile
+            continue
+        os.fchmod(fd, 0o666)
+        return fd
+
+def _tree_rss(roots):
+    """
+    Return the RSS, in bytes, of each of the process trees rooted at roots
+    """
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    parent = {}
+    rss = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry)) as f:
+                # the command, field 2, may contain spaces
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        pid = int(entry)
+        parent[pid] = int(fields[1])
+        rss[pid] = int(fields[21]) * page_size
+    total = dict.fromkeys(roots, 0)
+    for pid in rss:
+        p = pid
+        while p > 1 and p not in total:
+            p = parent.get(p, 0)
+        if p in total:
+            total[p] += rss[pid]
+    return total
+
+class MemoryHistory(object):
+    """
+    Peak RSS of the compiler per (source, target, arch)
+    """
+    def __init__(self, history_file):
+        self.history_file = history_file
+
+    @staticmethod
+    def key(source, target, arch):
+        return json.dumps([os.path.abspath(source), target, arch])
+
+    def _load(self):
+        try:
+            with open(self.history_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def peak(self, key):
+        return self._load().get(key)
+
+    def record(self, key, peak):
+        try:
+            os.makedirs(os.path.dirname(self.history_file), exist_ok = True)
+            with open(self.history_file + '.lock', 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                history = self._load()
+                history[key] = peak
+                tmp = '{}.{}.tmp'.format(self.history_file, os.getpid())
+                with open(tmp, 'w') as f:
+                    json.dump(history, f, indent=2, sort_keys=True)
+                os.replace(tmp, self.history_file)
+        except OSError:
+            pass   # the history is only a hint
+
+class AdmissionControl(object):
+    """
+    Admission of a compilation that needs reservation bytes
+    """
+    def __init__(self, admission_dir, reservation, verbose = False):
+        self.admission_dir = admission_dir
+        self.state_file = os.path.join(admission_dir, _STATE_FILE)
+        self.reservation = reservation
+        self.verbose = verbose
+        self.ticket = None
+
+    def _update(self, update):
+        """
+        Call update(state) with the state locked, and save the state
+        """
+        _shared_dir(self.admission_dir)
+        # written in place: in a sticky directory, the file of another user
+        # can not be replaced
+        with os.fdopen(_open_shared(self.state_file), 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                state = json.load(f)
+            except ValueError:
+                state = {}
+            state.setdefault('next_ticket', 0)
+            state.setdefault('admitted', [])
+            state.setdefault('waiting', [])
+            # forget the drivers that went away
+            state['admitted'] = [e for e in state['admitted'] if _alive(e['pid'])]
+            state['waiting'] = [e for e in state['waiting'] if _alive(e['pid'])]
+            result = update(state)
+            f.seek(0)
+            f.truncate()
+            json.dump(state, f, indent=2)
+            return result
+
+    def _enqueue(self, state):
+        self.ticket = state['next_ticket']
+        state['next_ticket'] += 1
+        state['waiting'].append({ 'pid': os.getpid(), 'ticket': self.ticket,
+                                  'reservation': self.reservation })
+
+    def _try_admit(self, state):
+        """
+        Returns None if admitted, otherwise why the compilation has to wait
+        """
+        waiting = sorted(state['waiting'], key = lambda e: e['ticket'])
+        ahead = [e for e in waiting if e['ticket'] < self.ticket]
+        if ahead:
+            return "{} compilations ahead".format(len(ahead))
+        if state['admitted']:
+            available = _meminfo('MemAvailable')
+            if available is not None:
+                reserved = {}
+                for e in state['admitted']:
+                    reserved[e['pid']] = reserved.get(e['pid'], 0) + e['reservation']
+                used = _tree_rss(list(reserved))
+                for pid, reservation in reserved.items():
+                    available -= max(0, reservation - used.get(pid, 0))
+                if available < self.reservation:
+                    return "{} MB needed, {} MB available".format(
+                        self.reservation // (1024 * 1024), max(0, available) // (1024 * 1024))
+        state['waiting'] = [e for e in state['waiting'] if e['ticket'] != self.ticket]
+        state['admitted'].append({ 'pid': os.getpid(), 'ticket': self.ticket,
+                                   'reservation': self.reservation, 'start': time.time() })
+        return None
+
+    def acquire(self):
+        """
+        Wait until the compilation is admitted. Returns the time waited.
+        """
+        start = time.time()
+        self._update(self._enqueue)
+        announced = False
+        try:
+            while True:
+                reason = self._update(self._try_admit)
+                if reason is None:
+                    break
+                if not announced or self.verbose:
+                    print("bf-p4c: waiting for memory: {}".format(reason), file=sys.stderr)
+                    announced = True
+                time.sleep(_POLL_INTERVAL)
+        except BaseException:
+            self.release()
+            raise
+        return time.time() - start
+
+    def release(self):
+        def remove(state):
+            state['admitted'] = [e for e in state['admitted'] if e['ticket'] != self.ticket]
+            state['waiting'] = [e for e in state['waiting'] if e['ticket'] != self.ticket]
+        if self.ticket is not None:
+            self._update(remove)
+            self.ticket = None
+
+def children_peak_rss():
+    """
+    Peak RSS of the largest child process waited for so far, in bytes
+    """
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
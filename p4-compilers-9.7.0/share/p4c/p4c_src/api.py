@@ -0,0 +1,186 @@
+# Copyright 2013-2021 Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials,
+# and your use of them is governed by the express license under which they
+# were provided to you ("License"). Unless the License provides otherwise,
+# you may not use, modify, copy, publish, distribute, disclose or transmit this
+# software or the related documents without Intel's prior written permission.
+#
+# This software and the related documents are provided as is, with no
+# express or implied warranties, other than those that are expressly stated
+# in the License.
+
+"""
+In-process API to the bf-p4c driver.
+
+    from p4c_src.api import compile
+
+    result = compile('prog.p4', 'tofino2', 't2na', ['-g'], output_dir='out')
+    if not result.success:
+        for stage in result.stages:
+            print(stage.name, stage.state, stage.returncode, stage.elapsed)
+    print(result.artifacts['manifest'])
+
+Each call constructs a fresh backend, so many programs and targets can be
+compiled from one process. Errors that end a compilation early are raised as
+DriverError (CompilationError for compilation failures), with the partial
+CompileResult attached as the result attribute. A compilation that runs to
+completion returns its CompileResult, whatever its return code.
+
+The environment the bf-p4c script sets up is derived from the location of
+this package when it is not already set.
+"""
+
+import argparse
+import os
+import time
+
+from p4c_src.driver import DriverError, DriverExit
+
+def setup_environment():
+    """
+    Set the P4C_* variables the driver needs, for an installed bf-p4c, unless
+    they are already set
+    """
+    artifacts_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    os.environ.setdefault('P4C_BUILD_TYPE', 'INSTALLED')
+    os.environ.setdefault('P4C_BIN_DIR',
+                          os.path.normpath(os.path.join(artifacts_dir, '..', '..', 'bin')))
+    os.environ.setdefault('P4C_CFG_PATH', os.path.join(artifacts_dir, 'p4c_src'))
+    os.environ.setdefault('P4C_16_INCLUDE_PATH',
+                          os.path.realpath(os.path.join(artifacts_dir, 'p4include')))
+    os.environ.setdefault('P4C_14_INCLUDE_PATH',
+                          os.path.realpath(os.path.join(artifacts_dir, 'p4_14include')))
+
+class ArgumentParser(argparse.ArgumentParser):
+    """
+    An argument parser that raises DriverError instead of exiting
+    """
+    def error(self, message):
+        raise DriverError('{}: error: {}'.format(self.prog, message), 2)
+
+    def exit(self, status = 0, message = None):
+        # e.g. after printing --help
+        raise DriverExit(message, status)
+
+class StageResult(object):
+    """
+    Outcome of one step of a compilation.
+
+    state is one of done, skipped (a step it depends on failed) or pending
+    (the compilation stopped before the step could run). returncode is None
+    unless the step is done. start and end are wall clock times. user and
+    sys are the CPU times of the commands the step ran, peak_rss the largest
+    RSS of those commands in bytes.
+    """
+    def __init__(self, name, state, returncode, start, end, user = 0.0, sys = 0.0,
+                 peak_rss = 0):
+        self.name = name
+        self.state = state
+        self.returncode = returncode
+        self.start = start
+        self.end = end
+        self.user = user
+        self.sys = sys
+        self.peak_rss = peak_rss
+
+    @property
+    def elapsed(self):
+        if self.start is None or self.end is None:
+            return None
+        return self.end - self.start
+
+    def __repr__(self):
+        return 'StageResult({!r}, {!r}, {!r})'.format(self.name, self.state, self.returncode)
+
+class CompileResult(object):
+    """
+    Outcome of a compilation.
+
+    returncode is the exit code bf-p4c would have returned. stages lists a
+    StageResult per step of the compilation, in the order they were added;
+    only the preprocessor runs when the outputs were restored from the
+    compile cache (cache_hit). artifacts maps artifact names to paths, see
+    BarefootBackend.artifacts.
+    """
+    def __init__(self, source, target, arch, output_dir):
+        self.source = source
+        self.target = target
+        self.arch = arch
+        self.output_dir = output_dir
+        self.returncode = None
+        self.stages = []
+        self.artifacts = {}
+        self.cache_hit = False
+        self.start = time.time()
+        self.end = None
+
+    @property
+    def success(self):
+        return self.returncode == 0
+
+    @property
+    def elapsed(self):
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+    def stage(self, name):
+        for s in self.stages:
+            if s.name == name:
+                return s
+        return None
+
+    def __repr__(self):
+        return 'CompileResult({!r}, {!r}, {!r}, returncode={!r})'.format(
+            self.source, self.target, self.arch, self.returncode)
+
+def _collect(result, backend):
+    result.end = time.time()
+    if backend is None:
+        return
+    result.output_dir = backend._output_directory
+    result.stages = [StageResult(s.name, s.state, s.rc, s.start, s.end,
+                                 s.user, s.sys, s.peak_rss)
+                     for s in backend.stages()]
+    result.cache_hit = getattr(backend, 'cache_hit', False)
+    try:
+        result.artifacts = backend.artifacts()
+    except DriverError:
+        # the manifest can not be parsed, report what we have
+        result.artifacts = {}
+
+def compile(source, target = 'tofino', arch = 'default', options = (), output_dir = None):
+    """
+    Compile source for (target, arch).
+
+    options is a list of bf-p4c command line options, e.g. ['-g', '--verbose', '2'].
+    output_dir defaults to the bf-p4c default (<program>.<target> in the
+    current directory). The P4C_DEFAULT_* environment variables do not apply.
+
+    Returns a CompileResult, or raises DriverError. DriverExit, a DriverError
+    with a return code of 0, is raised if options only ask for help.
+    """
+    setup_environment()
+    from p4c_src.main import build_parser, load_config, select_backend, run_backend
+
+    args = list(options) + ['--target', target, '--arch', arch]
+    if output_dir is not None:
+        args += ['-o', output_dir]
+    args.append(source)
+
+    result = CompileResult(source, target, arch, output_dir)
+    backend = None
+    try:
+        parser = build_parser(ArgumentParser)
+        cfg = load_config(parser)
+        early_opts = argparse.Namespace(target = target, arch = arch)
+        opts, backend = select_backend(parser, cfg, args, early_opts, environment = False)
+        result.returncode = run_backend(backend, opts)
+    except DriverError as e:
+        result.returncode = e.returncode
+        _collect(result, backend)
+        e.result = result
+        raise
+    _collect(result, backend)
+    return result
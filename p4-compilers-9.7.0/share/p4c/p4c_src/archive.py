@@ -0,0 +1,172 @@
+# Copyright 2013-2021 Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials,
+# and your use of them is governed by the express license under which they
+# were provided to you ("License"). Unless the License provides otherwise,
+# you may not use, modify, copy, publish, distribute, disclose or transmit this
+# software or the related documents without Intel's prior written permission.
+#
+# This software and the related documents are provided as is, with no
+# express or implied warranties, other than those that are expressly stated
+# in the License.
+
+"""
+The archive of the outputs (--archive).
+
+The outputs are streamed into a tar archive by tarfile, and the stream is
+compressed on several threads:
+
+  zst  with the zstandard module, which compresses on its own threads
+  xz, gz, bz2
+       the stream is cut in blocks, compressed concurrently (lzma, zlib
+       and bz2 release the GIL) and written in order, each block as a
+       separate stream. xz, gzip and bzip2 decompress such concatenated
+       streams as a single one, as pixz, pigz and pbzip2 archives.
+
+--archive-format auto selects zst if zstandard is installed, xz otherwise
+(gz if Python was built without lzma).
+"""
+
+import bz2
+import collections
+import concurrent.futures
+import fnmatch
+import os
+import tarfile
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+EXCLUDE = ('*.bin',)
+
+_BLOCK_SIZE = 8 << 20
+
+def resolve_format(archive_format):
+    if archive_format != 'auto':
+        return archive_format
+    if zstandard is not None:
+        return 'zst'
+    if lzma is not None:
+        return 'xz'
+    return 'gz'
+
+def available(archive_format):
+    return { 'zst': zstandard is not None, 'xz': lzma is not None }.get(archive_format, True)
+
+def extension(archive_format):
+    return '.tar.' + resolve_format(archive_format)
+
+def _compress_gz(block):
+    # a complete gzip member (wbits 31 writes the gzip header and trailer)
+    c = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return c.compress(block) + c.flush()
+
+def _compress_xz(block):
+    return lzma.compress(block, format = lzma.FORMAT_XZ, preset = 1)
+
+def _compress_bz2(block):
+    return bz2.compress(block, 9)
+
+_COMPRESSORS = { 'gz': _compress_gz, 'xz': _compress_xz, 'bz2': _compress_bz2 }
+
+class ParallelWriter(object):
+    """
+    A write-only file object that compresses blocks of what is written to
+    it concurrently, and writes them to fileobj in order
+    """
+    def __init__(self, fileobj, compress, threads):
+        self._fileobj = fileobj
+        self._compress = compress
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers = threads)
+        self._pending = collections.deque()
+        self._max_pending = 2 * threads
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= _BLOCK_SIZE:
+            self._submit(bytes(self._buffer[:_BLOCK_SIZE]))
+            del self._buffer[:_BLOCK_SIZE]
+        return len(data)
+
+    def _submit(self, block):
+        self._pending.append(self._executor.submit(self._compress, block))
+        while len(self._pending) > self._max_pending:
+            self._fileobj.write(self._pending.popleft().result())
+
+    def close(self):
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        try:
+            while self._pending:
+                self._fileobj.write(self._pending.popleft().result())
+        finally:
+            self._executor.shutdown(cancel_futures = True)
+
+def _excluded(path):
+    return any(fnmatch.fnmatch(os.path.basename(path), p) for p in EXCLUDE)
+
+def _size(path):
+    """
+    The size of the files under path that are archived
+    """
+    if not os.path.isdir(path):
+        return 0 if _excluded(path) else os.path.getsize(path)
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            if not _excluded(f):
+                try:
+                    total += os.lstat(os.path.join(root, f)).st_size
+                except OSError:
+                    pass
+    return total
+
+def create(archive_file, archive_format, members, threads = None, progress = None):
+    """
+    Write the tar archive archive_file, compressed with archive_format, of
+    members, a list of (path, name in the archive). Files matching EXCLUDE
+    are left out. progress is called with the bytes archived and the total
+    as files are added.
+    """
+    archive_format = resolve_format(archive_format)
+    threads = threads or os.cpu_count() or 1
+    total = sum(_size(path) for path, _ in members)
+    done = [0]
+
+    def add(tarinfo):
+        if _excluded(tarinfo.name):
+            return None
+        if tarinfo.isfile():
+            done[0] += tarinfo.size
+            if progress is not None:
+                progress(done[0], total)
+        return tarinfo
+
+    tmp = archive_file + '.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            if archive_format == 'zst':
+                stream = zstandard.ZstdCompressor(level = 3, threads = threads).stream_writer(f)
+            else:
+                stream = ParallelWriter(f, _COMPRESSORS[archive_format], threads)
+            try:
+                with tarfile.open(fileobj = stream, mode = 'w|',
+                                  format = tarfile.GNU_FORMAT) as tar:
+                    for path, name in members:
+                        tar.add(path, arcname = name, filter = add)
+            finally:
+                stream.close()
+        os.replace(tmp, archive_file)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
@@ -17,15 +17,14 @@ import os
 import os.path
 import argparse
 import sys
-import json
-from packaging import version
-import re
+import threading
 import time
 import p4c_src.bfn_version as p4c_version
 from p4c_src.util import find_file, find_bin
-from p4c_src.driver import BackendDriver
+from p4c_src.driver import BackendDriver, DriverError, DriverExit, Step, StepGraph, \
+    command_line, current_step, set_current_step
 
-class CompilationError(Exception):
+class CompilationError(DriverError):
     """Raised when a P4 program fails to compile"""
     pass
 
@@ -45,6 +44,7 @@ def checkEnv():
                 # This is a funny setup, where we can't find our configuration, so we should
                 # not run anything depending on scripts
                 return None
+            import re
             with open(cache_file) as cmake_cache:
                 src_dir_pattern = re.compile(r'BFN_P4C_SOURCE_DIR:STATIC=(.*)$')
                 for line in cmake_cache:
@@ -57,14 +57,36 @@ def checkEnv():
 
     return None
 
-# Search the environment for assets
-if os.environ['P4C_BUILD_TYPE'] == "DEVELOPER":
-    bfas = find_file('bf-asm', 'bfas')
-else:
-    bfas = find_file(os.environ['P4C_BIN_DIR'], 'bfas')
+_tools = None
+
+def findTools():
+    """
+    Search the environment for assets, the first time a backend needs them.
+    Returns the paths to bfas, bfrt_schema.py and p4c-gen-conf.
+    """
+    global _tools
+    if _tools is None:
+        if os.environ['P4C_BUILD_TYPE'] == "DEVELOPER":
+            bfas = find_file('bf-asm', 'bfas')
+        else:
+            bfas = find_file(os.environ['P4C_BIN_DIR'], 'bfas')
+
+        bfrt_schema = find_file(os.environ['P4C_BIN_DIR'], 'bfrt_schema.py')
+        p4c_gen_conf = find_file(os.environ['P4C_BIN_DIR'], 'p4c-gen-conf')
+        _tools = (bfas, bfrt_schema, p4c_gen_conf)
+    return _tools
+
+def default_arch(target, language):
+    """
+    Return the architecture used for target when none is specified
+    """
+    if language == "p4-14":
+        return "v1model"
+    import re
+    match = re.match('tofino([0-9]?)', target)
+    rev = match.group(1) if match else ''
+    return 't' + rev + 'na'
 
-bfrt_schema = find_file(os.environ['P4C_BIN_DIR'], 'bfrt_schema.py')
-p4c_gen_conf = find_file(os.environ['P4C_BIN_DIR'], 'p4c-gen-conf')
 class BarefootBackend(BackendDriver):
     def __init__(self, target, arch, argParser):
         BackendDriver.__init__(self, target, arch, argParser)
@@ -74,15 +96,42 @@ class BarefootBackend(BackendDriver):
         self.mau_json = {}   # remove when the compiler adds the manifest
         self.metrics = {}
         self.program_name = None
+        self._cache = None
+        self._cache_stats = False
+        self._manifest_lock = threading.Lock()
+        self._asm_intervals = []
+        self._verifier_rc = {}
+        self._incremental_assembly = True
+        self._defer_resources_merge = False
+        self._compact_json = False
+        self._staging_dir = None
+        self._publish_dir = None
+        self._archive = None
+        self._cleaned = None
+        self._manifest_rc = 0
+        self._resume_from = None
+        self._resume_skip = set()
+        self._checkpoint = None
+        self._asm_skipped = {}
+        self._pipes = []
+        self._manifest = None
+        self._bf_rt_schema = None
+        self._shard_pipes = None
+        self._race = None
+        self._race_summary = None
+        self._memory_admission = False
+        self._trace_file = None
+        self._run_start = None
+        self.cache_hit = False
 
         # commands
+        bfas, bfrt_schema, p4c_gen_conf = findTools()
         self.add_command('preprocessor', 'cc')
         self.add_command('compiler',
                          os.path.join(os.environ['P4C_BIN_DIR'], 'p4c-barefoot'))
         self.add_command('assembler', bfas)
         self.add_command('bf-rt-verifier', bfrt_schema)
         self.add_command('p4c-gen-conf', p4c_gen_conf)
-        self.add_command('cleaner', 'rm')
 
         self.runVerifiers = False
         top_src_dir = checkEnv()
@@ -96,7 +145,9 @@ class BarefootBackend(BackendDriver):
 
         # order of commands
         self.enable_commands(['preprocessor', 'compiler', 'assembler',
-                              'summary_logging', 'p4c-gen-conf', 'cleaner'])
+                              'summary_logging', 'p4c-gen-conf'])
+        # the cleaner runs in process
+        self._commandsEnabled.append('cleaner')
 
         # additional options
         self.add_command_line_options()
@@ -117,12 +168,16 @@ class BarefootBackend(BackendDriver):
                                     help="Only run assembler",
                                     action="store_true", default=False)
         self._argGroup.add_argument("--archive", nargs='?',
-                                    help="Archive all outputs into a single tar.bz2 file.\n" + \
+                                    help="Archive all outputs into a single compressed tar file.\n" + \
                                     "Note: it can not be the argument before source file" + \
                                     " without specifying the archive name!",
                                     const="__default__", default=None)
         self._argGroup.add_argument("--archive-source", action="store_true", default=False,
                                     help="Add source outputs to the archive.")
+        self._argGroup.add_argument("--archive-format", dest="archive_format",
+                                    choices=['auto', 'zst', 'xz', 'gz', 'bz2'], default="auto",
+                                    help="Compression of the archive (default auto: zst if the "
+                                    "zstandard module is installed, otherwise xz).")
         self._argGroup.add_argument("--bf-rt-schema", action="store", default=None,
                                     help="Generate and write BF-RT JSON schema  to the specified file")
         self._argGroup.add_argument("--no-bf-rt-schema", action="store_true", default=False,
@@ -133,6 +188,38 @@ class BarefootBackend(BackendDriver):
         self._argGroup.add_argument("--skip-compilation",
                                     action="store", help="Skip compiling pipes whose name contains one of the"
                                                          "'pipeX' substring")
+        self._argGroup.add_argument("--shard-pipes", dest="shard_pipes",
+                                    help="Compile each of the comma separated pipes with its own "
+                                    "compiler process, in parallel, and merge their outputs. "
+                                    "Without a list, the pipes of the previous compilation in the "
+                                    "output directory are used.",
+                                    action="store", nargs="?", const="", default=None,
+                                    metavar="PIPES")
+        self._argGroup.add_argument("--race", dest="race",
+                                    help="Run the compiler with each of the comma separated "
+                                    "strategies concurrently and keep the first that succeeds. "
+                                    "A strategy is 'default' or compiler options without their "
+                                    "leading dashes joined by '+', e.g. quick-phv-alloc,default.",
+                                    action="store", default=None, metavar="STRATEGIES")
+        self._argGroup.add_argument("--memory-admission", dest="memory_admission",
+                                    help="Wait, before running the compiler, until the memory it "
+                                    "used in previous compilations of the program is available, "
+                                    "taking into account other compilations waiting or running "
+                                    "(default $P4C_MEMORY_ADMISSION).",
+                                    action="store_true", default=False)
+        self._argGroup.add_argument("--trace-file", dest="trace_file",
+                                    help="Write the time line of the compilation steps to "
+                                    "TRACE_FILE, in the Chrome trace event format.",
+                                    action="store", default=None)
+        self._argGroup.add_argument("--depfile", dest="depfile",
+                                    help="Write the files the program includes to DEPFILE, as a "
+                                    "Make rule, so that build systems recompile the program when "
+                                    "any of them changes.",
+                                    action="store", default=None)
+        self._argGroup.add_argument("--depfile-target", dest="depfile_target",
+                                    help="Target of the rule written to --depfile "
+                                    "(default: manifest.json in the output directory).",
+                                    action="store", default=None)
         self._argGroup.add_argument("--auto-init-metadata",
                                     action="store_true", default=False,
                                     help="Automatically initialize metadata to false or 0. This "
@@ -203,6 +290,51 @@ class BarefootBackend(BackendDriver):
                                     help="Program name overriding the default name derived from source file name.",
                                     action="store", default=None, type=str,
                                     dest="program_name", required=False)
+        self._argGroup.add_argument("--post-jobs", dest="post_jobs",
+                                    help="Run up to N independent steps concurrently: "
+                                    "the assembler, verifier and summary logging of each pipe, "
+                                    "the BF-RT verifier and conf generation.",
+                                    action="store", default=1, type=int, metavar="N")
+        self._argGroup.add_argument("--no-incremental-assembly", dest="incremental_assembly",
+                                    help="Run the assembler for all the pipes, even those whose "
+                                    "assembly did not change since the previous compilation.",
+                                    action="store_false", default=True)
+        self._argGroup.add_argument("--defer-resources-merge", dest="defer_resources_merge",
+                                    help="Do not merge the deparser resources generated by the "
+                                    "assembler into resources.json, keep them in "
+                                    "resources_deparser.json to be merged when read.",
+                                    action="store_true", default=False)
+        self._argGroup.add_argument("--staging-dir", dest="staging_dir", nargs="?", const="",
+                                    help="Write the outputs to a scratch directory in DIR "
+                                    "(default $P4C_STAGING_DIR, or /dev/shm when it has room) "
+                                    "and publish them to the output directory at the end.",
+                                    action="store", default=None, metavar="DIR")
+        self._argGroup.add_argument("--compact-json", dest="compact_json",
+                                    help="Write the manifest, resources and conf files without "
+                                    "indentation (default $P4C_COMPACT_JSON). bf-p4c-fmt "
+                                    "indents them.",
+                                    action="store_true", default=None)
+        self._argGroup.add_argument("--resume-from", dest="resume_from", nargs="?", const="",
+                                    help="Resume a failed or interrupted compilation from STAGE "
+                                    "(compiler, bf-rt-verifier, assembler, summary_logging, "
+                                    "p4c-gen-conf or manifest-verifier), reusing the outputs of "
+                                    "the previous stages if the inputs did not change. Without "
+                                    "STAGE, resume after the last stage that completed.",
+                                    action="store", default=None, metavar="STAGE")
+        self._argGroup.add_argument("--no-cache", dest="no_cache",
+                                    help="Do not use the compilation cache.",
+                                    action="store_true", default=False)
+        self._argGroup.add_argument("--cache-dir", dest="cache_dir",
+                                    help="Directory of the compilation cache "
+                                    "(default $P4C_CACHE_DIR or ~/.cache/bf-p4c).",
+                                    action="store", default=None)
+        self._argGroup.add_argument("--cache-size", dest="cache_size",
+                                    help="Maximum size of the compilation cache in MB "
+                                    "(default $P4C_CACHE_SIZE or 5120).",
+                                    action="store", default=None, type=int)
+        self._argGroup.add_argument("--cache-stats", dest="cache_stats",
+                                    help="Print the compilation cache hit/miss statistics.",
+                                    action="store_true", default=False)
 
     def config_preprocessor(self, targetDefine):
         self.add_command_option('preprocessor', "-E -x assembler-with-cpp")
@@ -292,12 +424,26 @@ class BarefootBackend(BackendDriver):
         if self._output_directory == '.':
             # if no output directory set, set it to <program_name.target>
             self._output_directory = "{}.{}".format(self.program_name, self._target)
+        self._publish_dir = self._output_directory
+        if opts.staging_dir is not None and not opts.dry_run and opts.resume_from is None:
+            # a resumed compilation reuses the outputs in place
+            from p4c_src.staging import staging_root, create
+            root = staging_root(opts.staging_dir)
+            if root is not None:
+                self._staging_dir = create(root, self._output_directory)
+                self._output_directory = self._staging_dir
+            elif opts.staging_dir:
+                self.exitWithError("can not stage the outputs in {}".format(opts.staging_dir))
         output_dir = self._output_directory
         basepath = "{}/{}".format(output_dir, self.program_name)
 
         if not opts.run_preprocessor_only:
             self.add_command_option('preprocessor', "-o")
             self.add_command_option('preprocessor', "{}.p4pp".format(basepath))
+        if opts.depfile is not None:
+            depfile_target = opts.depfile_target or os.path.join(self._publish_dir, 'manifest.json')
+            self.add_command_args('preprocessor', '-MD', '-MP', '-MF', opts.depfile,
+                                  '-MT', depfile_target)
         self.add_command_option('preprocessor', self._source_filename)
 
         self.add_command_option('compiler', "--target " + self._target)
@@ -374,6 +520,21 @@ class BarefootBackend(BackendDriver):
             self.add_command_option('compiler', '--skip-compilation={}'.format(opts.skip_compilation))
             self.skip_compilation = opts.skip_compilation.split(',')
 
+        # sharding rewrites the compiler command, it can not run under a debugger
+        self._shard_pipes = None
+        if opts.shard_pipes is not None and opts.ir_to_json is None and \
+           not (os.environ['P4C_BUILD_TYPE'] == "DEVELOPER" and (opts.gdb or opts.lldb)):
+            self._shard_pipes = [p for p in opts.shard_pipes.split(',') if p]
+
+        self._race = None
+        if opts.race is not None and opts.ir_to_json is None and \
+           not (os.environ['P4C_BUILD_TYPE'] == "DEVELOPER" and (opts.gdb or opts.lldb)):
+            self._race = [r for r in opts.race.split(',') if r]
+            if len(set(self._race)) != len(self._race):
+                self.exitWithError("--race: duplicate strategy in {}".format(opts.race))
+            if self._shard_pipes is not None:
+                self.exitWithError("--race can not be combined with --shard-pipes")
+
         if opts.display_power_budget:
             self.add_command_option('compiler', '--display-power-budget')
 
@@ -395,7 +556,7 @@ class BarefootBackend(BackendDriver):
             self.add_command_option('compiler', '--help-warnings')
             self.checkAndRunCmd('compiler')
             # no need for anything else, we printed the pragmas and we need to exit
-            sys.exit(0)
+            raise DriverExit()
 
         if opts.Wdisable is not None:
             self.config_warning_modifiers(opts.Wdisable, "disable")
@@ -408,7 +569,7 @@ class BarefootBackend(BackendDriver):
             self.add_command_option('compiler', '--help-pragmas')
             self.checkAndRunCmd('compiler')
             # no need for anything else, we printed the pragmas and we need to exit
-            sys.exit(0)
+            raise DriverExit()
 
         if opts.verbose > 0:
             ta_logging = "table_placement:3,table_summary:1,table_dependency_graph:3"
@@ -448,6 +609,7 @@ class BarefootBackend(BackendDriver):
            not (self._arch == 'v1model' or self._arch == 'psa' or opts.no_bf_rt_schema):
             opts.bf_rt_schema = "{}/bfrt.json".format(self._output_directory)
 
+        self._bf_rt_schema = opts.bf_rt_schema
         if opts.bf_rt_schema is not None:
             self.add_command_option('compiler', '--bf-rt-schema {}'.format(opts.bf_rt_schema))
 
@@ -462,7 +624,8 @@ class BarefootBackend(BackendDriver):
         # Add conf generation options
         if opts.bf_rt_schema is not None:
             conf_type = 'BF-RT'
-            self.add_command_option('p4c-gen-conf', '--bfrt-name {}'.format(opts.bf_rt_schema))
+            self.add_command_option('p4c-gen-conf', '--bfrt-name {}'.format(
+                self.publishedPath(opts.bf_rt_schema)))
         elif opts.language == 'p4-14':
             conf_type = 'PD'
         elif opts.p4runtime_force_std_externs:
@@ -471,9 +634,13 @@ class BarefootBackend(BackendDriver):
         self.add_command_option('p4c-gen-conf', '--conf-type {}'.format(conf_type))
         self.add_command_option('p4c-gen-conf', '--name {}'.format(self.program_name))
         self.add_command_option('p4c-gen-conf', '--device {}'.format(self._target))
-        self.add_command_option('p4c-gen-conf', '--outputdir {}'.format(output_dir))
+        self.add_command_option('p4c-gen-conf', '--outputdir {}'.format(self._publish_dir))
         self.add_command_option('p4c-gen-conf', '--p4-version {}'.format(opts.language))
         self.conf_file = self.program_name + ".conf"
+        if self._staging_dir is not None:
+            # the conf refers to the published outputs, but is written with them
+            self.add_command_option('p4c-gen-conf', '--conf-file {}'.format(
+                os.path.join(output_dir, self.conf_file)))
 
         if opts.verbose > 0:
             log_scripts_dir = os.environ['P4C_BIN_DIR']
@@ -497,26 +664,121 @@ class BarefootBackend(BackendDriver):
 
         # if we need to generate an archive, should be the last command
         if opts.archive is not None:
-            self.add_command('archiver', 'tar')
-            root_dir = os.path.dirname(output_dir)
+            from p4c_src.archive import available, extension
+            if not available(opts.archive_format):
+                self.exitWithError("--archive-format {} is not supported by this Python "
+                                   "installation".format(opts.archive_format))
+            # archives the published outputs, see run()
+            root_dir = os.path.dirname(self._publish_dir)
             if root_dir == "": root_dir = "."
             if opts.archive == "__default__":
                 program_name = os.path.basename(basepath)
             else:
                 program_name = opts.archive
-            program_dir = os.path.basename(output_dir)
+            program_dir = os.path.basename(self._publish_dir)
             if program_dir != ".":
-                self.add_command_option('archiver',
-                                        "-jcf {}/{}.tar.bz2 --exclude=\"*.bin\" -C {} {}".format(root_dir,
-                                        program_name, root_dir, program_dir))
+                # the members as tar -C root_dir would name them
+                members = [(self._publish_dir, program_dir)]
                 if opts.archive_source:
-                    self.add_command_option('archiver',
-                                            os.path.dirname(os.path.abspath(self._source_filename)))
+                    source_dir = os.path.dirname(os.path.abspath(self._source_filename))
+                    members.append((source_dir, source_dir.lstrip(os.sep)))
+                self._archive = { 'file': os.path.join(root_dir, program_name +
+                                                       extension(opts.archive_format)),
+                                  'format': opts.archive_format,
+                                  'members': members }
                 self._commandsEnabled.append('archiver')
             else:
                 print("Please specify an output directory (using -o) to" + \
                     " generate an archive", file=sys.stderr)
 
+        if opts.post_jobs < 1:
+            self.exitWithError("--post-jobs expects a positive number of jobs")
+        self._jobs = opts.post_jobs
+
+        from p4c_src.admission import enabled
+        self._memory_admission = enabled(opts.memory_admission) and not self._dry_run
+
+        self._incremental_assembly = opts.incremental_assembly and not self._dry_run
+        self._resume_from = opts.resume_from
+        self._defer_resources_merge = opts.defer_resources_merge
+        if opts.compact_json is None:
+            from p4c_src.jsonio import compact_default
+            opts.compact_json = compact_default()
+        self._compact_json = opts.compact_json
+        if self._compact_json:
+            self.add_command_option('p4c-gen-conf', '--compact-json')
+
+        self._trace_file = opts.trace_file
+
+        self._cache_stats = opts.cache_stats
+        if self.isCacheable(opts):
+            from p4c_src.cache import CompileCache, default_cache_dir, default_cache_size
+            cache_dir = opts.cache_dir or default_cache_dir()
+            cache_size = opts.cache_size if opts.cache_size is not None else default_cache_size()
+            self._cache = CompileCache(cache_dir, cache_size, self._verbose)
+
+    def isCacheable(self, opts):
+        """
+        A compilation can be cached only if it runs the whole pipeline and all
+        its outputs end up in the output directory.
+        """
+        if opts.no_cache or self._dry_run:
+            return False
+        for c in ['preprocessor', 'compiler', 'assembler']:
+            if c not in self._commandsEnabled:
+                return False
+        if self._ir_to_json is not None or opts.p4runtime_file or opts.p4runtime_files:
+            return False
+        if os.environ['P4C_BUILD_TYPE'] == "DEVELOPER":
+            if opts.gdb or opts.lldb or opts.dump_dir or opts.json or opts.pretty_print:
+                return False
+        if opts.bf_rt_schema is not None:
+            output_dir = os.path.abspath(self._output_directory)
+            if not os.path.abspath(opts.bf_rt_schema).startswith(output_dir + os.sep):
+                return False
+        return True
+
+    def cacheKey(self):
+        """
+        Compute the cache key from the preprocessed source, the options of all
+        the commands that produce outputs, the target, and the compiler version.
+        """
+        from p4c_src.cache import CacheKey
+        from p4c_src.main import get_version
+        key = CacheKey()
+        key.add_file('source', "{}/{}.p4pp".format(self._output_directory, self.program_name))
+        key.add_string('target', self._target)
+        key.add_string('arch', self._arch)
+        key.add_string('bfn_version', p4c_version.p4c_version)
+        key.add_string('version', get_version())
+        if self._race:
+            # the outputs depend on the strategy that wins
+            key.add_string('race', ','.join(self._race))
+        if self._defer_resources_merge:
+            key.add_string('defer-resources-merge', True)
+        if self._compact_json:
+            key.add_string('compact-json', True)
+        for c in sorted(self._commandsEnabled):
+            if c not in ('preprocessor', 'cleaner', 'archiver'):
+                cmd = command_line(self._commands[c])
+                if self._staging_dir is not None:
+                    # as if compiled in place, the staging directory is unique
+                    cmd = cmd.replace(self._staging_dir, self._publish_dir)
+                key.add_string(c, cmd)
+        key.add_tool('compiler-bin', self._commands['compiler'][0])
+        key.add_tool('assembler-bin', self._commands['assembler'][0])
+        return key.hexdigest()
+
+    def manifest(self):
+        """
+        The manifest of the compilation, loaded by parseManifest
+        """
+        if self._manifest is None:
+            from p4c_src.manifest import Manifest
+            self._manifest = Manifest(os.path.join(self._output_directory, 'manifest.json'),
+                                      compact = self._compact_json)
+        return self._manifest
+
     def parseManifest(self):
         """
         parse the manifest file and return a map of the program pipes
@@ -524,15 +786,18 @@ class BarefootBackend(BackendDriver):
         one assembler line if needed.
         """
 
-        manifest_filename = "{}/manifest.json".format(self._output_directory)
+        from packaging import version
+        from p4c_src.manifest import PipeInfo
+
+        manifest = self.manifest()
+        manifest_filename = manifest.path
 
         if self._dry_run:
             print('parse manifest:', manifest_filename)
-            self._pipes = [ { 'context': '{}/pipe/context.json'.format(self._output_directory),
-                              'resources': '{}/pipe/resources.json'.format(self._output_directory),
-                              'pipe_dir': '{}/pipe'.format(self._output_directory),
-                              'pipe_id': 0
-            } ]
+            pipe = PipeInfo(0, pipe_dir = '{}/pipe'.format(self._output_directory),
+                            context = '{}/pipe/context.json'.format(self._output_directory))
+            pipe.resources = '{}/pipe/resources.json'.format(self._output_directory)
+            self._pipes = [ pipe ]
             return 0
 
         # compilation failed and there is no manifest. An error should have been printed,
@@ -540,85 +805,74 @@ class BarefootBackend(BackendDriver):
         if not os.path.isfile(manifest_filename) or os.path.getsize(manifest_filename) == 0:
             self.exitWithError(None)
 
-        with open(manifest_filename, "r") as json_file:
+        if not manifest.loaded:
             try:
-                self._manifest = json.load(json_file)
-            except:
+                manifest.load()
+            except (OSError, ValueError):
                 error_msg = None
                 if os.environ['P4C_BUILD_TYPE'] == "DEVELOPER":
                     error_msg = "ERROR: Input file '" + manifest_filename + \
                                 "' could not be decoded as JSON.\n"
                 self.exitWithError(error_msg)
-            if (type(self._manifest) is not dict or "programs" not in self._manifest):
-                error_msg = None
-                if os.environ['P4C_BUILD_TYPE'] == "DEVELOPER":
-                    error_msg = "ERROR: Input file '" + manifest_filename + \
-                                "' does not appear to be valid manifest JSON.\n"
-                self.exitWithError(error_msg)
+        tree = manifest.tree
+        if (type(tree) is not dict or "programs" not in tree):
+            error_msg = None
+            if os.environ['P4C_BUILD_TYPE'] == "DEVELOPER":
+                error_msg = "ERROR: Input file '" + manifest_filename + \
+                            "' does not appear to be valid manifest JSON.\n"
+            self.exitWithError(error_msg)
 
-        self._pipes = []
-        schema_version = version.parse(self._manifest['schema_version'])
+        pipes = {}
+        schema_version = version.parse(tree['schema_version'])
         pipe_name_label = 'pipe_name'
         if schema_version == version.parse("1.0.0"): pipe_name_label = 'pipe'
 
-        programs = self._manifest['programs']
+        programs = tree['programs']
         if len(programs) > 1:
             error_msg = "{} currently supports a single program".format(self._targetName.title())
             self.exitWithError(error_msg)
 
+        def __pipeDir(pipe_name, p4_version):
+            if p4_version == 'p4-14':
+                return self._output_directory
+            return os.path.join(self._output_directory, pipe_name)
+
         def __parseManifestBefore_2_0(prog, p4_version):
             if (type(prog) is not dict or "contexts" not in prog):
                 error_msg = "ERROR: Input file '" + manifest_filename + \
                                  "' does not contain valid program contexts.\n"
                 self.exitWithError(error_msg)
             for ctxt in prog["contexts"]:
-                self._pipes.append({})
                 pipe_id = ctxt['pipe']
-                self._pipes[pipe_id]['pipe_name'] = ctxt['pipe_name']
-                self._pipes[pipe_id]['context'] = os.path.join(self._output_directory,
-                                                               ctxt['path'])
-                if p4_version == 'p4-14':
-                    self._pipes[pipe_id]['pipe_dir'] = self._output_directory
-                else:
-                    self._pipes[pipe_id]['pipe_dir'] = os.path.join(self._output_directory,
-                                                                    ctxt['pipe_name'])
+                pipes[pipe_id] = PipeInfo(pipe_id, ctxt['pipe_name'],
+                                          __pipeDir(ctxt['pipe_name'], p4_version),
+                                          os.path.join(self._output_directory, ctxt['path']))
             for res in prog['p4i']:
-                pipe_id = res['pipe']
-                res_file = os.path.join(self._output_directory, res['path'])
-                self._pipes[pipe_id]['resources'] = res_file
+                pipes[res['pipe']].resources = os.path.join(self._output_directory, res['path'])
 
         def __parseManifestAfter_2_0(prog, p4_version):
             if (type(prog) is not dict or "pipes" not in prog):
                 error_msg = "ERROR: Input file '" + manifest_filename + \
                                  "' does not contain a valid program.\n"
+                self.exitWithError(error_msg)
             for pipe in prog["pipes"]:
-                self._pipes.append({})
                 pipe_id = int(pipe['pipe_id'])
-                self._pipes[pipe_id]['pipe_id'] = pipe_id
-                self._pipes[pipe_id]['pipe_name'] = pipe['pipe_name']
-                self._pipes[pipe_id]['context'] = os.path.join(self._output_directory,
-                                                               pipe['files']['context']['path'])
-                if p4_version == 'p4-14':
-                    self._pipes[pipe_id]['pipe_dir'] = self._output_directory
-                else:
-                    self._pipes[pipe_id]['pipe_dir'] = os.path.join(self._output_directory,
-                                                                    pipe['pipe_name'])
+                info = PipeInfo(pipe_id, pipe['pipe_name'],
+                                __pipeDir(pipe['pipe_name'], p4_version),
+                                os.path.join(self._output_directory,
+                                             pipe['files']['context']['path']))
                 for res in pipe['files']['resources']:
                     if res['type'] == "resources":
-                        self._pipes[pipe_id]['resources'] = os.path.join(self._output_directory,
-                                                                         res['path'])
+                        info.resources = os.path.join(self._output_directory, res['path'])
                 for graph in pipe['files']['graphs']:
                     if graph['graph_format'] == ".json" and graph['graph_type'] == 'table':
-                        self._pipes[pipe_id]['graph'] = os.path.join(self._output_directory,
-                                                                        graph['path'])
+                        info.graph = os.path.join(self._output_directory, graph['path'])
                 for log in pipe['files']['logs']:
                     if log['log_type'] == 'phv' and log['path'].endswith('phv.json'):
-                        self._pipes[pipe_id]['phv_json'] = os.path.join(self._output_directory,
-                                                                        log['path'])
+                        info.phv_json = os.path.join(self._output_directory, log['path'])
                     elif log['log_type'] == 'power' and log['path'].endswith('power.json'):
-                        self._pipes[pipe_id]['power_json'] = os.path.join(self._output_directory,
-                                                                          log['path'])
-
+                        info.power_json = os.path.join(self._output_directory, log['path'])
+                pipes[pipe_id] = info
 
         for prog in programs:
             p4_version = prog['p4_version']
@@ -626,18 +880,28 @@ class BarefootBackend(BackendDriver):
                 __parseManifestBefore_2_0(prog, p4_version)
             else:
                 __parseManifestAfter_2_0(prog, p4_version)
+        self._pipes = [pipes[pipe_id] for pipe_id in sorted(pipes)]
 
-    def updateManifest(self, jsonFile, compilation_successful = True):
+    def updateManifest(self, compilation_successful = True):
         """
-        Set the compile_command in the manifest or context.json
+        Set the compile_command and the compilation status in the manifest,
+        and write it for the tools that read it
         """
-        if self._dry_run or not os.path.exists(jsonFile) or os.path.getsize(jsonFile) == 0:
+        if self._dry_run:
             return
-
-        jsonTree = None
-        with open(jsonFile, "r") as json_file:
+        manifest = self.manifest()
+        with self._manifest_lock:
+            if not manifest.loaded:
+                try:
+                    manifest.load()
+                except (OSError, ValueError):
+                    return
+            self._updateManifest(manifest, compilation_successful)
+            manifest.flush()
+
+    def _updateManifest(self, manifest, compilation_successful):
+        with manifest.edit() as jsonTree:
             try:
-                jsonTree = json.load(json_file)
                 jsonTree['compile_command'] = ' '.join(sys.argv)
                 jsonTree['compilation_succeeded'] = compilation_successful
                 jsonTree['compilation_time'] = str(self.compilation_time)
@@ -645,69 +909,78 @@ class BarefootBackend(BackendDriver):
                         os.path.dirname(os.path.abspath(self._source_filename))
                 if self.conf_file is not None:
                     jsonTree['conf_file'] = self.conf_file
+                if self._race_summary is not None:
+                    jsonTree['race'] = self._race_summary
+                if self._asm_skipped:
+                    jsonTree['incremental_assembly'] = {
+                        'skipped': sorted(p for p, s in self._asm_skipped.items() if s),
+                        'assembled': sorted(p for p, s in self._asm_skipped.items() if not s) }
+                pipes = jsonTree['programs'][0]['pipes']
                 for pipe in self.mau_json:
                     mau_json = { 'path' : self.mau_json[pipe], 'log_type' : 'mau' }
-                    jsonTree['programs'][0]['pipes'][pipe]['files']['logs'].append(mau_json)
+                    logs = pipes[pipe]['files']['logs']
+                    # the manifest may be updated several times
+                    if mau_json not in logs:
+                        logs.append(mau_json)
                 for pipe in self.metrics:
-                    jsonTree['programs'][0]['pipes'][pipe]['files']['metrics'] = {
-                        'path' : self.metrics[pipe] }
+                    pipes[pipe]['files']['metrics'] = { 'path' : self.metrics[pipe] }
                 for pipe in self.contexts:
-                    jsonTree['programs'][0]['pipes'][pipe]['files']['context'] = {
-                        'path' : self.contexts[pipe] }
-            except:
-                return
-
-        if jsonTree is not None:
-            with open(jsonFile, "w") as new_file:
-                json.dump(jsonTree, new_file, indent=2, separators=(',', ': '))
+                    pipes[pipe]['files']['context'] = { 'path' : self.contexts[pipe] }
+            except (KeyError, IndexError, TypeError):
+                pass
 
     def exitWithError(self, error_msg):
         """
         Function to be called when compilation ends in error.
+        Records the failure in the manifest and raises CompilationError.
         """
         try:
-            manifest_json = os.path.join(self._output_directory, 'manifest.json')
-            self.updateManifest(manifest_json, False)
+            self.updateManifest(False)
         except:
             pass
-        finally:
-            if error_msg is not None:
-                print(str(error_msg), file=sys.stderr)
-            sys.exit(1)
+        raise CompilationError(None if error_msg is None else str(error_msg))
 
-    def runAssembler(self, dirname, unique_table_offset):
+    def assemblerCommand(self, dirname, unique_table_offset):
         """
-        Run an instance of the assembler on the provided directory
+        Return the assembler command for the provided directory, without the input file
         """
-        # reset all assembler options to what was passed on cmd line
-        # Note that we need to make a copy of the list
-        self._commands['assembler'] = list(self._saved_assembler_params)
+        # start from the options that were passed on cmd line
+        # Note that we need to make a copy of the list, pipes may be assembled concurrently
+        cmd = list(self._saved_assembler_params)
         # lookup the directory name. For P4-16, it is the output + pipe_name.
         # This logging feature is enabled during the DEVELOPER mode
         if os.environ['P4C_BUILD_TYPE'] == "DEVELOPER" and self.verbose > 0:
-            self.add_command_option('assembler',
-                                    "-vvvl {}/bfas.config.log".format(dirname))
+            cmd.append("-vvvl {}/bfas.config.log".format(dirname))
         else:
             # Disable warnings when not in DEVELOPER Mode
-            self.add_command_option('assembler', "--no-warn")
+            cmd.append("--no-warn")
 
         # don't generate a binary
         if self._no_link:
-            self.add_command_option('assembler', "--no-bin")
+            cmd.append("--no-bin")
 
         # target name
-        self.add_command_option('assembler', "--target " + self._targetName)
+        cmd.append("--target " + self._targetName)
         # prepend unique offset to table handle
-        self.add_command_option('assembler',
-                                "--table-handle-offset{0}".format(unique_table_offset))
+        cmd.append("--table-handle-offset{0}".format(unique_table_offset))
 
         if self._multi_parsers:
-            self.add_command_option('assembler', "--multi-parsers")
+            cmd.append("--multi-parsers")
 
         # output dir
-        self.add_command_option('assembler', "-o {}".format(dirname))
+        cmd.append("-o {}".format(dirname))
+        return cmd
+
+    def assemblyFile(self, dirname):
+        return "{}/{}.bfa".format(dirname, self.program_name)
+
+    def runAssembler(self, dirname, unique_table_offset):
+        """
+        Run an instance of the assembler on the provided directory
+        """
+        cmd = self.assemblerCommand(dirname, unique_table_offset)
         # input file
-        asm_file = "{}/{}.bfa".format(dirname, self.program_name)
+        asm_file = self.assemblyFile(dirname)
         asm_file_path = os.path.join(os.getcwd(), asm_file)
         if not os.path.isfile(asm_file_path):
             print("Skipping assembler, no assembly file generated", file=sys.stderr)
@@ -717,33 +990,36 @@ class BarefootBackend(BackendDriver):
             print("Skipping assembler, assembly file is empty", file=sys.stderr)
             return 1
 
-        self.add_command_option('assembler', asm_file)
+        cmd.append(asm_file)
         # run
-        return self.checkAndRunCmd('assembler')
+        return self.checkAndRunCmd('assembler', cmd)
 
-    def runSummaryLogging(self, pipe):
+    def addSummaryLogs(self, pipe):
+        """
+        Add the logs generated by summary logging for pipe to the manifest
+        """
         def __update_log_file(filemap, filetype, filename):
             fpath = os.path.join(filetype, filename) if self.language == 'p4-14' else \
-                    os.path.join(pipe['pipe_name'], filetype, filename)
+                    os.path.join(pipe.pipe_name, filetype, filename)
             if os.path.exists(os.path.join(self._output_directory, fpath)):
-                filemap[pipe['pipe_id']] = fpath
+                filemap[pipe.pipe_id] = fpath
 
+        __update_log_file(self.mau_json, 'logs', 'mau.json')
+        __update_log_file(self.metrics, 'logs', 'metrics.json')
+
+    def runSummaryLogging(self, pipe):
         try:
-            self.add_command_option('summary_logging', "{}".format(pipe['context']))
-            if pipe.get('resources', False):
-                self.add_command_option('summary_logging', "-r {}".format(pipe['resources']))
-            self.add_command_option('summary_logging',
-                                    "-o {}".format(os.path.join(pipe['pipe_dir'], 'logs')))
-            self.add_command_option('summary_logging', "--disable-phv-json")
-            if pipe.get('power_json', False):
-                self.add_command_option('summary_logging', "-p {}".format(pipe['power_json']))
-            manifest_filename = "{}/manifest.json".format(self._output_directory)
-            self.add_command_option('summary_logging', "-m {}".format(manifest_filename))
-            rc = self.checkAndRunCmd('summary_logging')
-            # and now remove the arguments added so that the next pipe is correct
-            del self._commands['summary_logging'][1:]
-            __update_log_file(self.mau_json, 'logs', 'mau.json')
-            __update_log_file(self.metrics, 'logs', 'metrics.json')
+            cmd = self._commands['summary_logging'][:1]
+            cmd.append("{}".format(pipe.context))
+            if pipe.resources:
+                cmd.append("-r {}".format(pipe.resources))
+            cmd.append("-o {}".format(os.path.join(pipe.pipe_dir, 'logs')))
+            cmd.append("--disable-phv-json")
+            if pipe.power_json:
+                cmd.append("-p {}".format(pipe.power_json))
+            cmd.append("-m {}".format(self.manifest().path))
+            rc = self.checkAndRunCmd('summary_logging', cmd)
+            self.addSummaryLogs(pipe)
             return rc
         except:
             pass
@@ -751,6 +1027,11 @@ class BarefootBackend(BackendDriver):
         return 1
 
     def runCleaner(self):
+        """
+        Remove the intermediate files from the outputs, ignoring failures.
+        The number of files removed and the bytes freed are reported with
+        the timings.
+        """
         if self.debug_info:
             return 0
 
@@ -758,29 +1039,60 @@ class BarefootBackend(BackendDriver):
         filesToRemove = []
         filesToRemove.append('.dynhash.json')
         filesToRemove.append('.prim.json')
-        filesToRemove.append('resources_deparser.json')
-
-        self.add_command_option('cleaner', '-f');
-        filesFound = 0
-        for root, dirs, files in os.walk(self._output_directory):
-            for f in files:
-                for rFile in filesToRemove:
-                    if f.endswith(rFile):
-                        self.add_command_option('cleaner', os.path.join(root, f));
-                        filesFound += 1
-
-        if filesFound == 0:
+        if not self._defer_resources_merge:
+            filesToRemove.append('resources_deparser.json')
+
+        from p4c_src.cleaner import matching_files, network_filesystem, remove_files, \
+            NETWORK_THREADS
+        if self._dry_run:
+            files = [path for path, _ in matching_files(self._output_directory, filesToRemove)]
+            if files:
+                print('cleaner:\n{}'.format(' '.join(files)))
             return 0
 
-        return self.checkAndRunCmd('cleaner')
+        threads = NETWORK_THREADS if network_filesystem(self._output_directory) else 1
+        count, freed = remove_files(self._output_directory, filesToRemove, threads)
+        self._cleaned = { 'files': count, 'bytes': freed }
+        if self._verbose:
+            print("cleaner: removed {} files, {} bytes".format(count, freed))
+        return 0
+
+    def runArchiver(self):
+        """
+        Archive the outputs, reporting the progress of large archives
+        """
+        import tarfile
+        from p4c_src.archive import create
+        archive = self._archive
+        if self._dry_run:
+            print('archiver:\n{} ({})'.format(archive['file'],
+                                              ' '.join(p for p, _ in archive['members'])))
+            return 0
+        if self._verbose:
+            print('archiving to {}'.format(archive['file']))
+        reported = [0]
+        def progress(done, total):
+            if total < (64 << 20) and not self._verbose:
+                return
+            percent = 100 * done // total if total else 100
+            if percent >= reported[0] + 10:
+                reported[0] = percent - percent % 10
+                print('archiver: {}% ({:.1f} of {:.1f} MB)'.format(
+                    percent, done / 1048576.0, total / 1048576.0))
+        try:
+            create(archive['file'], archive['format'], archive['members'], progress = progress)
+        except (OSError, tarfile.TarError) as e:
+            print("failed command archiver: {}".format(e), file=sys.stderr)
+            return 1
+        return 0
 
     # this should be in the parent class!!
-    def checkAndRunCmd(self, command):
-        cmd = self._commands[command]
+    def checkAndRunCmd(self, command, cmd = None):
+        if cmd is None:
+            cmd = self._commands[command]
         if cmd[0].find('/') != 0 and (find_bin(cmd[0]) == None):
             error_msg = "{}: command not found".format(cmd[0])
-            print(str(error_msg), file=sys.stderr)
-            sys.exit(100)   # environment missconfiguration.
+            raise DriverError(error_msg, 100)   # environment missconfiguration.
         rc = self.runCmd(command, cmd)
         if rc != 0:
             error_msg = "failed command {}".format(command)
@@ -793,13 +1105,8 @@ class BarefootBackend(BackendDriver):
         return rc
 
     def checkVersionTargetArch(self, target, language, arch):
-        if language == "p4-14" and arch == 'default':
-            self._arch = "v1model"
-            self.backend = target + '-' + 'v1model'
-        elif language == "p4-16" and arch == 'default':
-            match = re.match('tofino([0-9]?)', target)
-            rev = match.group(1) or ''
-            self._arch = 't' + rev + 'na'
+        if arch == 'default' and language in ("p4-14", "p4-16"):
+            self._arch = default_arch(target, language)
             self.backend = target + '-' + self._arch
 
     def aggregate_deparser_resources_json(self,pipe):
@@ -810,11 +1117,13 @@ class BarefootBackend(BackendDriver):
         Parameters:
             - pipe - object with available pipes
         """
+        from p4c_src.resources import merge_deparser
+
         # Prepare path for output files
-        log_dir = os.path.join(self._output_directory,pipe["pipe_name"],"logs")
+        log_dir = os.path.join(self._output_directory,pipe.pipe_name,"logs")
         deparser_file = os.path.join(log_dir,"resources_deparser.json")
-        if "resources" in pipe.keys():
-            resources_file = pipe["resources"]
+        if pipe.resources is not None:
+            resources_file = pipe.resources
         else:
             # No resources generated, nothing to add
             return
@@ -823,157 +1132,815 @@ class BarefootBackend(BackendDriver):
             # Any of required files doesn't exist
             return
 
-        # So far so good, open both files and add the bf-asm file to the resources
-        # file under deparser node
-        resources_json = open(resources_file,"r+")
-        deparser_json = open(deparser_file,"r")
+        # So far so good, add the bf-asm file to the resources file under
+        # deparser node. The resources file is large, the node is spliced in.
+        merge_deparser(resources_file, deparser_file, compact = self._compact_json)
+
+    def addAssemblerTime(self, start_t, end_t):
+        """
+        Account for an assembler run in compilation_time.
+        Assemblers may run concurrently, so we add the length of the union of the
+        intervals in which they ran.
+        """
+        with self._manifest_lock:
+            self._asm_intervals.append((start_t, end_t))
+            asm_time = 0.0
+            last_end = None
+            for start, end in sorted(self._asm_intervals):
+                if last_end is None or start > last_end:
+                    asm_time += end - start
+                    last_end = end
+                elif end > last_end:
+                    asm_time += end - last_end
+                    last_end = end
+            self.compilation_time = self._compile_time + asm_time
+
+    def compileFailed(self):
+        """
+        Invocation or program error, the compilation can not continue.
+        Error codes defined in p4c-barefoot.cpp:main
+        """
+        if self._compiler_rc is None:
+            return True   # the compiler did not run
+        return self._compiler_rc > 1 or self._compiler_rc < 0
+
+    def shardPipes(self):
+        """
+        Return the pipes to compile in parallel for --shard-pipes
+        """
+        if self._shard_pipes is None:
+            return []
+        from p4c_src.shard import overlapping_pipes, previous_pipes
+        pipes = self._shard_pipes
+        if not pipes:
+            pipes = previous_pipes(self._publish_dir)
+        # the compiler skips the pipes whose name contains a skipped name
+        pipes = [p for p in pipes if not any(s and s in p for s in self.skip_compilation)]
+        overlapping = overlapping_pipes(pipes, self.skip_compilation)
+        if overlapping:
+            print("--shard-pipes: the names of pipes {} contain the name of another pipe, "
+                  "compiling all the pipes at once".format(', '.join(overlapping)),
+                  file=sys.stderr)
+            return []
+        return pipes
+
+    def runShardedCompiler(self, pipes):
+        """
+        Run a compiler per pipe concurrently, and merge their outputs
+        """
+        import concurrent.futures
+        from p4c_src.shard import shard_command, merge_shards, remove_shards
+        self.preRun('compiler')
+        cmd = self._commands['compiler']
+        if cmd[0].find('/') != 0 and (find_bin(cmd[0]) == None):
+            raise DriverError("{}: command not found".format(cmd[0]))
+
+        step = current_step()
+        def compilePipe(i):
+            set_current_step(step)
+            pipe_cmd = shard_command(cmd, self._output_directory, pipes[i], pipes,
+                                     self.skip_compilation, i == 0)
+            return self.runCmd('compiler:{}'.format(pipes[i]), pipe_cmd)
+        remove_shards(self._output_directory)
+        # a dry run prints the commands in order
+        jobs = 1 if self._dry_run else len(pipes)
+        with concurrent.futures.ThreadPoolExecutor(max_workers = jobs) as pool:
+            rcs = [1 if rc is None else rc for rc in pool.map(compilePipe, range(len(pipes)))]
+        self.postRun('compiler')
+
+        # an invocation error of any shard fails the compilation, otherwise
+        # the outputs of program errors (1) are processed as usual
+        failed = [rc for rc in rcs if rc > 1 or rc < 0]
+        rc = failed[0] if failed else max(rcs)
+        if not self._dry_run:
+            if not merge_shards(self._output_directory, pipes, self._compact_json) and rc == 0:
+                rc = 1
+            remove_shards(self._output_directory)
+        return rc
+
+    def runRacingCompiler(self, strategies):
+        """
+        Run a compiler per strategy concurrently, and keep the outputs of the
+        first that succeeds
+        """
+        import shutil
+        from p4c_src.race import Contender, Race, race_command, race_dir, keep_outputs, remove_race
+        self.preRun('compiler')
+        cmd = self._commands['compiler']
+        if cmd[0].find('/') != 0 and (find_bin(cmd[0]) == None):
+            raise DriverError("{}: command not found".format(cmd[0]))
+
+        contenders = []
+        for strategy in strategies:
+            race_cmd, files = race_command(cmd, self._output_directory, strategy)
+            if self._dry_run:
+                self.runCmd('compiler:{}'.format(strategy), race_cmd)
+                continue
+            log = os.path.join(race_dir(self._output_directory, strategy), strategy + '.log')
+            contenders.append(Contender(strategy, race_cmd, files, log))
+        if self._dry_run:
+            self.postRun('compiler')
+            return 0
+
+        remove_race(self._output_directory)
+        history, key = self.durationHistory()
+        race = Race(contenders, self._output_directory, self._verbose, history.elapsed(key))
+        try:
+            rc = race.run()
+        finally:
+            self.postRun('compiler')
+        default = race.completed_default()
+        if default is not None:
+            self.recordDefaultDuration(history, key, default.elapsed)
+        reported = race.report()
+        sys.stdout.flush()
+        with open(reported.log, 'rb') as log:
+            shutil.copyfileobj(log, sys.stdout.buffer)
+        sys.stdout.flush()
+        keep_outputs(self._output_directory, reported)
+        remove_race(self._output_directory)
+
+        self._race_summary = race.summary()
+        if self._verbose and 'time_saved' in self._race_summary:
+            print("race: {} won, {:.2f}s saved compared to default ({:.2f}s)".format(
+                self._race_summary['winner'], self._race_summary['time_saved'],
+                self._race_summary['default_elapsed']))
+        return 1 if rc is None else rc
+
+    def durationHistory(self):
+        """
+        Return the history of the time the default strategy takes to
+        compile, and the key of this program in it
+        """
+        from p4c_src.race import DurationHistory, default_history_file
+        history = DurationHistory(default_history_file())
+        return history, history.key(self._source_filename, self._target, self._arch)
+
+    def recordDefaultDuration(self, history, key, elapsed):
+        """
+        Record the time the default strategy took to compile; the history
+        is kept in the cache directory, so only when the cache is used
+        """
+        if self._cache is not None:
+            history.record(key, elapsed)
+
+    def admitCompiler(self, processes):
+        """
+        Wait until there is enough memory to run processes compilers.
+        Returns the admission to release, the memory history and the key
+        under which this compilation is recorded.
+        """
+        from p4c_src.admission import AdmissionControl, MemoryHistory, \
+            default_admission_dir, default_compile_memory, default_history_file
+        history = MemoryHistory(default_history_file())
+        key = history.key(self._source_filename, self._target, self._arch)
+        peak = history.peak(key) or default_compile_memory()
+        admission = AdmissionControl(default_admission_dir(), peak * processes, self._verbose)
+        waited = admission.acquire()
+        if self._verbose:
+            print("admitted with {} MB reserved after {:.2f}s".format(
+                peak * processes // (1024 * 1024), waited))
+        # the time spent waiting is not compilation time
+        self._start_t += waited
+        return admission, history, key
+
+    def runCompilerStep(self):
+        if 'compiler' in self._resume_skip:
+            return self.resumeCompiler()
+        pipes = self.shardPipes()
+        admission = None
+        if self._memory_admission:
+            processes = len(self._race) if self._race else max(1, len(pipes))
+            admission, history, key = self.admitCompiler(processes)
+        try:
+            if self._race:
+                rc = self.runRacingCompiler(self._race)
+            elif len(pipes) > 1:
+                rc = self.runShardedCompiler(pipes)
+            else:
+                start = time.time()
+                rc = self.runCommandStep('compiler')
+                if rc == 0 and not self._dry_run:
+                    self.recordDefaultDuration(*self.durationHistory(), time.time() - start)
+        finally:
+            if admission is not None:
+                admission.release()
+        if admission is not None and rc is not None and 0 <= rc <= 1:
+            from p4c_src.admission import children_peak_rss
+            step = current_step()
+            history.record(key, step.peak_rss if step is not None and step.peak_rss
+                                else children_peak_rss())
+        self._compiler_rc = 1 if rc is None else rc
+        self._compile_time = time.time() - self._start_t
+        self.compilation_time = self._compile_time
+        if self._checkpoint is not None and self._compiler_rc == 0:
+            self.checkpointCompiler()
+        # on a program error (1) the outputs are still processed
+        return self._compiler_rc if self.compileFailed() else 0
+
+    def startCheckpoint(self, key):
+        """
+        Start checkpointing the compilation with the given key, and decide
+        which stages to skip if it resumes a previous one
+        """
+        from p4c_src.checkpoint import Checkpoint, ResumeError, STAGES
+        self._checkpoint = Checkpoint(self._output_directory, key)
+        skip = []
+        if self._resume_from is not None:
+            stages = [s for s in STAGES if s in self._commandsEnabled]
+            try:
+                skip = self._checkpoint.plan(stages, self._resume_from)
+            except ResumeError as e:
+                raise DriverError("--resume-from: {}".format(e))
+            if skip:
+                print("bf-p4c: resuming the compilation, skipping {}".format(', '.join(skip)),
+                      file=sys.stderr)
+            elif self._verbose:
+                print("bf-p4c: no stage to resume, compiling from the start", file=sys.stderr)
+            if self._resume_from == 'assembler':
+                # assemble all the pipes again
+                self._incremental_assembly = False
+        self._resume_skip = set(skip)
+        try:
+            self._checkpoint.begin(skip)
+        except OSError:
+            self._checkpoint = None
+
+    def checkpointCompiler(self):
+        """
+        Record that the compiler completed, keeping its manifest as the driver updates it
+        """
+        from p4c_src.checkpoint import assembly_files, checkpoint_dir
+        manifest = os.path.join(self._output_directory, 'manifest.json')
+        try:
+            self._checkpoint.save_file(manifest)
+        except OSError:
+            return
+        files = assembly_files(self._output_directory)
+        files.append(os.path.join(checkpoint_dir(self._output_directory), 'manifest.json'))
+        if self._bf_rt_schema is not None:
+            files.append(self._bf_rt_schema)
+        self._checkpoint.record('compiler', files, compile_time = self._compile_time)
+
+    def resumeCompiler(self):
+        """
+        Skip the compiler, restoring the manifest it wrote in the previous compilation
+        """
+        self._checkpoint.restore_file(os.path.join(self._output_directory, 'manifest.json'))
+        # the preprocessed source is not needed
+        self.postRun('compiler')
+        self._compiler_rc = 0
+        self._compile_time = self._checkpoint.data('compiler').get('compile_time', 0.0)
+        self.compilation_time = self._compile_time
+        return 0
+
+    def runCheckpointedStep(self, stage, action):
+        """
+        Run action, unless the compilation resumes after stage, and record
+        that stage completed
+        """
+        if stage in self._resume_skip:
+            return 0
+        rc = action()
+        if rc == 0 and self._checkpoint is not None:
+            self._checkpoint.record(stage)
+        return rc
+
+    def runPipeAssembler(self, pipe, unique_table_offset, run_verifier):
+        """
+        Run the assembler for one pipe, add the deparser resources and verify the
+        outputs. Returns the sum of the assembler and verifier return codes.
+        """
+        from p4c_src import incremental
+        stamp = None
+        key = None
+        if 'assembler' in self._resume_skip:
+            # the outputs of the previous compilation were checked by plan
+            stamp = self.resumedAssembly(pipe)
+        elif self._incremental_assembly:
+            stamp, key = self.previousAssembly(pipe.pipe_dir, unique_table_offset)
+        pipe_name = pipe.name
+        if stamp is not None:
+            if self._verbose:
+                print("bf-p4c: assembly of pipe {} unchanged, skipping the assembler".format(
+                    pipe_name), file=sys.stderr)
+            incremental.restore_deparser_resources(pipe.pipe_dir, stamp)
+            rc_bfa = 0
+        else:
+            start_t = time.time()
+            start_ns = time.time_ns()
+            if key is not None:
+                incremental.remove_stamp(pipe.pipe_dir)
+            rc_bfa = self.runAssembler(pipe.pipe_dir, unique_table_offset)
+            self.addAssemblerTime(start_t, time.time())
+        with self._manifest_lock:
+            self._asm_skipped[pipe_name] = stamp is not None
+
+        # We always need a  context.json -- TODO: need to make sure it is generated
+        pipeName = 'pipe' if self._dry_run else pipe.pipe_name
+        context = 'context.json' if self.language == 'p4-14' else \
+                   os.path.join(pipeName, 'context.json')
+        pipe.context = os.path.join(self._output_directory, context)
+        self.contexts[pipe.pipe_id] = context
+        # Although the context.json schema has an optional compile_command and
+        # we could add it here, it is a potential performance penalty to re-write
+        # a large context.json file. So we don't!
+
+        # Add resources from deparser
+        if self._dry_run:
+            print("Skipping aggregation of resources_deparser.json with resources.json, no file was generated")
+        elif self._defer_resources_merge:
+            pass   # merged by the consumers, see resources.load_resources
+        else:
+            self.aggregate_deparser_resources_json(pipe)
+
+        rc_ver = 0
+        if run_verifier and not (stamp is not None and stamp.get('verified')):
+            # A map of file key and verifier option
+            toBeVerified = {
+                'context'   : 'c',
+                'graph'     : 'd',
+                'resources' : 'r',
+                'phv_json'  : 'p',
+                'power_json': 'w',
+                'source'    : 's'
+                # add new option
+            }
+            cmd = self._commands['verifier'][:1]
+            for k in sorted(toBeVerified):
+                path = getattr(pipe, k)
+                if path and os.path.exists(path):
+                    cmd.append("-{} {}".format(toBeVerified[k], path))
+            rc_ver = self.checkAndRunCmd('verifier', cmd)
+        self._verifier_rc[pipe.pipe_id] = rc_ver
+        if stamp is None and key is not None and rc_bfa == 0 and rc_ver == 0:
+            incremental.write_stamp(pipe.pipe_dir, key, start_ns, run_verifier)
+
+        # TODO: the assembler failed: should we assemble the other pipes? Now we do.
+        return rc_bfa + rc_ver
+
+    def previousAssembly(self, dirname, unique_table_offset):
+        """
+        Return the stamp of the previous assembly of dirname if it can be
+        reused (None otherwise), and the key of the assembly (None if the
+        assembly file is missing)
+        """
+        from p4c_src import incremental
+        asm_file = self.assemblyFile(dirname)
+        if not os.path.isfile(asm_file):
+            return None, None
+        cmd = self.assemblerCommand(dirname, unique_table_offset) + [asm_file]
+        key = incremental.assembly_key(asm_file, cmd, self._commands['assembler'][0])
+        return incremental.load_stamp(dirname, key), key
+
+    def resumedAssembly(self, pipe):
+        """
+        Return the assembly of pipe in the compilation that is resumed, as
+        an incremental stamp
+        """
+        data = self._checkpoint.data('assembler')
+        return { 'deparser': data.get('deparser', {}).get(pipe.name),
+                 'verified': data.get('verified', False) }
+
+    def checkpointAssembler(self, run_verifier):
+        """
+        Record that all the pipes were assembled, with the outputs of the
+        assembler and the deparser resources, that the cleaner removes
+        """
+        from p4c_src import incremental
+        files = []
+        deparser = {}
+        for pipe in self._pipes:
+            if pipe.pipe_name in self.skip_compilation:
+                continue
+            files += [os.path.join(pipe.pipe_dir, f)
+                      for f in sorted(incremental.assembler_outputs(pipe.pipe_dir, 0))]
+            deparser[pipe.name] = incremental.load_deparser_resources(pipe.pipe_dir)
+        self._checkpoint.record('assembler', files, deparser = deparser,
+                                verified = run_verifier)
+
+    def runPipeSummaryLogging(self, pipe):
+        """
+        Run summary logging for one pipe, if its outputs were verified
+        """
+        if self._verifier_rc.get(pipe.pipe_id, 0) != 0:
+            return 0
+        if not pipe.context:  # context.json is required
+            return 0
+        if 'summary_logging' in self._resume_skip:
+            # the logs of the previous compilation are up to date
+            self.addSummaryLogs(pipe)
+            return 0
+        # update manifest to export compilation time before runSummaryLogging is executed
+        self.updateManifest(False)
+        rc = self.runSummaryLogging(pipe)
+        # when recovering from a failed compilation we may have failed
+        # generating some logs, ignore the return code
+        return 0 if self.compileFailed() else rc
+
+    def addPipeSteps(self, graph, run_assembler, run_verifier, run_summary_logs):
+        """
+        Parse the manifest and add the steps for each pipe to the graph.
+        The steps produce 'assembly' and 'logs', and the per pipe 'pipe:<name>'.
+        """
+        if self.compileFailed():
+            # Invocation or program error. Should try to recover as much as we can
+            if not run_summary_logs:
+                return 0
+            try:
+                self.parseManifest()
+            except (SystemExit, CompilationError):
+                return 1
+            for pipe in self._pipes:
+                graph.add(Step('summary_logging:{}'.format(pipe.name),
+                               lambda pipe=pipe: self.runPipeSummaryLogging(pipe),
+                               inputs = ['pipes'], outputs = ['logs'], always = True))
+            return 0
 
-        # Append the deparer node to the output
-        deparser_data = json.load(deparser_json)
-        resources_data = json.load(resources_json)
-        resources_data["resources"]["deparser"] = deparser_data
+        if not run_assembler:
+            return 0
 
-        # Dump the node to the output - don't forget to reset the file
-        resources_json.close()
-        resources_json = open(resources_file,"w")
-        json.dump(resources_data,resources_json,indent=2)
-        resources_json.close()
+        # we ran the compiler, now we need to parse the manifest and run the assembler
+        # for each P4-16 pipe
+        self.parseManifest()
+        # We need to make a copy of the list to get a copy of any additional parameters
+        # that were added on the command line (-Xassembler)
+        self._saved_assembler_params = list(self._commands['assembler'])
+        pipes = [p for p in self._pipes if p.pipe_name not in self.skip_compilation]
+        # table handle offsets are assigned in pipe order, independently of scheduling
+        for unique_table_offset, pipe in enumerate(pipes):
+            pipe_step = 'pipe:{}'.format(pipe.name)
+            graph.add(Step('assembler:{}'.format(pipe.name),
+                           lambda pipe=pipe, offset=unique_table_offset:
+                               self.runPipeAssembler(pipe, offset, run_verifier),
+                           inputs = ['pipes'], outputs = ['assembly', pipe_step]))
+            if run_summary_logs:
+                # summary logging runs even if the assembler failed
+                graph.add(Step('summary_logging:{}'.format(pipe.name),
+                               lambda pipe=pipe: self.runPipeSummaryLogging(pipe),
+                               inputs = [pipe_step], outputs = ['logs'], always = True))
+        return 0
 
     def run(self):
+        """
+        Run the compilation, and record how long each step took
+        """
+        self._run_start = time.time()
+        try:
+            rc = self.runSteps()
+        finally:
+            self.recordTimings()
+            if self._staging_dir is not None:
+                publish_rc = self.publishOutputs()
+        if self._staging_dir is not None:
+            rc += publish_rc
+            # the archiver reads the published outputs
+            if 'archiver' in self._commandsEnabled and publish_rc == 0 and \
+               self._manifest_rc == 0:
+                rc += self.runArchiver()
+        return rc
+
+    def cleanup(self):
+        BackendDriver.cleanup(self)
+        if self._staging_dir is not None:
+            from p4c_src.staging import remove
+            remove(self._staging_dir)
+
+    def publishedPath(self, path):
+        """
+        The path of an output once published to the output directory
+        """
+        if self._staging_dir is None:
+            return path
+        from p4c_src.staging import published_path
+        return published_path(path, self._staging_dir, self._publish_dir)
+
+    def publishOutputs(self):
+        """
+        Move the outputs from the staging directory to the output directory.
+        The outputs are then reported from the output directory.
+        """
+        from p4c_src.staging import publish
+        start_t = time.time()
+        try:
+            publish(self._staging_dir, self._publish_dir)
+        except OSError as e:
+            print("can not publish the outputs from {} to {}: {}".format(
+                self._staging_dir, self._publish_dir, e), file=sys.stderr)
+            return 1
+        finally:
+            if self._verbose:
+                print("published {} to {} in {:.3f}s".format(
+                    self._staging_dir, self._publish_dir, time.time() - start_t))
+        self._output_directory = self._publish_dir
+        self._bf_rt_schema = self.publishedPath(self._bf_rt_schema)
+        self._manifest = None
+        self._pipes = []
+        return 0
+
+    def timings(self):
+        """
+        Return the wall time, CPU time of the commands and their peak RSS
+        (bytes) for each step that ran, the total wall time, and what the
+        cleaner removed
+        """
+        steps = []
+        for s in self.stages():
+            if s.start is None or s.end is None:
+                continue
+            steps.append({ 'name': s.name,
+                           'start': s.start - self._run_start,
+                           'wall': s.end - s.start,
+                           'user': s.user,
+                           'sys': s.sys,
+                           'peak_rss': s.peak_rss,
+                           'returncode': s.rc })
+        timings = { 'total': time.time() - self._run_start, 'steps': steps }
+        if self._cleaned is not None:
+            timings['cleaner'] = self._cleaned
+        return timings
+
+    def recordTimings(self):
+        """
+        Add the timings to the manifest, and write the trace file
+        """
+        import json
+        manifest = self.manifest()
+        if not self._dry_run and os.path.isfile(manifest.path):
+            timings = self.timings()
+            with self._manifest_lock:
+                try:
+                    if not manifest.loaded:
+                        manifest.load()
+                    with manifest.edit() as jsonTree:
+                        jsonTree['timings'] = timings
+                    manifest.flush()
+                except (OSError, ValueError, TypeError):
+                    pass
+        if self._trace_file is not None:
+            from p4c_src.driver import chrome_trace
+            try:
+                with open(self._trace_file, 'w') as f:
+                    json.dump(chrome_trace(self.stages(), self._run_start), f)
+            except OSError as e:
+                print("can not write the trace file {}: {}".format(self._trace_file, e),
+                      file=sys.stderr)
+
+    def runSteps(self):
         """
         Override the parent run, in order to insert manifest parsing.
+
+        The compilation is executed as a StepGraph. Steps added by add_step can
+        consume or produce the following artifacts:
+          p4pp, manifest, bfrt       -- preprocessor and compiler outputs
+          bfrt-verified              -- the BF-RT schema was verified
+          pipes                      -- the manifest was parsed, pipe steps were added
+          assembly, pipe:<name>      -- assembler and verifier outputs, for all or one pipe
+          logs                       -- summary logging outputs
+          manifest-final             -- the manifest was updated with the compilation status
+          conf, manifest-verified    -- p4c-gen-conf and manifest verifier outputs
+          tree                       -- the output directory was cleaned up
         """
         run_assembler = 'assembler' in self._commandsEnabled
-        run_archiver = 'archiver' in self._commandsEnabled
+        # with staging, the archiver runs once the outputs are published
+        run_archiver = 'archiver' in self._commandsEnabled and self._staging_dir is None
         run_compiler = 'compiler' in self._commandsEnabled
         run_verifier = 'verifier' in self._commandsEnabled
+        run_bfrt_verifier = 'bf-rt-verifier' in self._commandsEnabled
         run_manifest_verifier = 'manifest-verifier' in self._commandsEnabled
         run_summary_logs = 'summary_logging' in self._commandsEnabled
         run_p4c_gen_conf = 'p4c-gen-conf' in self._commandsEnabled
         run_cleaner  = 'cleaner' in self._commandsEnabled
-
-        # run the preprocessor, compiler, and verifiers (manifest, context schema, and bf-rt)
-        self.disable_commands(['assembler', 'archiver', 'verifier',
-                               'summary_logging', 'p4c-gen-conf', 'cleaner'])
-
-        start_t = time.time()
-        rc = BackendDriver.run(self)
-        self.compilation_time = time.time() - start_t
-
-        # Error codes defined in p4c-barefoot.cpp:main
-        if rc is None: rc = 1
-        if rc > 1 or rc < 0:
-            # Invocation or program error. Should try to recover as much as we can
-            try:
-                self.parseManifest()
-                for pipe in self._pipes:
-                    if run_summary_logs and pipe.get('context', False):  # context.json is required
-                        # ignore the return code -- we may have failed generating some logs.
-                        # update manifest to export compilation time before runSummaryLogging is executed
-                        self.updateManifest(os.path.join(self._output_directory, 'manifest.json'), False)
-                        self.runSummaryLogging(pipe)
-                self.updateManifest(os.path.join(self._output_directory, 'manifest.json'), False)
-                if run_cleaner: self.runCleaner()
-                if run_archiver: self.checkAndRunCmd('archiver')
-            finally:
-                return rc
+        run_preprocessor = 'preprocessor' in self._commandsEnabled
+
+        # set output directory
+        if not os.path.exists(self._output_directory):
+            os.makedirs(self._output_directory)
+
+        graph = StepGraph(self._jobs)
+        self._graph = graph
+        self._manifest = None
+        self.cache_hit = False
+
+        # checkpoint the stages of the compilation, to be able to resume it,
+        # unless staging: the checkpoint refers to the outputs by path
+        early_exit = self._ir_to_json is not None or self.pragmas_help
+        checkpointing = run_compiler and not self._dry_run and not early_exit and \
+                        self._staging_dir is None
+
+        # preprocess first, the cache and the checkpoints are keyed on the
+        # preprocessed source (unless it was preprocessed for us, see fanout)
+        cache_key = None
+        self._checkpoint = None
+        self._resume_skip = set()
+        if self._cache is not None or checkpointing:
+            if run_preprocessor:
+                step = graph.add(Step('preprocessor',
+                                      lambda: self.checkAndRunCmd('preprocessor'),
+                                      outputs = ['p4pp']))
+                StepGraph._start(step)
+                StepGraph._finish(step, StepGraph._execute(step))
+                if step.rc != 0:
+                    return step.rc
+                run_preprocessor = False
+            key = self.cacheKey()
+            if self._cache is not None:
+                cache_key = key
+                if self._cache.lookup(cache_key, self._output_directory):
+                    self.cache_hit = True
+                    return self.runFromCache(cache_key, run_archiver)
+            if checkpointing:
+                self.startCheckpoint(key)
+
+        self._start_t = time.time()
+        self._compile_time = 0.0
+        self._compiler_rc = None if run_compiler else 0
+        self._manifest_rc = 0
+
+        # the preprocessor, compiler, and bf-rt verifier
+        if run_preprocessor:
+            graph.add(self.command_step('preprocessor', outputs = ['p4pp']))
+        if run_compiler:
+            graph.add(Step('compiler', self.runCompilerStep,
+                           inputs = ['p4pp'], outputs = ['manifest', 'bfrt']))
+        if run_bfrt_verifier:
+            graph.add(Step('bf-rt-verifier',
+                           lambda: self.runCheckpointedStep('bf-rt-verifier',
+                               lambda: self.runCommandStep('bf-rt-verifier')),
+                           inputs = ['bfrt'], outputs = ['bfrt-verified']))
 
         # ir_to_json exits early, serializing only the IR
         # print pragmas also needs to exit early, it's just like help
-        if self._ir_to_json is not None or self.pragmas_help:
-            return rc
+        if not early_exit:
+            self.addFinalSteps(graph, cache_key, run_assembler, run_verifier, run_summary_logs,
+                               run_p4c_gen_conf, run_manifest_verifier, run_cleaner,
+                               run_archiver)
+        for step in self._steps:
+            graph.add(step)
+
+        graph.run()
+
+        if self.compileFailed():
+            if self._compiler_rc is None:
+                # the preprocessor failed
+                return graph.rc() or 1
+            return self._compiler_rc
+        if early_exit:
+            return graph.rc() + self._compiler_rc
 
-        # we ran the compiler, now we need to parse the manifest and run the assembler
-        # for each P4-16 pipe
-        rc_bfa = 0  # accumulate assembler errors
-        if run_assembler:
-            self.parseManifest()
-            # We need to make a copy of the list to get a copy of any additional parameters
-            # that were added on the command line (-Xassembler)
-            self._saved_assembler_params = list(self._commands['assembler'])
-            unique_table_offset = 0
-            for pipe in self._pipes:
+        # Chech manifest only after all changes have been made to it
+        if self._manifest_rc != 0:
+            print("Manifest validation failed")
+            return self._manifest_rc
 
-                if 'pipe_name' in pipe and pipe['pipe_name'] in self.skip_compilation:
-                    continue
-
-                start_t = time.time()
-                rc_bfa += self.runAssembler(pipe['pipe_dir'], unique_table_offset)
-                self.compilation_time += (time.time() - start_t)
-                unique_table_offset += 1
-
-                # We always need a  context.json -- TODO: need to make sure it is generated
-                pipeName = 'pipe' if self._dry_run else pipe['pipe_name']
-                context = 'context.json' if self.language == 'p4-14' else \
-                           os.path.join(pipeName, 'context.json')
-                pipe['context'] = os.path.join(self._output_directory, context)
-                self.contexts[pipe['pipe_id']] = context
-                # Although the context.json schema has an optional compile_command and
-                # we could add it here, it is a potential performance penalty to re-write
-                # a large context.json file. So we don't!
-
-                # Add resources from deparser
+        # We've successfully reached this point, but the compilation may have failed
+        return graph.rc() + self._compiler_rc
+
+    def addFinalSteps(self, graph, cache_key, run_assembler, run_verifier, run_summary_logs,
+                      run_p4c_gen_conf, run_manifest_verifier, run_cleaner, run_archiver):
+        """
+        Add the steps that run after the compiler: the per pipe steps, manifest
+        update, conf generation, manifest verification, cleanup and archiving.
+        """
+        graph.add(Step('parse-manifest',
+                       lambda: self.addPipeSteps(graph, run_assembler, run_verifier,
+                                                 run_summary_logs),
+                       inputs = ['manifest'], outputs = ['pipes'], always = True))
+
+        def updateManifestStep():
+            success = not self.compileFailed() and self._compiler_rc == 0 and graph.rc() == 0
+            self.updateManifest(success)
+            if self._checkpoint is not None and not self.compileFailed():
+                # the per pipe stages complete when all their pipes did
+                for stage in ('assembler', 'summary_logging'):
+                    steps = [s for s in graph.steps() if s.name.startswith(stage + ':')]
+                    if not steps or not all(s.state == 'done' and s.rc == 0 for s in steps):
+                        continue
+                    if stage == 'assembler':
+                        self.checkpointAssembler(run_verifier)
+                    else:
+                        self._checkpoint.record(stage)
+            return 0
+        graph.add(Step('update-manifest', updateManifestStep,
+                       inputs = ['manifest', 'pipes', 'assembly', 'logs', 'bfrt-verified'],
+                       outputs = ['manifest-final'], always = True))
+
+        if run_p4c_gen_conf:
+            def genConfStep():
+                if self._compiler_rc != 0:
+                    return 0   # only generated for successful compilations
                 if self._dry_run:
-                    print("Skipping aggregation of resources_deparser.json with resources.json, no file was generated")
+                    pipeNames = ['pipe']
                 else:
-                    self.aggregate_deparser_resources_json(pipe)
-
-                rc_ver = 0
-                if run_verifier:
-                    # A map of file key and verifier option
-                    toBeVerified = {
-                        'context'   : 'c',
-                        'graph'     : 'd',
-                        'resources' : 'r',
-                        'phv_json'  : 'p',
-                        'power_json': 'w',
-                        'source'    : 's'
-                        # add new option
-                    }
-                    # Clear verifier options
-                    del self._commands['verifier'] [1:]
-                    for k in sorted(toBeVerified):
-                        if pipe.get(k, False) and os.path.exists(pipe[k]):
-                            self.add_command_option('verifier',
-                                                    "-{} {}".format(toBeVerified[k], pipe[k]))
-                    rc_ver = self.checkAndRunCmd('verifier')
-
-                if run_summary_logs and rc_ver == 0:
-                    if pipe.get('context', False):  # context.json is required
-                        # update manifest to export compilation time before runSummaryLogging is executed
-                        self.updateManifest(os.path.join(self._output_directory, 'manifest.json'), False)
-                        rc += self.runSummaryLogging(pipe)
-
-                rc += rc_ver
-
-                # TODO: the assembler failed: should we assemble the other pipes? Now we do.
-
-        success = (rc + rc_bfa) == 0
-        self.updateManifest(os.path.join(self._output_directory, 'manifest.json'), success)
-        if success and run_p4c_gen_conf:
-            if self._dry_run:
-                pipeNames = ['pipe']
-            else:
-                pipeNames = [ p['pipe_name'] for p in self._pipes ]
-            self.add_command_option('p4c-gen-conf', '--pipe {}'.format(' '.join(pipeNames)))
-            rc += self.checkAndRunCmd('p4c-gen-conf')
+                    pipeNames = [ p.pipe_name for p in self._pipes ]
+                cmd = self._commands['p4c-gen-conf'] + ['--pipe {}'.format(' '.join(pipeNames))]
+                return self.checkAndRunCmd('p4c-gen-conf', cmd)
+            # does not wait for summary logging
+            graph.add(Step('p4c-gen-conf',
+                           lambda: self.runCheckpointedStep('p4c-gen-conf', genConfStep),
+                           inputs = ['manifest', 'pipes', 'assembly', 'bfrt-verified'],
+                           outputs = ['conf']))
 
-        # Chech manifest only after all changes have been made to it
-        rmc = 0
         if run_manifest_verifier:
-            rmc = self.checkAndRunCmd('manifest-verifier')
-
-        if rmc != 0:
-            print("Manifest validation failed")
-            return rmc
-
-        # Cleanup temp files
-        if run_cleaner: self.runCleaner()
+            def manifestVerifierStep():
+                if self.compileFailed():
+                    return 0
+                self._manifest_rc = self.checkAndRunCmd('manifest-verifier')
+                return self._manifest_rc
+            graph.add(Step('manifest-verifier', manifestVerifierStep,
+                           inputs = ['manifest-final', 'conf'],
+                           outputs = ['manifest-verified'], always = True))
+
+        after_manifest = ['manifest-final', 'conf', 'manifest-verified']
+        if run_cleaner:
+            def cleanerStep():
+                if self._manifest_rc == 0:
+                    # Cleanup temp files, ignoring failures
+                    self.runCleaner()
+                return 0
+            graph.add(Step('cleaner', cleanerStep,
+                           inputs = after_manifest, outputs = ['tree'], always = True))
+
+        if self._checkpoint is not None:
+            def checkpointStep():
+                # there is nothing to resume once the compilation succeeded
+                if not self.compileFailed() and self._compiler_rc == 0 and \
+                   graph.rc() == 0 and self._manifest_rc == 0:
+                    self._checkpoint.remove()
+                return 0
+            graph.add(Step('checkpoint', checkpointStep,
+                           inputs = after_manifest, outputs = ['tree'], always = True))
+
+        if cache_key is not None:
+            def cacheStep():
+                # only successful compilations are cached
+                if not self.compileFailed() and self._compiler_rc == 0 and graph.rc() == 0:
+                    self._cache.store(cache_key, self._output_directory,
+                                      { 'program' : self.program_name, 'target' : self._target,
+                                        'arch' : self._arch })
+                if self._cache_stats:
+                    print(self._cache.format_stats())
+                return 0
+            graph.add(Step('cache', cacheStep,
+                           inputs = after_manifest + ['tree'], outputs = ['cached'],
+                           always = True))
 
         # run the archiver if one has been set, regardless whether the
-        # execution was successful or not
+        # execution was successful or not. It reads the tree the cleaner modifies.
         if run_archiver:
-            rc += self.checkAndRunCmd('archiver')
+            def archiverStep():
+                if self._manifest_rc != 0:
+                    return 0
+                return self.runArchiver()
+            graph.add(Step('archiver', archiverStep,
+                           inputs = after_manifest + ['tree', 'cached'], always = True))
+
+    def artifacts(self):
+        """
+        Return the paths of the artifacts of the last run that exist, by name:
+        manifest, bfrt and conf, and for each pipe <pipe_name>/context,
+        <pipe_name>/resources, <pipe_name>/graph, <pipe_name>/phv_json,
+        <pipe_name>/power_json and <pipe_name>/<binary>.bin
+        """
+        artifacts = {}
+        def add(name, path):
+            if path is not None and os.path.isfile(path):
+                artifacts[name] = path
+
+        add('manifest', os.path.join(self._output_directory, 'manifest.json'))
+        add('bfrt', self._bf_rt_schema)
+        if self.conf_file is not None:
+            add('conf', os.path.join(self._output_directory, self.conf_file))
+        if self._dry_run:
+            return artifacts
 
-        # We've successfully reached this point, but the compilation may have failed
-        return rc + rc_bfa
+        if not self._pipes and 'manifest' in artifacts:
+            # the outputs were restored from the cache, or the run stopped early
+            self.parseManifest()
+        for pipe in self._pipes:
+            name = pipe.name
+            for kind in ('context', 'resources', 'graph', 'phv_json', 'power_json'):
+                add('{}/{}'.format(name, kind), getattr(pipe, kind))
+            pipe_dir = pipe.pipe_dir
+            if pipe_dir is not None and os.path.isdir(pipe_dir):
+                for f in sorted(os.listdir(pipe_dir)):
+                    if f.endswith('.bin'):
+                        add('{}/{}'.format(name, f), os.path.join(pipe_dir, f))
+        return artifacts
+
+    def runFromCache(self, cache_key, run_archiver):
+        """
+        The output directory was restored from the cache: finish the compilation
+        without running the compiler and the assembler.
+        """
+        if self._verbose:
+            print("cache hit {}".format(cache_key))
+        # remove the preprocessed file as the compiler would have done
+        self.postRun('compiler')
+        self.updateManifest(True)
+        if self._cache_stats:
+            print(self._cache.format_stats())
+        rc = 0
+        if run_archiver:
+            rc += self.runArchiver()
+        return rc
@@ -0,0 +1,281 @@
+# Copyright 2013-2021 Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials,
+# and your use of them is governed by the express license under which they
+# were provided to you ("License"). Unless the License provides otherwise,
+# you may not use, modify, copy, publish, distribute, disclose or transmit this
+# software or the related documents without Intel's prior written permission.
+#
+# This software and the related documents are provided as is, with no
+# express or implied warranties, other than those that are expressly stated
+# in the License.
+
+"""
+Batch compilation: 'bf-p4c --batch jobs.json' compiles many programs in one
+invocation.
+
+jobs.json holds a list of jobs (or an object with a "jobs" list). A job is
+either an object
+
+    { "source": "prog.p4", "target": "tofino2", "arch": "t2na",
+      "flags": ["-g"], "output": "out/prog.tofino2", "name": "prog-t2" }
+
+where only source is required, or a [source, target, arch, flags] list.
+flags may also be a single string, split like a shell would. Relative sources
+are relative to the directory of jobs.json, relative outputs to the current
+directory. The output defaults to <program>.<target>, or
+<program>.<target>-<arch> when an architecture is given.
+
+Each job runs in a child forked from this process, with its output written to
+<output>.log. At most --batch-jobs jobs run at once. Jobs that took the
+longest in previous batches start first, and a job is only started if the
+peak memory it used before fits, along with that of the running jobs, in the
+memory that was available when the batch started. The wall time and peak
+memory of each job are recorded for the next batch.
+
+By default the batch stops at the first failure, terminating the jobs that
+are running; with --keep-going all jobs run. A summary of the return code,
+wall time, CPU time and peak RSS of each job is printed at the end.
+"""
+
+import json
+import os
+import shlex
+import signal
+import sys
+import time
+
+_HISTORY_FILE = 'batch-history.json'
+
+class BatchJob(object):
+    def __init__(self, name, source, target, arch, flags, output):
+        self.name = name
+        self.source = source
+        self.target = target
+        self.arch = arch
+        self.flags = flags
+        self.output = output
+        self.log = output + '.log'
+        self.state = 'pending'   # pending, running, done, killed, not run
+        self.pid = None
+        self.returncode = None
+        self.start = None
+        self.wall = None
+        self.cpu = None
+        self.maxrss = None       # bytes
+
+    def argv(self):
+        args = list(self.flags)
+        if self.target is not None:
+            args += ['--target', self.target]
+        if self.arch is not None:
+            args += ['--arch', self.arch]
+        return args + ['-o', self.output, self.source]
+
+    def history_key(self):
+        return json.dumps([os.path.abspath(self.source), self.target, self.arch, self.flags])
+
+def load_jobs(jobs_file):
+    """
+    Read the jobs from jobs_file. Raises ValueError if they are malformed.
+    """
+    with open(jobs_file) as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        data = data.get('jobs')
+    if not isinstance(data, list):
+        raise ValueError("expected a list of jobs")
+
+    base_dir = os.path.dirname(os.path.abspath(jobs_file))
+    jobs = []
+    names = set()
+    for entry in data:
+        if isinstance(entry, list):
+            entry = dict(zip(['source', 'target', 'arch', 'flags'], entry))
+        if not isinstance(entry, dict) or 'source' not in entry:
+            raise ValueError("job without a source: {}".format(entry))
+        source = os.path.join(base_dir, entry['source'])
+        target = entry.get('target')
+        arch = entry.get('arch')
+        flags = entry.get('flags') or []
+        if isinstance(flags, str):
+            flags = shlex.split(flags)
+        program = os.path.splitext(os.path.basename(source))[0]
+        default_name = '{}.{}'.format(program, target or 'tofino')
+        if arch is not None:
+            default_name += '-' + arch
+        name = entry.get('name', default_name)
+        if name in names:
+            raise ValueError("duplicate job {}, give it a name or an output".format(name))
+        names.add(name)
+        output = entry.get('output', default_name)
+        jobs.append(BatchJob(name, source, target, arch, [str(f) for f in flags], output))
+    return jobs
+
+def mem_available():
+    """
+    Return MemAvailable from /proc/meminfo, in bytes, or None
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+class BatchScheduler(object):
+    def __init__(self, jobs, max_jobs, keep_going = False, history_file = None,
+                 verbose = False):
+        self.jobs = jobs
+        self.max_jobs = max(1, max_jobs)
+        self.keep_going = keep_going
+        self.history_file = history_file
+        self.verbose = verbose
+        self.history = self._load_history()
+        self.memory_budget = mem_available()
+        self._running = {}
+
+    def _load_history(self):
+        if self.history_file is None:
+            return {}
+        try:
+            with open(self.history_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_history(self):
+        if self.history_file is None:
+            return
+        for job in self.jobs:
+            if job.state == 'done' and job.returncode == 0:
+                self.history[job.history_key()] = { 'wall': job.wall, 'maxrss': job.maxrss }
+        try:
+            os.makedirs(os.path.dirname(self.history_file), exist_ok=True)
+            with open(self.history_file + '.tmp', 'w') as f:
+                json.dump(self.history, f, indent=2, sort_keys=True)
+            os.replace(self.history_file + '.tmp', self.history_file)
+        except OSError as e:
+            if self.verbose:
+                print("batch: can not save history: {}".format(e), file=sys.stderr)
+
+    def _expected(self, job, what):
+        return self.history.get(job.history_key(), {}).get(what) or 0
+
+    def _fits(self, job):
+        """
+        Check that the peak memory job used before fits with the running jobs
+        """
+        if self.memory_budget is None or not self._running:
+            return True
+        reserved = sum(self._expected(j, 'maxrss') for j in self._running.values())
+        return reserved + self._expected(job, 'maxrss') <= self.memory_budget
+
+    def _start(self, job):
+        out_dir = os.path.dirname(job.log)
+        if out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+        fd = os.open(job.log, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            from p4c_src.server import fork_driver
+            job.pid = fork_driver(job.argv(), fd, fd, new_group = True)
+        finally:
+            os.close(fd)
+        job.state = 'running'
+        job.start = time.time()
+        self._running[job.pid] = job
+        if self.verbose:
+            print("batch: started {}: bf-p4c {}".format(job.name, ' '.join(job.argv())))
+
+    def _reap(self):
+        pid, status, usage = os.wait4(-1, 0)
+        job = self._running.pop(pid, None)
+        if job is None:
+            return None
+        job.wall = time.time() - job.start
+        job.cpu = usage.ru_utime + usage.ru_stime
+        job.maxrss = usage.ru_maxrss * 1024
+        rc = os.waitstatus_to_exitcode(status)
+        job.returncode = 128 - rc if rc < 0 else rc
+        if job.state == 'running':
+            job.state = 'done'
+        return job
+
+    def _terminate(self):
+        for job in self._running.values():
+            job.state = 'killed'
+            try:
+                os.killpg(job.pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def run(self):
+        """
+        Run the jobs. Returns 0 if all of them succeeded, 1 otherwise.
+        """
+        # longest jobs first, jobs we know nothing about after them in order
+        pending = sorted(self.jobs, key = lambda j: -self._expected(j, 'wall'))
+        stopping = False
+        try:
+            while pending or self._running:
+                while not stopping and pending and len(self._running) < self.max_jobs:
+                    job = next((j for j in pending if self._fits(j)), None)
+                    if job is None:
+                        break
+                    pending.remove(job)
+                    self._start(job)
+                job = self._reap()
+                if job is None:
+                    continue
+                if job.returncode != 0 and job.state == 'done':
+                    print("batch: {} failed with exit code {}, see {}".format(
+                        job.name, job.returncode, job.log), file=sys.stderr)
+                    if not self.keep_going and not stopping:
+                        stopping = True
+                        self._terminate()
+                if stopping:
+                    for j in pending:
+                        j.state = 'not run'
+                    pending = []
+        except KeyboardInterrupt:
+            self._terminate()
+            while self._running:
+                self._reap()
+            raise
+        finally:
+            self._save_history()
+
+        print(self.summary())
+        return 0 if all(j.state == 'done' and j.returncode == 0 for j in self.jobs) else 1
+
+    def summary(self):
+        def fmt(value, scale = 1.0):
+            return '-' if value is None else '{:.2f}'.format(value / scale)
+
+        width = max([len('job')] + [len(j.name) for j in self.jobs])
+        lines = ['{:<{w}}  {:>8}  {:>9}  {:>9}  {:>13}'.format(
+            'job', 'rc', 'wall (s)', 'cpu (s)', 'peak RSS (MB)', w = width)]
+        for j in self.jobs:
+            rc = j.state if j.state in ('not run', 'killed') else str(j.returncode)
+            lines.append('{:<{w}}  {:>8}  {:>9}  {:>9}  {:>13}'.format(
+                j.name, rc, fmt(j.wall), fmt(j.cpu), fmt(j.maxrss, 1024.0 * 1024.0), w = width))
+        failed = sum(1 for j in self.jobs if j.state != 'done' or j.returncode != 0)
+        lines.append('{} jobs, {} failed'.format(len(self.jobs), failed))
+        return '\n'.join(lines)
+
+def run_batch(jobs_file, max_jobs, keep_going = False, verbose = False):
+    """
+    Compile the jobs in jobs_file. Returns the exit code.
+    """
+    try:
+        jobs = load_jobs(jobs_file)
+    except (OSError, ValueError) as e:
+        print("bf-p4c: can not load jobs from {}: {}".format(jobs_file, e), file=sys.stderr)
+        return 1
+
+    from p4c_src.cache import default_cache_dir
+    history_file = os.path.join(default_cache_dir(), _HISTORY_FILE)
+    scheduler = BatchScheduler(jobs, max_jobs, keep_going, history_file, verbose)
+    return scheduler.run()
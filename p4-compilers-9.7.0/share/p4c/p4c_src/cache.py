@@ -0,0 +1,223 @@
+# Copyright 2013-2021 Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials,
+# and your use of them is governed by the express license under which they
+# were provided to you ("License"). Unless the License provides otherwise,
+# you may not use, modify, copy, publish, distribute, disclose or transmit this
+# software or the related documents without Intel's prior written permission.
+#
+# This software and the related documents are provided as is, with no
+# express or implied warranties, other than those that are expressly stated
+# in the License.
+
+"""
+Content addressed cache of compiler output directories.
+
+Each entry is stored under <cache_dir>/<key[:2]>/<key> and holds a copy of
+the complete output directory of a successful compilation, together with a
+small meta.json file. The modification time of meta.json is used as the
+last access time for LRU eviction.
+"""
+
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+DEFAULT_CACHE_SIZE_MB = 5 * 1024
+
+def default_cache_dir():
+    """
+    Return the cache directory: $P4C_CACHE_DIR, or bf-p4c under the XDG cache dir
+    """
+    cache_dir = os.environ.get('P4C_CACHE_DIR')
+    if cache_dir:
+        return cache_dir
+    xdg_cache = os.environ.get('XDG_CACHE_HOME',
+                               os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(xdg_cache, 'bf-p4c')
+
+def default_cache_size():
+    """
+    Return the maximum cache size in MB: $P4C_CACHE_SIZE, or DEFAULT_CACHE_SIZE_MB
+    """
+    try:
+        return int(os.environ.get('P4C_CACHE_SIZE', DEFAULT_CACHE_SIZE_MB))
+    except ValueError:
+        return DEFAULT_CACHE_SIZE_MB
+
+def _tree_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                size += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return size
+
+class CacheKey(object):
+    """
+    Incrementally computed key of a compilation
+    """
+    def __init__(self):
+        self._hash = hashlib.sha256()
+
+    def add_string(self, tag, value):
+        data = str(value).encode('utf-8')
+        self._hash.update('{}:{}:'.format(tag, len(data)).encode('utf-8'))
+        self._hash.update(data)
+
+    def add_file(self, tag, filename):
+        self.add_string(tag, os.path.getsize(filename))
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                self._hash.update(chunk)
+
+    def add_tool(self, tag, path):
+        """
+        Tools are identified by path, size and modification time
+        """
+        try:
+            st = os.stat(path)
+            self.add_string(tag, '{}:{}:{}'.format(path, st.st_size, st.st_mtime_ns))
+        except OSError:
+            self.add_string(tag, path)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+class CompileCache(object):
+    """
+    Size bounded LRU cache of output directories
+    """
+    def __init__(self, cache_dir, max_size_mb, verbose = False):
+        self.cache_dir = cache_dir
+        self.max_size = max_size_mb * 1024 * 1024
+        self.verbose = verbose
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _update_stats(self, **deltas):
+        """
+        Add deltas to the statistics file, under an exclusive lock
+        """
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(os.path.join(self.cache_dir, 'stats.lock'), 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                stats = self.stats()
+                for k, v in deltas.items():
+                    stats[k] = stats.get(k, 0) + v
+                stats_file = os.path.join(self.cache_dir, 'stats.json')
+                with open(stats_file + '.tmp', 'w') as f:
+                    json.dump(stats, f, indent=2, sort_keys=True)
+                os.replace(stats_file + '.tmp', stats_file)
+        except OSError as e:
+            if self.verbose:
+                print("cache: can not update statistics: {}".format(e), file=sys.stderr)
+
+    def stats(self):
+        try:
+            with open(os.path.join(self.cache_dir, 'stats.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def format_stats(self):
+        stats = self.stats()
+        hits = stats.get('hits', 0)
+        misses = stats.get('misses', 0)
+        total = hits + misses
+        ratio = 100.0 * hits / total if total else 0.0
+        return "cache {}: {} hits, {} misses ({:.1f}% hit rate), {} stores, {} evictions".format(
+            self.cache_dir, hits, misses, ratio,
+            stats.get('stores', 0), stats.get('evictions', 0))
+
+    def lookup(self, key, output_dir):
+        """
+        Restore the output directory for key. Returns True on a hit.
+        """
+        entry = self._entry_dir(key)
+        meta = os.path.join(entry, 'meta.json')
+        if not os.path.isfile(meta):
+            self._update_stats(misses=1)
+            return False
+        try:
+            shutil.copytree(os.path.join(entry, 'output'), output_dir,
+                            symlinks=True, dirs_exist_ok=True)
+            # touch the entry, so it becomes the most recently used
+            os.utime(meta, None)
+        except (OSError, shutil.Error) as e:
+            if self.verbose:
+                print("cache: failed to restore {}: {}".format(key, e), file=sys.stderr)
+            self._update_stats(misses=1)
+            return False
+        self._update_stats(hits=1)
+        return True
+
+    def store(self, key, output_dir, meta):
+        """
+        Copy output_dir into the cache under key and evict old entries
+        """
+        entry = self._entry_dir(key)
+        if os.path.isdir(entry):
+            return
+        tmp_dir = None
+        try:
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=os.path.dirname(entry))
+            shutil.copytree(output_dir, os.path.join(tmp_dir, 'output'), symlinks=True)
+            meta = dict(meta)
+            meta['size'] = _tree_size(tmp_dir)
+            meta['created'] = time.time()
+            with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+                json.dump(meta, f, indent=2, sort_keys=True)
+            os.rename(tmp_dir, entry)
+            tmp_dir = None
+        except OSError as e:
+            # someone else stored the same entry in the meantime
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY) and self.verbose:
+                print("cache: failed to store {}: {}".format(key, e), file=sys.stderr)
+            return
+        finally:
+            if tmp_dir is not None:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        self._update_stats(stores=1)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in max_size
+        """
+        entries = []
+        total = 0
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+            if len(prefix) != 2 or not os.path.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                meta = os.path.join(prefix_dir, key, 'meta.json')
+                try:
+                    with open(meta) as f:
+                        size = json.load(f).get('size', 0)
+                    entries.append((os.path.getmtime(meta), size, os.path.join(prefix_dir, key)))
+                    total += size
+                except (OSError, ValueError):
+                    continue
+
+        evicted = 0
+        for atime, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            evicted += 1
+        if evicted:
+            self._update_stats(evictions=evicted)
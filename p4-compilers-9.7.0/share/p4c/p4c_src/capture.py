@@ -0,0 +1,125 @@
+# Copyright 2013-2021 Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials,
+# and your use of them is governed by the express license under which they
+# were provided to you ("License"). Unless the License provides otherwise,
+# you may not use, modify, copy, publish, distribute, disclose or transmit this
+# software or the related documents without Intel's prior written permission.
+#
+# This software and the related documents are provided as is, with no
+# express or implied warranties, other than those that are expressly stated
+# in the License.
+
+"""
+Capture of the output of the commands (--step-logs).
+
+The standard output and error of a command are read from non-blocking
+pipes as the command writes them, copied to the terminal, and written to
+the log of its step, <dir>/<step>.log. The commands of a step, which may
+run concurrently (the assembler of each pipe), share one log, kept open
+until the compilation ends. A log keeps at most the given number of bytes:
+the first half of them, then the last half, kept in a ring buffer until
+the log is closed, with a note of how much was left out in between.
+"""
+
+import collections
+import os
+import selectors
+import subprocess
+import sys
+import threading
+
+_READ_SIZE = 1 << 16
+
+def log_name(step):
+    return step.replace(os.sep, '_').replace(':', '.') + '.log'
+
+class StepLog(object):
+    """
+    A log file of at most size bytes, keeping the start and the end of
+    what is written to it, from any thread
+    """
+    def __init__(self, path, size):
+        self._file = open(path, 'wb')
+        self._lock = threading.Lock()
+        self._head = size - size // 2
+        self._tail_size = size // 2
+        self._written = 0
+        self._tail = collections.deque()
+        self._tail_bytes = 0
+        self._omitted = 0
+
+    def write(self, data):
+        with self._lock:
+            self._write(data)
+
+    def _write(self, data):
+        if self._written < self._head:
+            n = min(len(data), self._head - self._written)
+            self._file.write(data[:n])
+            self._written += n
+            data = data[n:]
+        if not data:
+            return
+        self._tail.append(data)
+        self._tail_bytes += len(data)
+        # drop whole chunks while the others still fill the tail
+        while self._tail and self._tail_bytes - len(self._tail[0]) >= self._tail_size:
+            chunk = self._tail.popleft()
+            self._tail_bytes -= len(chunk)
+            self._omitted += len(chunk)
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._close()
+
+    def _close(self):
+        excess = self._tail_bytes - self._tail_size
+        if excess > 0:
+            self._tail[0] = self._tail[0][excess:]
+            self._omitted += excess
+        if self._omitted:
+            self._file.write('\n[... {} bytes omitted ...]\n'.format(self._omitted).encode())
+        for chunk in self._tail:
+            self._file.write(chunk)
+        self._tail.clear()
+        self._file.close()
+
+def _echo(stream, data):
+    buffer = getattr(stream, 'buffer', None)
+    if buffer is not None:
+        stream.flush()
+        buffer.write(data)
+        buffer.flush()
+    else:
+        stream.write(data.decode('utf-8', 'replace'))
+        stream.flush()
+
+def start(args):
+    """
+    Start the command args with its output captured
+    """
+    return subprocess.Popen(args, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+
+def tee(p, log):
+    """
+    Copy the output of the process p started by start to the terminal and to
+    log, a StepLog, until p closes its standard output and error
+    """
+    with selectors.DefaultSelector() as selector:
+        for pipe, stream in ((p.stdout, sys.stdout), (p.stderr, sys.stderr)):
+            os.set_blocking(pipe.fileno(), False)
+            selector.register(pipe, selectors.EVENT_READ, stream)
+        while selector.get_map():
+            for key, _ in selector.select():
+                try:
+                    data = os.read(key.fd, _READ_SIZE)
+                except BlockingIOError:
+                    continue
+                if not data:
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                    continue
+                _echo(key.data, data)
+                log.write(data)
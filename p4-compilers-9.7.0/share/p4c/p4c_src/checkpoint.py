@@ -0,0 +1,181 @@
+# Copyright 2013-2021 Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials,
+# and your use of them is governed by the express license under which they
+# were provided to you ("License"). Unless the License provides otherwise,
+# you may not use, modify, copy, publish, distribute, disclose or transmit this
+# software or the related documents without Intel's prior written permission.
+#
+# This software and the related documents are provided as is, with no
+# express or implied warranties, other than those that are expressly stated
+# in the License.
+
+"""
+Stage checkpoints and --resume-from.
+
+While a program compiles, the stages that complete successfully are
+recorded in <output_dir>/.checkpoint/checkpoint.json, together with the key
+of the compilation (the key of the compilation cache: the preprocessed
+source, the commands, the target and the tools). When the compiler
+completes, a copy of the manifest it wrote is kept there as well, as the
+driver updates the manifest afterwards, and the size and modification time
+of the assembly files and runtime schemas it generated are recorded. When
+the assembler completes for all the pipes, the size and modification time
+of its outputs are recorded, with the deparser resources of each pipe,
+which the cleaner removes.
+
+A compilation that failed or was interrupted can then be resumed with
+--resume-from STAGE: the preprocessor runs again, and if the key is the
+same, the stages before STAGE are skipped. They must have completed, and
+the outputs of the compiler must not have changed since. Without STAGE,
+the compilation resumes after the last stage that completed, or starts
+over if nothing can be reused.
+
+The checkpoint is removed once the compilation succeeds.
+"""
+
+import json
+import os
+import shutil
+import threading
+
+CHECKPOINT_DIR = '.checkpoint'
+_CHECKPOINT_FILE = 'checkpoint.json'
+
+# the stages that can be skipped, in the order they run. The preprocessor
+# always runs, the checkpoint is keyed on its output.
+STAGES = ('compiler', 'bf-rt-verifier', 'assembler', 'summary_logging', 'p4c-gen-conf',
+          'manifest-verifier')
+
+class ResumeError(Exception):
+    pass
+
+def checkpoint_dir(output_dir):
+    return os.path.join(output_dir, CHECKPOINT_DIR)
+
+def file_stats(paths):
+    stats = {}
+    for path in paths:
+        try:
+            st = os.stat(path)
+            stats[path] = [st.st_size, st.st_mtime_ns]
+        except OSError:
+            pass
+    return stats
+
+def assembly_files(output_dir):
+    """
+    Return the assembly files the compiler wrote to output_dir
+    """
+    files = []
+    for root, dirs, entries in os.walk(output_dir):
+        # skip the scratch directories (.checkpoint, .shards, .race)
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        files += [os.path.join(root, e) for e in entries if e.endswith('.bfa')]
+    return sorted(files)
+
+class Checkpoint(object):
+    """
+    The stages of the compilation with the given key that completed
+    """
+    def __init__(self, output_dir, key):
+        self.dir = checkpoint_dir(output_dir)
+        self.file = os.path.join(self.dir, _CHECKPOINT_FILE)
+        self.key = key
+        self.previous = self._load()
+        self.state = { 'key': key, 'stages': {} }
+        self._lock = threading.Lock()
+
+    def _load(self):
+        """
+        Return the checkpoint of the previous compilation if it had the same key
+        """
+        try:
+            with open(self.file) as f:
+                state = json.load(f)
+            if state.get('key') == self.key and isinstance(state.get('stages'), dict):
+                return state
+        except (OSError, ValueError, AttributeError):
+            pass
+        return None
+
+    def completed(self, stage):
+        return self.previous is not None and stage in self.previous['stages']
+
+    def data(self, stage):
+        return self.previous['stages'][stage]
+
+    def intact(self, stage):
+        """
+        True if the files recorded with the stage did not change
+        """
+        files = self.data(stage).get('files', {})
+        return file_stats(files) == files
+
+    def plan(self, stages, resume_from):
+        """
+        Return the stages to skip, out of the stages of this compilation.
+        resume_from is the stage to resume from, or '' to resume after the
+        last stage that completed. Raises ResumeError if resuming from
+        resume_from is not possible.
+        """
+        if resume_from:
+            if resume_from not in STAGES and resume_from != 'preprocessor':
+                raise ResumeError("unknown stage {}, expected one of: preprocessor, {}".format(
+                    resume_from, ', '.join(STAGES)))
+            if resume_from == 'preprocessor':
+                # the first stage, nothing to skip
+                return []
+            if resume_from not in stages:
+                raise ResumeError("stage {} does not run in this compilation".format(resume_from))
+        skip = []
+        for stage in stages:
+            if stage == resume_from:
+                break
+            if not self.completed(stage) or not self.intact(stage):
+                if not resume_from:
+                    break
+                if self.previous is None:
+                    raise ResumeError("no checkpoint of a previous compilation of the same "
+                                      "program with the same options")
+                raise ResumeError("stage {} of the previous compilation did not complete, "
+                                  "or its outputs changed since".format(stage))
+            skip.append(stage)
+        return skip
+
+    def _save(self):
+        os.makedirs(self.dir, exist_ok = True)
+        with open(self.file + '.tmp', 'w') as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(self.file + '.tmp', self.file)
+
+    def begin(self, skipped):
+        """
+        Start a new checkpoint, keeping the stages that are skipped
+        """
+        with self._lock:
+            for stage in skipped:
+                self.state['stages'][stage] = self.data(stage)
+            self._save()
+
+    def record(self, stage, files = (), **data):
+        """
+        Record that stage completed, with the files to check before skipping it
+        """
+        with self._lock:
+            data['files'] = file_stats(files)
+            self.state['stages'][stage] = data
+            try:
+                self._save()
+            except OSError:
+                pass   # the checkpoint is only needed to resume
+
+    def save_file(self, path):
+        os.makedirs(self.dir, exist_ok = True)
+        shutil.copyfile(path, os.path.join(self.dir, os.path.basename(path)))
+
+    def restore_file(self, path):
+        shutil.copyfile(os.path.join(self.dir, os.path.basename(path)), path)
+
+    def remove(self):
+        shutil.rmtree(self.dir, ignore_errors = True)
@@ -0,0 +1,100 @@
+# Copyright 2013-2021 Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials,
+# and your use of them is governed by the express license under which they
+# were provided to you ("License"). Unless the License provides otherwise,
+# you may not use, modify, copy, publish, distribute, disclose or transmit this
+# software or the related documents without Intel's prior written permission.
+#
+# This software and the related documents are provided as is, with no
+# express or implied warranties, other than those that are expressly stated
+# in the License.
+
+"""
+Removal of the intermediate files from the outputs.
+
+The output tree is scanned once with os.scandir, and the files whose name
+ends with one of the suffixes are removed in process. On network
+filesystems, where each unlink is a round trip to the server, they are
+removed from a few threads.
+"""
+
+import concurrent.futures
+import os
+
+NETWORK_FILESYSTEMS = ('nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'afs', 'ceph', 'lustre', 'gpfs',
+                       'glusterfs', 'fuse.glusterfs', 'fuse.sshfs', 'beegfs')
+NETWORK_THREADS = 4
+
+def filesystem_type(path):
+    """
+    Return the type of the filesystem path is on, or None if unknown
+    """
+    path = os.path.realpath(path)
+    fs_type = None
+    longest = -1
+    try:
+        with open('/proc/self/mountinfo') as f:
+            for line in f:
+                fields, _, rest = line.partition(' - ')
+                fields = fields.split()
+                if len(fields) < 5 or not rest:
+                    continue
+                mount_point = fields[4].replace('\\040', ' ')
+                if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) \
+                   and len(mount_point) > longest:
+                    longest = len(mount_point)
+                    fs_type = rest.split()[0]
+    except OSError:
+        return None
+    return fs_type
+
+def network_filesystem(path):
+    return filesystem_type(path) in NETWORK_FILESYSTEMS
+
+def matching_files(top, suffixes):
+    """
+    Yield the path and size of the files under top whose name ends with one
+    of suffixes
+    """
+    suffixes = tuple(suffixes)
+    pending = [top]
+    while pending:
+        try:
+            with os.scandir(pending.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks = False):
+                        pending.append(entry.path)
+                    elif entry.name.endswith(suffixes):
+                        try:
+                            yield entry.path, entry.stat(follow_symlinks = False).st_size
+                        except OSError:
+                            pass
+        except OSError:
+            pass
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+        return True
+    except OSError:
+        return False
+
+def remove_files(top, suffixes, threads = 1):
+    """
+    Remove the files under top whose name ends with one of suffixes,
+    ignoring failures. Returns the number of files removed and their size.
+    """
+    files = list(matching_files(top, suffixes))
+    if threads > 1 and len(files) > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers = threads) as executor:
+            removed = list(executor.map(_unlink, [path for path, _ in files]))
+    else:
+        removed = [_unlink(path) for path, _ in files]
+    count = 0
+    freed = 0
+    for (_, size), ok in zip(files, removed):
+        if ok:
+            count += 1
+            freed += size
+    return count, freed
@@ -16,6 +16,33 @@
 import sys
 import os
 
+# compiled configuration files, by (path, mtime), so that a long running
+# process (the compile server) does not compile them for every request
+_compiled_configs = {}
+
+class TargetDescriptor(object):
+    """
+    TargetDescriptor - A backend registered by a configuration file, that is
+    only constructed when it is selected.
+
+    Constructing a backend registers its command line options and looks up
+    its tools, so we defer it until we know which (target, arch) tuple is
+    being compiled for.
+    """
+
+    def __init__(self, target, arch, factory):
+        self._target = target
+        self._arch = arch
+        self._backend = target + '-' + arch
+        self._factory = factory
+
+    def __str__(self):
+        return self._backend
+
+    def instantiate(self, argParser):
+        return self._factory(self._target, self._arch, argParser)
+
+
 class Config(object):
     """
     Config - Configuration data for a 'p4c' tool chain.
@@ -29,22 +56,39 @@ class Config(object):
         self.config_prefix = config_prefix or 'p4c'
         self.target = []
 
+    def add_target(self, target, arch, factory):
+        """
+        Register a backend for (target, arch). factory is called with
+        (target, arch, argParser) when the backend is selected.
+        """
+        self.target.append(TargetDescriptor(target, arch, factory))
+
     def load_from_config(self, path, argParser):
         cfg_globals = dict(globals())
         cfg_globals['config'] = self
         cfg_globals['__file__'] = path
         cfg_globals['argParser'] = argParser
 
-        data = None
-        f = open(path)
         try:
-            data = f.read()
-        except:
-            print("error", path)
-        f.close()
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            mtime = None
+        code = _compiled_configs.get((path, mtime))
+
+        if code is None:
+            data = None
+            f = open(path)
+            try:
+                data = f.read()
+            except:
+                print("error", path)
+            f.close()
 
         try:
-            exec(compile(data, path, 'exec'), cfg_globals, None)
+            if code is None:
+                code = compile(data, path, 'exec')
+                _compiled_configs[(path, mtime)] = code
+            exec(code, cfg_globals, None)
         except SystemExit:
             e = sys.exc_info()[1]
             if e.args:
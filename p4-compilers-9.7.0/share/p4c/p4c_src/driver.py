@@ -14,9 +14,272 @@
 import os
 import shlex, subprocess
 import sys
+import threading
+import time
 
 import p4c_src.util as util
 
+class DriverError(Exception):
+    """Raised when the driver can not complete.
+
+    returncode is the exit code of the driver. message, if not None, is
+    reported to the user by whoever catches the exception.
+    """
+
+    def __init__(self, message = None, returncode = 1):
+        Exception.__init__(self, message)
+        self.message = message
+        self.returncode = returncode
+
+class DriverExit(DriverError):
+    """Raised when the driver is done early, e.g. after printing help.
+    """
+
+    def __init__(self, message = None, returncode = 0):
+        DriverError.__init__(self, message, returncode)
+
+_current = threading.local()
+
+def command_argv(cmd):
+    """
+    Return the arguments of cmd, a list of options as added by
+    add_command_option and add_command_args: strings are split as by a
+    shell, each on its own, and lists of arguments are taken as is
+    """
+    argv = []
+    for option in cmd:
+        if isinstance(option, str):
+            argv += shlex.split(option)
+        else:
+            argv += list(option)
+    return argv
+
+def command_line(cmd):
+    """
+    Return cmd as printed to the user
+    """
+    return ' '.join(o if isinstance(o, str) else shlex.join(o) for o in cmd)
+
+def current_step():
+    """
+    Return the step running in this thread, or None
+    """
+    return getattr(_current, 'step', None)
+
+def set_current_step(step):
+    """
+    Account the commands run by this thread to step, e.g. in threads that a
+    step starts to run several commands concurrently
+    """
+    _current.step = step
+
+def wait_process(p, step = None):
+    """
+    Wait for the subprocess.Popen p and return its return code. Its resource
+    usage is added to step, by default the step running in this thread.
+    """
+    _, status, usage = os.wait4(p.pid, 0)
+    p.returncode = os.waitstatus_to_exitcode(status)
+    if step is None:
+        step = current_step()
+    if step is not None:
+        step.add_usage(usage)
+    return p.returncode
+
+class Step(object):
+    """A node of the compilation graph.
+
+    action is a callable that takes no arguments and returns a return code.
+    inputs and outputs are names of the artifacts (files or logical names)
+    that the step consumes and produces. A step depends on every step that
+    produces one of its inputs, and on the steps named in after.
+
+    A step runs once all its dependencies are done. If any of them failed or
+    was skipped, the step is skipped, unless always is set, in which case it
+    runs regardless (cleanup steps).
+    """
+
+    def __init__(self, name, action, inputs = (), outputs = (), after = (), always = False):
+        self.name = name
+        self.action = action
+        self.inputs = set(inputs)
+        self.outputs = set(outputs)
+        self.after = set(after)
+        self.always = always
+        self.state = 'pending'   # pending, running, done, skipped
+        self.rc = None
+        self.start = None        # wall clock time the step started and ended
+        self.end = None
+        self.user = 0.0          # CPU time and peak RSS (bytes) of its commands
+        self.sys = 0.0
+        self.peak_rss = 0
+        self._usage_lock = threading.Lock()
+
+    def add_usage(self, usage):
+        """
+        Add the resource.struct_rusage of a command run by the step
+        """
+        with self._usage_lock:
+            self.user += usage.ru_utime
+            self.sys += usage.ru_stime
+            # Linux reports kilobytes
+            self.peak_rss = max(self.peak_rss, usage.ru_maxrss * 1024)
+
+    def __str__(self):
+        return self.name
+
+class StepGraph(object):
+    """A dependency graph of steps, executed on a bounded worker pool.
+
+    Ready steps are started in the order in which they were added, so with a
+    single job the execution order is deterministic. Dependencies are resolved
+    when a step is considered for scheduling, which allows steps to add new
+    steps to the graph while it runs (e.g. one step per pipe once the manifest
+    has been parsed): a step that adds steps must produce an output that the
+    steps depending on the new ones consume.
+    """
+
+    def __init__(self, jobs = 1):
+        self._jobs = max(1, jobs)
+        self._steps = []
+        self._names = set()
+        self._lock = threading.Lock()
+
+    def add(self, step):
+        with self._lock:
+            if step.name in self._names:
+                raise Exception("Programmer error - duplicate step " + step.name)
+            self._names.add(step.name)
+            self._steps.append(step)
+        return step
+
+    def steps(self):
+        with self._lock:
+            return list(self._steps)
+
+    def get(self, name):
+        for s in self.steps():
+            if s.name == name:
+                return s
+        return None
+
+    def dependencies(self, step):
+        return [s for s in self.steps() if s is not step and \
+                (s.name in step.after or (s.outputs & step.inputs))]
+
+    def rc(self):
+        """
+        Sum of the return codes of the steps that ran
+        """
+        return sum(s.rc for s in self.steps() if s.state == 'done')
+
+    def _ready(self):
+        """
+        Return the next step that can run, marking skipped steps on the way
+        """
+        for step in self.steps():
+            if step.state != 'pending':
+                continue
+            deps = self.dependencies(step)
+            if any(d.state in ('pending', 'running') for d in deps):
+                continue
+            if not step.always and \
+               any(d.state == 'skipped' or d.rc != 0 for d in deps):
+                step.state = 'skipped'
+                continue
+            return step
+        return None
+
+    @staticmethod
+    def _start(step):
+        step.state = 'running'
+        step.start = time.time()
+
+    @staticmethod
+    def _execute(step):
+        """
+        Run the action of step, accounting the commands it runs to it
+        """
+        previous = current_step()
+        set_current_step(step)
+        try:
+            return step.action()
+        finally:
+            set_current_step(previous)
+
+    @staticmethod
+    def _finish(step, rc):
+        # a return code of None means the command did not complete
+        step.end = time.time()
+        step.rc = 1 if rc is None else rc
+        step.state = 'done'
+
+    def run(self):
+        """
+        Run all the steps. Exceptions raised by a step are propagated once the
+        steps that are already running have completed.
+        """
+        if self._jobs == 1:
+            # run in the calling thread
+            step = self._ready()
+            while step is not None:
+                self._start(step)
+                self._finish(step, self._execute(step))
+                step = self._ready()
+        else:
+            import concurrent.futures
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self._jobs) as pool:
+                running = {}
+                error = None
+                while True:
+                    while error is None and len(running) < self._jobs:
+                        step = self._ready()
+                        if step is None:
+                            break
+                        self._start(step)
+                        running[pool.submit(self._execute, step)] = step
+                    if not running:
+                        break
+                    done, _ = concurrent.futures.wait(
+                        running, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for f in done:
+                        step = running.pop(f)
+                        try:
+                            self._finish(step, f.result())
+                        except BaseException as e:
+                            self._finish(step, 1)
+                            if error is None:
+                                error = e
+                if error is not None:
+                    raise error
+
+        pending = [s.name for s in self.steps() if s.state == 'pending']
+        if pending:
+            raise Exception("Dependency cycle between steps: " + ", ".join(pending))
+
+def chrome_trace(steps, origin):
+    """
+    Return the steps that ran as a Chrome trace (chrome://tracing, Perfetto)
+    with times relative to origin. Steps that overlap are shown on separate
+    rows.
+    """
+    events = []
+    lanes = []   # end time of the last step of each row
+    for step in sorted((s for s in steps if s.start is not None and s.end is not None),
+                       key = lambda s: s.start):
+        lane = next((i for i, end in enumerate(lanes) if end <= step.start), len(lanes))
+        if lane == len(lanes):
+            lanes.append(step.end)
+        else:
+            lanes[lane] = step.end
+        events.append({ 'name': step.name, 'cat': 'bf-p4c', 'ph': 'X',
+                        'ts': int((step.start - origin) * 1e6),
+                        'dur': int((step.end - step.start) * 1e6),
+                        'pid': os.getpid(), 'tid': lane,
+                        'args': { 'returncode': step.rc, 'user': step.user, 'sys': step.sys,
+                                  'peak_rss': step.peak_rss } })
+    return { 'traceEvents': events, 'displayTimeUnit': 'ms' }
+
 class BackendDriver:
     """A class that has a list of passes that need to be run.  Each
     backend configures the commands that wants to be run.
@@ -28,6 +291,10 @@ class BackendDriver:
     process.  Each pass also allows invoking a pre and post processing
     step to setup and cleanup after each command.
 
+    The passes are executed as a StepGraph. Backends can add their own
+    steps with add_step, declaring what each step consumes and produces,
+    and they will be scheduled with the commands without overriding run.
+
     """
 
     def __init__(self, target, arch, argParser = None):
@@ -38,6 +305,9 @@ class BackendDriver:
         self._commandsEnabled = []
         self._preCmds = {}
         self._postCmds = {}
+        self._steps = []
+        self._jobs = 1
+        self._graph = None
         self._argParser = argParser
         self._argGroup = None
         # options
@@ -46,6 +316,10 @@ class BackendDriver:
         self._source_filename = None
         self._source_basename = None
         self._verbose = False
+        self._step_logs = None
+        self._step_log_size = 0
+        self._step_log_files = {}
+        self._step_logs_lock = threading.Lock()
 
     def __str__(self):
         return self._backend
@@ -60,6 +334,15 @@ class BackendDriver:
         self._commands[cmd_name] = []
         self._commands[cmd_name].append(cmd)
 
+    def add_step(self, name, action, inputs = (), outputs = (), after = (), always = False):
+        """ Add a step to the graph executed by run
+
+        See Step for the meaning of the arguments.
+        """
+        step = Step(name, action, inputs, outputs, after, always)
+        self._steps.append(step)
+        return step
+
     def add_command_option(self, cmd_name, option):
         """ Add an option to a command
         """
@@ -70,6 +353,12 @@ class BackendDriver:
             return
         self._commands[cmd_name].append(option)
 
+    def add_command_args(self, cmd_name, *args):
+        """ Add arguments to a command, passed as they are (e.g. paths
+        that may contain spaces)
+        """
+        self.add_command_option(cmd_name, tuple(args))
+
     def add_command_line_options(self):
         """ Method for derived classes to add options to the parser
         """
@@ -84,6 +373,10 @@ class BackendDriver:
         self._output_directory = opts.output_directory
         self._source_filename = opts.source_file
         self._source_basename = os.path.splitext(os.path.basename(opts.source_file))[0]
+        self._step_logs = opts.step_logs or os.environ.get('P4C_STEP_LOGS') or None
+        if opts.step_log_size < 1:
+            raise DriverError("--step-log-size expects a positive size in MB")
+        self._step_log_size = opts.step_log_size << 20
 
         # set preprocessor options
         if 'preprocessor' in self._commands:
@@ -230,27 +523,71 @@ class BackendDriver:
             if c in self._commandsEnabled:
                 self._commandsEnabled.remove(c)
 
+    @staticmethod
+    def stepLogName(step):
+        """
+        The step log a command of step writes to: the commands run for a
+        part of the compilation (the steps named <step>:<part>, one per pipe)
+        write to the log of their command for that part
+        """
+        current = current_step()
+        if current is not None and ':' not in step and ':' in current.name:
+            return '{}:{}'.format(step, current.name.split(':', 1)[1])
+        return step
+
+    def stepLog(self, step):
+        """
+        Return the log of step in the --step-logs directory, truncated when
+        the first command of the step in this run opens it, and shared by
+        all its commands until closeStepLogs
+        """
+        from p4c_src.capture import StepLog, log_name
+        name = self.stepLogName(step)
+        with self._step_logs_lock:
+            log = self._step_log_files.get(name)
+            if log is None:
+                os.makedirs(self._step_logs, exist_ok = True)
+                log = StepLog(os.path.join(self._step_logs, log_name(name)),
+                              self._step_log_size)
+                self._step_log_files[name] = log
+            return log
+
+    def closeStepLogs(self):
+        with self._step_logs_lock:
+            logs = list(self._step_log_files.values())
+            self._step_log_files.clear()
+        for log in logs:
+            log.close()
+
     def runCmd(self, step, cmd):
         """
-        Run a command, capture its output and print it
-        Also exit with the command error code if failed
+        Run a command and print its output, also to the log of the step
+        with --step-logs. Returns its return code.
         """
         if self._dry_run:
-            print('{}:\n{}'.format(step, ' '.join(cmd)))
+            print('{}:\n{}'.format(step, command_line(cmd)))
             return 0
 
-        args = shlex.split(" ".join(cmd))
+        args = command_argv(cmd)
+        log = None
         try:
-            p = subprocess.Popen(args)
+            if self._step_logs is not None:
+                from p4c_src.capture import start
+                log = self.stepLog(step)
+                p = start(args)
+            else:
+                p = subprocess.Popen(args)
         except:
             import traceback
-            print("error invoking {}".format(" ".join(cmd)), file=sys.stderr)
+            print("error invoking {}".format(command_line(cmd)), file=sys.stderr)
             print(traceback.format_exc(), file=sys.stderr)
             return 1
 
-        if self._verbose: print('running {}'.format(' '.join(cmd)))
-        p.communicate() # now wait
-        return p.returncode
+        if self._verbose: print('running {}'.format(command_line(cmd)))
+        if log is not None:
+            from p4c_src.capture import tee
+            tee(p, log)
+        return wait_process(p)
 
 
     def preRun(self, cmd_name):
@@ -264,7 +601,7 @@ class BackendDriver:
         for c in cmds:
             rc = self.runCmd(cmd_name, c)
             if rc != 0:
-                sys.exit(rc)
+                raise DriverError(None, rc)
 
     def postRun(self, cmd_name):
         """
@@ -281,34 +618,69 @@ class BackendDriver:
             # so that we do all the cleanup
         return rc # \TODO should we fail on this or not?
 
-    def run(self):
+    def runCommandStep(self, cmd_name):
         """
-        Run the set of commands required by this driver
+        Run a command with its setup and cleanup
         """
+        # run the setup for the command
+        self.preRun(cmd_name)
 
-        # set output directory
-        if not os.path.exists(self._output_directory):
-            os.makedirs(self._output_directory)
+        # run the command
+        cmd = self._commands[cmd_name]
+        if cmd[0].find('/') != 0 and (util.find_bin(cmd[0]) == None):
+            raise DriverError("{}: command not found".format(cmd[0]))
 
-        for c in self._commandsEnabled:
+        rc = self.runCmd(cmd_name, cmd)
 
-            # run the setup for the command
-            self.preRun(c)
+        # run the cleanup whether the command succeeded or failed
+        postrc = self.postRun(cmd_name)
+        return rc
 
-            # run the command
-            cmd = self._commands[c]
-            if cmd[0].find('/') != 0 and (util.find_bin(cmd[0]) == None):
-                print("{}: command not found".format(cmd[0]), file=sys.stderr)
-                sys.exit(1)
+    def stages(self):
+        """
+        Return the steps of the last run, in the order they were added
+        """
+        if self._graph is None:
+            return []
+        return self._graph.steps()
 
-            rc = self.runCmd(c, cmd)
+    def command_step(self, cmd_name, inputs = (), outputs = (), after = (), always = False):
+        """
+        Create the step that runs command cmd_name
+        """
+        return Step(cmd_name, lambda: self.runCommandStep(cmd_name),
+                    inputs, outputs, after, always)
 
-            # run the cleanup whether the command succeeded or failed
-            postrc = self.postRun(c)
+    def run(self):
+        """
+        Run the set of commands required by this driver
+        """
 
-            # if the main command failed, stop and return its error code so that
-            # backends that override run can chose what to do on error
-            if rc != 0:
-                return rc
+        # set output directory
+        if not os.path.exists(self._output_directory):
+            os.makedirs(self._output_directory)
 
+        # the enabled commands run in order, each one after the previous one
+        graph = StepGraph(self._jobs)
+        self._graph = graph
+        previous = ()
+        for c in self._commandsEnabled:
+            graph.add(self.command_step(c, after = previous))
+            previous = (c,)
+        for step in self._steps:
+            graph.add(step)
+        graph.run()
+
+        # if a command failed, return its error code so that
+        # backends that override run can chose what to do on error
+        for step in graph.steps():
+            if step.state == 'done' and step.rc != 0:
+                return step.rc
         return 0
+
+    def cleanup(self):
+        """
+        Remove what the compilation used but does not leave behind, once
+        it ended, successfully or not
+        """
+        self.closeStepLogs()
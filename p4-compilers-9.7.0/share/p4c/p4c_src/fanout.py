@@ -0,0 +1,189 @@
+# Copyright 2013-2021 Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials,
+# and your use of them is governed by the express license under which they
+# were provided to you ("License"). Unless the License provides otherwise,
+# you may not use, modify, copy, publish, distribute, disclose or transmit this
+# software or the related documents without Intel's prior written permission.
+#
+# This software and the related documents are provided as is, with no
+# express or implied warranties, other than those that are expressly stated
+# in the License.
+
+"""
+Multi-target compilation: '--target tofino,tofino2,tofino2m' compiles the
+program for each target from a single driver.
+
+Each target gets its own backend. With the default architecture, each target
+uses its own default (see barefoot.default_arch). The source is preprocessed
+once for each distinct set of preprocessor options, and the result is shared
+by the targets that use the same set. The targets then compile, assemble and
+generate their configuration concurrently.
+
+Outputs go to <program>.<target> in the directory given by -o (default the
+current directory). If -o contains '{target}', it is replaced by the name of
+the target instead. The other files the targets write, --bf-rt-schema,
+--p4runtime-file(s), --depfile and --archive, must contain '{target}' when
+they are given, so that the targets do not write the same file; the default
+archive of a target is named <program>.<target>.
+"""
+
+import argparse
+import copy
+import os
+import shutil
+import sys
+
+from p4c_src.driver import DriverError
+
+_TEMPLATED_OPTIONS = ('bf_rt_schema', 'p4runtime_file', 'p4runtime_files', 'depfile',
+                      'depfile_target', 'archive')
+# the options that name files written by each target
+_OUTPUT_FILE_OPTIONS = ('bf_rt_schema', 'p4runtime_file', 'p4runtime_files', 'depfile',
+                        'archive')
+
+def _shared_outputs(opts):
+    """
+    Return the options that name files that all the targets would write
+    """
+    shared = []
+    for option in _OUTPUT_FILE_OPTIONS:
+        value = getattr(opts, option, None)
+        if not isinstance(value, str) or not value or \
+           (option == 'archive' and value == '__default__'):
+            continue
+        if not all('{target}' in path for path in value.split(',')):
+            shared.append('--' + option.replace('_', '-'))
+    return shared
+
+def _language(args, environment):
+    """
+    The language selects the default architecture, we need it before parsing
+    the options registered by the backends
+    """
+    parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    parser.add_argument("--std", "-x", dest="language", default="p4-16")
+    opts, _ = parser.parse_known_args(args)
+    language = opts.language
+    if environment and os.environ.get('P4C_DEFAULT_VERSION') is not None:
+        language = os.environ['P4C_DEFAULT_VERSION']
+    return language.replace('_', '-')
+
+def _preprocessor_key(backend):
+    """
+    The preprocessor command, without the name of the file it writes
+    """
+    cmd = list(backend._commands['preprocessor'])
+    for i, arg in enumerate(cmd[:-1]):
+        if arg == '-o':
+            cmd[i + 1] = None
+    return tuple(cmd)
+
+def _p4pp(backend):
+    return "{}/{}.p4pp".format(backend._output_directory, backend.program_name)
+
+def _share_file(src, dst):
+    if os.path.abspath(src) == os.path.abspath(dst):
+        return
+    try:
+        if os.path.exists(dst):
+            os.unlink(dst)
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+def run_targets(parser, cfg, early_opts, args = None, environment = True):
+    """
+    Compile for each of the comma separated targets in early_opts.target.
+    Returns the exit code: 0 if all targets compiled, otherwise the exit code
+    of the first target that failed.
+    """
+    from p4c_src.barefoot import default_arch
+    from p4c_src.main import check_input, find_backend, instantiate_backend, parse_options
+
+    targets = [t for t in early_opts.target.split(',') if t]
+    if len(set(targets)) != len(targets):
+        parser.error("Duplicate target in {}".format(early_opts.target))
+    language = _language(args, environment)
+
+    # construct a backend per target; they all register their options
+    backends = []
+    for target in targets:
+        arch = early_opts.arch
+        backend = find_backend(cfg, target, arch)
+        if backend is None and arch == 'default':
+            arch = default_arch(target, language)
+            backend = find_backend(cfg, target, arch)
+        if backend is None:
+            parser.error("Unknown backend: {}-{}".format(target, arch))
+        backends.append((target, arch, instantiate_backend(backend, parser)))
+
+    opts = parse_options(parser, args, environment)
+    check_input(parser, opts, backends[0][2])
+    program_name = opts.program_name or \
+                   os.path.splitext(os.path.basename(opts.source_file))[0]
+    shared = _shared_outputs(opts)
+    if len(backends) > 1 and shared:
+        parser.error("{} must contain {{target}} when compiling for several targets".format(
+            ', '.join(shared)))
+
+    try:
+        # configure the backends, each with its own output directory
+        for target, arch, backend in backends:
+            target_opts = copy.copy(opts)
+            target_opts.target = target
+            target_opts.arch = arch
+            if '{target}' in opts.output_directory:
+                target_opts.output_directory = opts.output_directory.format(target = target)
+            else:
+                target_opts.output_directory = os.path.join(opts.output_directory,
+                                                            "{}.{}".format(program_name, target))
+            for option in _TEMPLATED_OPTIONS:
+                value = getattr(opts, option, None)
+                if isinstance(value, str) and '{target}' in value:
+                    setattr(target_opts, option, value.format(target = target))
+            if opts.archive == '__default__':
+                target_opts.archive = "{}.{}".format(program_name, target)
+            backend.process_command_line_options(target_opts)
+
+        # preprocess once per distinct set of preprocessor options
+        preprocessed = {}
+        for target, arch, backend in backends:
+            if 'preprocessor' not in backend._commandsEnabled or \
+               len(backend._commandsEnabled) == 1:
+                continue   # -e, or -E which only preprocesses
+            if not os.path.exists(backend._output_directory):
+                os.makedirs(backend._output_directory)
+            key = _preprocessor_key(backend)
+            if key not in preprocessed:
+                rc = backend.checkAndRunCmd('preprocessor')
+                if rc != 0:
+                    return rc
+                preprocessed[key] = backend
+            elif not backend._dry_run:
+                _share_file(_p4pp(preprocessed[key]), _p4pp(backend))
+            backend.disable_commands(['preprocessor'])
+
+        # and compile all targets concurrently
+        def run(backend):
+            try:
+                return backend.run()
+            except DriverError as e:
+                if e.message is not None:
+                    print(e.message, file=sys.stderr)
+                return e.returncode
+
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(max_workers = len(backends)) as pool:
+            rcs = list(pool.map(run, [b for _, _, b in backends]))
+
+        rc = 0
+        for (target, arch, backend), target_rc in zip(backends, rcs):
+            if target_rc != 0:
+                print("bf-p4c: compilation for {} failed with exit code {}".format(
+                    target, target_rc), file=sys.stderr)
+                rc = rc or target_rc
+        return rc
+    finally:
+        for _, _, backend in backends:
+            backend.cleanup()
@@ -0,0 +1,129 @@
+# Copyright 2013-2021 Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials,
+# and your use of them is governed by the express license under which they
+# were provided to you ("License"). Unless the License provides otherwise,
+# you may not use, modify, copy, publish, distribute, disclose or transmit this
+# software or the related documents without Intel's prior written permission.
+#
+# This software and the related documents are provided as is, with no
+# express or implied warranties, other than those that are expressly stated
+# in the License.
+
+"""
+Incremental assembly.
+
+When a program is recompiled, the assembly of most pipes is often the same
+as in the previous compilation. After a pipe is assembled successfully, a
+stamp is written to <pipe_dir>/.bfas.stamp with:
+  - the key of the assembly: the hash of the .bfa file, the assembler
+    command and the assembler binary,
+  - the size and modification time of the outputs of the assembler
+    (context.json and the binary),
+  - the deparser resources, that are merged into the resources.json the
+    compiler writes again every time, and that the cleaner removes,
+  - whether the outputs were verified.
+
+The next compilation skips the assembler of the pipe if the key is the
+same and the outputs were not touched since. The stamp is removed before
+running the assembler, so a failed or interrupted assembly never leaves a
+stamp behind.
+"""
+
+import json
+import os
+
+from p4c_src.cache import CacheKey
+from p4c_src.driver import command_line
+
+STAMP_FILE = '.bfas.stamp'
+DEPARSER_RESOURCES = os.path.join('logs', 'resources_deparser.json')
+
+def stamp_file(dirname):
+    return os.path.join(dirname, STAMP_FILE)
+
+def assembly_key(asm_file, cmd, assembler):
+    key = CacheKey()
+    key.add_file('bfa', asm_file)
+    key.add_string('command', command_line(cmd))
+    key.add_tool('assembler-bin', assembler)
+    return key.hexdigest()
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime_ns]
+    except OSError:
+        return None
+
+def assembler_outputs(dirname, since_ns):
+    """
+    Return the outputs the assembler wrote to dirname since since_ns
+    """
+    outputs = {}
+    for entry in os.listdir(dirname):
+        if entry == 'context.json' or entry.endswith('.bin'):
+            st = _stat(os.path.join(dirname, entry))
+            if st is not None and st[1] >= since_ns:
+                outputs[entry] = st
+    return outputs
+
+def load_stamp(dirname, key):
+    """
+    Return the stamp of the previous assembly in dirname if it had the same
+    key and its outputs are intact, otherwise None
+    """
+    try:
+        with open(stamp_file(dirname)) as f:
+            stamp = json.load(f)
+        if stamp['key'] != key or 'context.json' not in stamp['outputs']:
+            return None
+        for entry, st in stamp['outputs'].items():
+            if _stat(os.path.join(dirname, entry)) != st:
+                return None
+        return stamp
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+def remove_stamp(dirname):
+    try:
+        os.unlink(stamp_file(dirname))
+    except OSError:
+        pass
+
+def load_deparser_resources(dirname):
+    """
+    Return the deparser resources the assembler wrote to dirname, or None
+    """
+    try:
+        with open(os.path.join(dirname, DEPARSER_RESOURCES)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_stamp(dirname, key, since_ns, verified):
+    """
+    Record a successful assembly of dirname
+    """
+    stamp = { 'key': key,
+              'outputs': assembler_outputs(dirname, since_ns),
+              'deparser': load_deparser_resources(dirname),
+              'verified': verified }
+    try:
+        with open(stamp_file(dirname) + '.tmp', 'w') as f:
+            json.dump(stamp, f)
+        os.replace(stamp_file(dirname) + '.tmp', stamp_file(dirname))
+    except OSError:
+        pass   # the stamp is only an optimization
+
+def restore_deparser_resources(dirname, stamp):
+    """
+    Put back the deparser resources of the skipped assembly, to be merged
+    into resources.json
+    """
+    if stamp.get('deparser') is None:
+        return
+    path = os.path.join(dirname, DEPARSER_RESOURCES)
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    with open(path, 'w') as f:
+        json.dump(stamp['deparser'], f)
@@ -0,0 +1,216 @@
+# Copyright 2013-2021 Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials,
+# and your use of them is governed by the express license under which they
+# were provided to you ("License"). Unless the License provides otherwise,
+# you may not use, modify, copy, publish, distribute, disclose or transmit this
+# software or the related documents without Intel's prior written permission.
+#
+# This software and the related documents are provided as is, with no
+# express or implied warranties, other than those that are expressly stated
+# in the License.
+
+"""
+JSON I/O for the driver and the post-compilation tools.
+
+The manifest, context.json, resources.json and bf-rt.json can be large. This
+module parses and serializes them with the fastest JSON library installed:
+orjson, then ujson, then simdjson (parsing only), falling back to the
+standard json module. $P4C_JSON selects one of them explicitly.
+
+load, loads, dump and dumps take the arguments of their json counterparts
+that the tools use, so that a tool can fall back to json when the driver is
+not installed:
+
+    try:
+        from p4c_src import jsonio as json
+    except ImportError:
+        import json
+
+load and dump also accept a path. Files are read as bytes through mmap.
+
+The libraries do not format numbers and non-ASCII characters as json does,
+and orjson only indents by 2. When the output must be byte-identical to the
+output of json, pass deterministic=True or set $P4C_JSON_DETERMINISTIC=1:
+dump and dumps then always use json. They also use it for the formats the
+selected library can not produce.
+
+Artifacts are indented for humans unless --compact-json is given, or
+$P4C_COMPACT_JSON=1: layout() returns the indent and separators to write
+them with, and bf-p4c-fmt indents a compact file on demand.
+
+python3 -m p4c_src.jsonio FILE... compares the libraries on FILE.
+"""
+
+import io
+import json
+import mmap
+import os
+import sys
+import time
+
+_LIBRARIES = ('orjson', 'ujson', 'simdjson', 'json')
+
+def _import(name):
+    try:
+        return __import__(name)
+    except ImportError:
+        return None
+
+def _select():
+    requested = os.environ.get('P4C_JSON', '')
+    for name in ([requested] if requested in _LIBRARIES else _LIBRARIES):
+        module = _import(name)
+        if module is not None:
+            return name, module
+    return 'json', json
+
+backend, _module = _select()
+
+def deterministic_default():
+    return os.environ.get('P4C_JSON_DETERMINISTIC', '0') not in ('', '0')
+
+def compact_default():
+    return os.environ.get('P4C_COMPACT_JSON', '0') not in ('', '0')
+
+def layout(compact, indent = 2):
+    """
+    Return the indent and separators to write an artifact with
+    """
+    if compact:
+        return { 'indent': None, 'separators': (',', ':') }
+    return { 'indent': indent, 'separators': (',', ': ') }
+
+def loads(data):
+    """
+    Parse data, str or bytes-like
+    """
+    if backend == 'orjson':
+        return _module.loads(data)
+    if isinstance(data, (memoryview, bytearray, mmap.mmap)):
+        data = bytes(data)
+    if backend in ('ujson', 'simdjson'):
+        return _module.loads(data)
+    return json.loads(data)
+
+def _load_fd(fd):
+    if os.fstat(fd).st_size == 0:
+        return loads(b'')   # raises the error of the library
+    with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as data:
+        if backend == 'orjson':
+            view = memoryview(data)
+            try:
+                return loads(view)
+            finally:
+                view.release()
+        return loads(data)
+
+def load(source):
+    """
+    Parse the file at path source, or the file object source
+    """
+    if isinstance(source, (str, bytes, os.PathLike)):
+        with open(source, 'rb') as f:
+            return _load_fd(f.fileno())
+    try:
+        fd = source.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return loads(source.read())
+    # the file object may have been read from already
+    if hasattr(source, 'tell') and source.tell() != 0:
+        return loads(source.read())
+    return _load_fd(fd)
+
+def _fast_dumps(obj, indent, separators, sort_keys):
+    """
+    Serialize obj with the selected library, or return None if it can not
+    produce this format
+    """
+    if backend == 'orjson':
+        if indent not in (None, 2):
+            return None
+        if indent is None and separators not in (None, (',', ':')):
+            return None
+        if indent == 2 and separators not in (None, (',', ': ')):
+            return None
+        option = 0
+        if indent == 2:
+            option |= _module.OPT_INDENT_2
+        if sort_keys:
+            option |= _module.OPT_SORT_KEYS
+        try:
+            return _module.dumps(obj, option = option)
+        except TypeError:
+            return None   # e.g. integers larger than 64 bits
+    if backend == 'ujson':
+        if separators is not None:
+            return None
+        return _module.dumps(obj, indent = indent or 0, sort_keys = sort_keys,
+                             escape_forward_slashes = False).encode('utf-8')
+    return None
+
+def dumps(obj, indent = None, separators = None, sort_keys = False, deterministic = None):
+    """
+    Serialize obj to a str
+    """
+    if deterministic is None:
+        deterministic = deterministic_default()
+    if not deterministic:
+        data = _fast_dumps(obj, indent, separators, sort_keys)
+        if data is not None:
+            return data.decode('utf-8')
+    return json.dumps(obj, indent = indent, separators = separators, sort_keys = sort_keys)
+
+def dump(obj, target, indent = None, separators = None, sort_keys = False, deterministic = None):
+    """
+    Serialize obj to the file at path target, or to the file object target
+    """
+    if deterministic is None:
+        deterministic = deterministic_default()
+    data = None if deterministic else _fast_dumps(obj, indent, separators, sort_keys)
+    if isinstance(target, (str, bytes, os.PathLike)):
+        with open(target, 'wb') as f:
+            if data is not None:
+                f.write(data)
+            else:
+                f.write(json.dumps(obj, indent = indent, separators = separators,
+                                   sort_keys = sort_keys).encode('utf-8'))
+        return
+    if data is None:
+        json.dump(obj, target, indent = indent, separators = separators, sort_keys = sort_keys)
+    elif isinstance(target, io.TextIOBase):
+        target.write(data.decode('utf-8'))
+    else:
+        target.write(data)
+
+def _benchmark(paths, repeat = 3):
+    """
+    Time parsing and serializing paths with each of the libraries installed
+    """
+    global backend, _module
+    selected = (backend, _module)
+    try:
+        for path in paths:
+            print('{} ({:.1f} MB)'.format(path, os.path.getsize(path) / (1024.0 * 1024)))
+            for name in _LIBRARIES:
+                module = _import(name)
+                if module is None:
+                    continue
+                backend, _module = name, module
+                load_t = dump_t = float('inf')
+                for _ in range(repeat):
+                    start = time.time()
+                    obj = load(path)
+                    load_t = min(load_t, time.time() - start)
+                    start = time.time()
+                    dumps(obj, indent = 2, separators = (',', ': '), deterministic = False)
+                    dump_t = min(dump_t, time.time() - start)
+                print('  {:10} load {:7.3f}s  dump {:7.3f}s'.format(name, load_t, dump_t))
+    finally:
+        backend, _module = selected
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: python3 -m p4c_src.jsonio FILE...', file=sys.stderr)
+        sys.exit(2)
+    _benchmark(sys.argv[1:])
@@ -23,7 +23,6 @@ import argparse
 import glob
 import os
 import sys
-import re
 
 import p4c_src.config as config
 import p4c_src
@@ -45,6 +44,124 @@ def display_supported_targets(cfg):
         ret += str(target) + "\n"
     return ret
 
+def parse_early_options(args = None):
+    """
+    Parse the options needed before the configuration is loaded: the version
+    and the (target, arch) tuple. Returns None if the command line can not be
+    parsed, in which case the full parser reports the error.
+    """
+    parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False,
+                                     exit_on_error=False)
+    parser.add_argument("-V", "--version", dest="show_version",
+                        action="store_true", default=False)
+    parser.add_argument("-b", "--target", dest="target",
+                        action="store", default="tofino")
+    parser.add_argument("-a", "--arch", dest="arch",
+                        action="store", default="default")
+    parser.add_argument("-v", "--debug", dest="debug",
+                        action="store_true", default=False)
+    add_server_options(parser)
+    add_batch_options(parser)
+    add_profile_options(parser)
+    try:
+        opts, _ = parser.parse_known_args(args)
+    except argparse.ArgumentError:
+        return None
+    set_default_target(opts)
+    return opts
+
+def add_server_options(parser):
+    parser.add_argument("--server", dest="server",
+                        help="Run a compile server, that accepts compile requests "
+                        "on a Unix domain socket until interrupted.",
+                        action="store_true", default=False)
+    parser.add_argument("--socket", dest="socket", metavar="PATH",
+                        help="Socket of the compile server. With --server, where to listen "
+                        "(default $P4C_SERVER_SOCKET or bf-p4c.sock in $XDG_RUNTIME_DIR); "
+                        "otherwise, submit the compilation to the server listening there. "
+                        "If $P4C_SERVER_SOCKET is set, compilations are submitted to it "
+                        "when a server is running.",
+                        action="store", default=None)
+    parser.add_argument("--server-jobs", dest="server_jobs", metavar="N", type=int,
+                        help="Number of compilations the server runs concurrently "
+                        "(default: the number of CPUs).",
+                        action="store", default=os.cpu_count() or 1)
+
+def add_batch_options(parser):
+    parser.add_argument("--batch", dest="batch", metavar="JOBS",
+                        help="Compile the programs listed in the JSON file JOBS, each with "
+                        "its own target, architecture, flags and output directory.",
+                        action="store", default=None)
+    parser.add_argument("--batch-jobs", dest="batch_jobs", metavar="N", type=int,
+                        help="Number of programs compiled concurrently by --batch "
+                        "(default: the number of CPUs).",
+                        action="store", default=os.cpu_count() or 1)
+    parser.add_argument("--keep-going", dest="keep_going",
+                        help="With --batch, compile all programs even if some fail.",
+                        action="store_true", default=False)
+
+def add_profile_options(parser):
+    from p4c_src.profiling import DEFAULT_PROFILE, DEFAULT_INTERVAL_MS
+    parser.add_argument("--profile-driver", dest="profile_driver", metavar="FILE",
+                        help="Profile the driver with cProfile, writing the statistics to "
+                        "FILE (default {}) and the sampled stacks of all its threads, "
+                        "including the time spent waiting for commands, to FILE.folded "
+                        "for flame graphs.".format(DEFAULT_PROFILE),
+                        action="store", nargs="?", const=DEFAULT_PROFILE, default=None)
+    parser.add_argument("--profile-interval", dest="profile_interval", metavar="MS", type=int,
+                        help="Sampling interval of --profile-driver in milliseconds, "
+                        "0 to disable sampling (default: {}).".format(DEFAULT_INTERVAL_MS),
+                        action="store", default=DEFAULT_INTERVAL_MS)
+
+def set_default_target(opts):
+    user_defined_target = os.environ.get('P4C_DEFAULT_TARGET')
+    if user_defined_target != None:
+        opts.target = user_defined_target
+
+    user_defined_arch = os.environ.get('P4C_DEFAULT_ARCH')
+    if user_defined_arch != None:
+        opts.arch = user_defined_arch
+
+def parse_options(parser, args = None, environment = True):
+    """
+    Parse args (default sys.argv). If environment is set, the P4C_DEFAULT_*
+    environment variables override the language, target and architecture.
+    """
+    opts = parser.parse_args(args)
+
+    user_defined_version = os.environ.get('P4C_DEFAULT_VERSION')
+    if environment and user_defined_version != None:
+        opts.language = user_defined_version
+    # accept multiple ways of specifying which language, and ensure that it is a consistent
+    # string from now on.
+    if opts.language == "p4_14": opts.language = "p4-14"
+    if opts.language == "p4_16": opts.language = "p4-16"
+
+    if environment:
+        set_default_target(opts)
+    return opts
+
+def find_backend(cfg, target, arch):
+    """
+    Return the backend registered for target-arch, or None
+    """
+    import re
+    for backend in cfg.target:
+        regex = backend._backend.replace('*', '[a-zA-Z0-9*]*')
+        pattern = re.compile(regex)
+        if (pattern.match(target + '-' + arch)):
+            return backend
+    return None
+
+def instantiate_backend(backend, parser):
+    """
+    Construct a backend registered with config.add_target. Configuration
+    files may also register backend instances, which are returned as is.
+    """
+    if isinstance(backend, config.TargetDescriptor):
+        return backend.instantiate(parser)
+    return backend
+
 def add_developer_options(parser):
     parser.add_argument("-T", dest="log_levels",
                         action="append", default=[],
@@ -65,7 +182,73 @@ def add_developer_options(parser):
                         help="Pretty-print the program in the specified file.")
 
 def main():
-    parser = argparse.ArgumentParser(conflict_handler='resolve')
+    early_opts = parse_early_options()
+    if early_opts is not None:
+        # deal with the version before loading any backend
+        if early_opts.show_version:
+            print("p4c", get_version())
+            sys.exit(0)
+
+        if early_opts.server:
+            from p4c_src import server
+            socket_path = early_opts.socket or server.default_socket_path()
+            sys.exit(server.serve(socket_path, max(1, early_opts.server_jobs),
+                                  verbose = early_opts.debug))
+
+        if early_opts.batch is not None:
+            from p4c_src.batch import run_batch
+            sys.exit(run_batch(early_opts.batch, early_opts.batch_jobs,
+                               keep_going = early_opts.keep_going, verbose = early_opts.debug))
+
+        socket_path = early_opts.socket or os.environ.get('P4C_SERVER_SOCKET')
+        if socket_path:
+            from p4c_src import server
+            rc = server.submit(socket_path, sys.argv[1:],
+                               verbose = early_opts.socket is not None or early_opts.debug)
+            if rc is not None:
+                sys.exit(rc)
+            # no server, compile here
+
+    compile_main(early_opts)
+
+def compile_main(early_opts):
+    """
+    Run the driver for the command line in sys.argv, and exit with its return
+    code. early_opts are the options returned by parse_early_options.
+    """
+    if early_opts is not None and early_opts.profile_driver is not None:
+        from p4c_src.profiling import profiled
+        rc = profiled(early_opts.profile_driver, early_opts.profile_interval,
+                      run_driver, early_opts)
+    else:
+        rc = run_driver(early_opts)
+    sys.exit(rc)
+
+def run_driver(early_opts):
+    """
+    Run the driver for the command line in sys.argv. Returns the exit code.
+    """
+    from p4c_src.driver import DriverError
+    try:
+        parser = build_parser()
+        cfg = load_config(parser)
+        if early_opts is not None and ',' in early_opts.target:
+            from p4c_src.fanout import run_targets
+            rc = run_targets(parser, cfg, early_opts)
+        else:
+            opts, backend = select_backend(parser, cfg, early_opts = early_opts)
+            rc = run_backend(backend, opts)
+    except DriverError as e:
+        if e.message is not None:
+            print(e.message, file=sys.stderr)
+        rc = e.returncode
+    return rc
+
+def build_parser(parser_class = argparse.ArgumentParser):
+    """
+    Return a parser for the options common to all backends
+    """
+    parser = parser_class(conflict_handler='resolve')
     parser.add_argument("-V", "--version", dest="show_version",
                         help="show version and exit",
                         action="store_true", default=False)
@@ -92,7 +275,8 @@ def main():
                         help="Pass <arg> to the linker",
                         action="append", default=[])
     parser.add_argument("-b", "--target", dest="target",
-                        help="specify target device",
+                        help="specify target device, or a comma separated list "
+                             "of devices to compile for all of them",
                         action="store", default="tofino")
     parser.add_argument("-a", "--arch", dest="arch",
                         help="specify target architecture",
@@ -168,66 +352,87 @@ def main():
                             "when it can inline the subparser's states only once for multiple"
                             "invocations of the same subparser instance.",
                         action="store_true", default=False)
+    parser.add_argument("--step-logs", dest="step_logs", metavar="DIR",
+                        help="Also write the output of the commands of each step to "
+                        "DIR/<step>.log (default $P4C_STEP_LOGS).",
+                        action="store", default=None)
+    parser.add_argument("--step-log-size", dest="step_log_size", metavar="MB",
+                        help="Keep at most the first and last MB/2 of the output "
+                        "in each step log (default 16).",
+                        action="store", default=16, type=int)
 
     if (os.environ['P4C_BUILD_TYPE'] == "DEVELOPER"):
         add_developer_options(parser)
 
+    add_server_options(parser)
+    add_batch_options(parser)
+    add_profile_options(parser)
+
     parser.add_argument("source_file", nargs='?', help="Files to compile", default=None)
+    return parser
 
-    # load supported configuration.
-    # We load these before we parse options, so that backends can register
-    # proprietary options
+def load_config(parser):
+    """
+    Load the backend configuration files.
+    We load these before we parse options, so that backends can register
+    proprietary options
+    """
     cfg_files = glob.glob("{}/*.cfg".format(os.environ['P4C_CFG_PATH']))
     cfg = config.Config(config_prefix = "p4c")
     for cf in cfg_files:
         cfg.load_from_config(cf, parser)
+    return cfg
 
-    # parse the arguments
-    opts = parser.parse_args()
-
-    user_defined_version = os.environ.get('P4C_DEFAULT_VERSION')
-    if user_defined_version != None:
-        opts.language = user_defined_version
-    # accept multiple ways of specifying which language, and ensure that it is a consistent
-    # string from now on.
-    if opts.language == "p4_14": opts.language = "p4-14"
-    if opts.language == "p4_16": opts.language = "p4-16"
-
-    user_defined_target = os.environ.get('P4C_DEFAULT_TARGET')
-    if user_defined_target != None:
-        opts.target = user_defined_target
+def select_backend(parser, cfg, args = None, early_opts = None, environment = True):
+    """
+    Construct the backend selected by args (default sys.argv) and parse them.
+    early_opts, if not None, holds the target and arch guessed before parsing.
+    Returns (opts, backend). Usage errors are reported through parser.error.
+    """
+    # Only the selected backend is constructed, and hence registers its options
+    backend = None
+    if early_opts is not None:
+        backend = find_backend(cfg, early_opts.target, early_opts.arch)
+        if backend is not None:
+            backend = instantiate_backend(backend, parser)
 
-    user_defined_arch = os.environ.get('P4C_DEFAULT_ARCH')
-    if user_defined_arch != None:
-        opts.arch = user_defined_arch
+    # parse the arguments
+    opts = parse_options(parser, args, environment)
 
     # deal with early exits
+    from p4c_src.driver import DriverExit
     if opts.show_version:
         print("p4c", get_version())
-        sys.exit(0)
+        raise DriverExit()
 
     if opts.show_target_help:
         print(display_supported_targets(cfg))
-        sys.exit(0)
+        raise DriverExit()
 
     # check that the tuple value is correct
-    backend = (opts.target, opts.arch)
-    if (len(backend) != 2):
+    target_arch = (opts.target, opts.arch)
+    if (len(target_arch) != 2):
         parser.error("Invalid target and arch tuple: {}\n{}".\
-                     format(backend, display_supported_targets(cfg)))
+                     format(target_arch, display_supported_targets(cfg)))
 
-    # find the backend
-    backend = None
-    for target in cfg.target:
-        regex = target._backend.replace('*', '[a-zA-Z0-9*]*')
-        pattern = re.compile(regex)
-        if (pattern.match(opts.target + '-' + opts.arch)):
-            backend = target
-            break
+    # find the backend, unless the early options already selected it
+    if early_opts is None or (early_opts.target, early_opts.arch) != target_arch:
+        backend = find_backend(cfg, opts.target, opts.arch)
+        if backend is not None:
+            # reparse, now that the backend has registered its options
+            backend = instantiate_backend(backend, parser)
+            opts = parse_options(parser, args, environment)
     if backend == None:
         parser.error("Unknown backend: {}-{}".format(str(opts.target),
                                                      str(opts.arch)))
 
+    check_input(parser, opts, backend)
+    return opts, backend
+
+def check_input(parser, opts, backend):
+    """
+    Check that the input file exists, unless only help is requested
+    """
     # When using --help-* options, we don't necessarily need to pass an input file
     # However, by default the driver checks the input and fails if it does not exist.
     # In that case we set source to dummy.p4 so sanity checking works. Backend can
@@ -251,12 +456,18 @@ def main():
             opts.source_file = opts.json_source
 
     if checkInput and not os.path.isfile(opts.source_file):
-        print('Input file {} does not exist'.format(opts.source_file),
-              file = sys.stderr)
-        sys.exit(1)
-
-    # set all configuration and command line options for backend
-    backend.process_command_line_options(opts)
-    # run all commands
-    rc = backend.run()
-    sys.exit(rc)
+        from p4c_src.driver import DriverError
+        raise DriverError('Input file {} does not exist'.format(opts.source_file))
+
+def run_backend(backend, opts):
+    """
+    Configure backend with opts and run all its commands. Returns the exit code.
+    Errors that end the compilation early are raised as DriverError.
+    """
+    try:
+        # set all configuration and command line options for backend
+        backend.process_command_line_options(opts)
+        # run all commands
+        return backend.run()
+    finally:
+        backend.cleanup()
@@ -0,0 +1,101 @@
+# Copyright 2013-2021 Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials,
+# and your use of them is governed by the express license under which they
+# were provided to you ("License"). Unless the License provides otherwise,
+# you may not use, modify, copy, publish, distribute, disclose or transmit this
+# software or the related documents without Intel's prior written permission.
+#
+# This software and the related documents are provided as is, with no
+# express or implied warranties, other than those that are expressly stated
+# in the License.
+
+"""
+The manifest of a compilation.
+
+The compiler writes manifest.json, and the driver then adds the status of
+the compilation, the outputs of the assembler and summary logging, and its
+timings. The manifest is loaded once, when the compiler is done, and
+updated in memory. It is written back only when a tool is about to read it
+(summary logging, the manifest verifier, the cache and the archiver) and
+when the compilation ends, to a new file that replaces the manifest, as
+tools may be reading it concurrently.
+"""
+
+import contextlib
+import os
+import threading
+
+from p4c_src import jsonio
+
+class PipeInfo(object):
+    """
+    A pipe of the program, and the paths of its outputs
+    """
+    __slots__ = ('pipe_id', 'pipe_name', 'pipe_dir', 'context', 'resources', 'graph',
+                 'phv_json', 'power_json', 'source')
+
+    def __init__(self, pipe_id, pipe_name = None, pipe_dir = None, context = None):
+        self.pipe_id = pipe_id
+        self.pipe_name = pipe_name
+        self.pipe_dir = pipe_dir
+        self.context = context
+        self.resources = None
+        self.graph = None
+        self.phv_json = None
+        self.power_json = None
+        self.source = None
+
+    @property
+    def name(self):
+        return self.pipe_name if self.pipe_name is not None else str(self.pipe_id)
+
+    def __repr__(self):
+        return 'PipeInfo({})'.format(', '.join('{}={!r}'.format(s, getattr(self, s))
+                                               for s in self.__slots__
+                                               if getattr(self, s) is not None))
+
+class Manifest(object):
+    """
+    manifest.json, loaded once and updated in memory
+    """
+    def __init__(self, path, compact = False):
+        self.path = path
+        self.compact = compact
+        self.tree = None
+        self._dirty = False
+        self._lock = threading.RLock()
+
+    @property
+    def loaded(self):
+        return self.tree is not None
+
+    def load(self):
+        """
+        Read the manifest. Raises OSError or ValueError.
+        """
+        with self._lock:
+            self.tree = jsonio.load(self.path)
+            self._dirty = False
+            return self.tree
+
+    @contextlib.contextmanager
+    def edit(self):
+        """
+        Lock the loaded manifest, to update the tree it yields
+        """
+        with self._lock:
+            yield self.tree
+            self._dirty = True
+
+    def flush(self):
+        """
+        Write the manifest if it changed since it was loaded or last written
+        """
+        with self._lock:
+            if self.tree is None or not self._dirty:
+                return
+            tmp = self.path + '.tmp'
+            jsonio.dump(self.tree, tmp, **jsonio.layout(self.compact))
+            os.replace(tmp, self.path)
+            self._dirty = False
@@ -0,0 +1,107 @@
+# Copyright 2013-2021 Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials,
+# and your use of them is governed by the express license under which they
+# were provided to you ("License"). Unless the License provides otherwise,
+# you may not use, modify, copy, publish, distribute, disclose or transmit this
+# software or the related documents without Intel's prior written permission.
+#
+# This software and the related documents are provided as is, with no
+# express or implied warranties, other than those that are expressly stated
+# in the License.
+
+"""
+Profiling of the driver itself (--profile-driver[=FILE]).
+
+The driver runs under cProfile, and the statistics are written to FILE
+(default bf-p4c.prof), to be read with pstats or snakeviz. cProfile only
+sees the main thread and the CPU time of the driver.
+
+Unless --profile-interval is 0, the stacks of all the threads are also
+sampled every --profile-interval milliseconds, whatever they are doing,
+so the time spent waiting for the compiler and the other commands, and
+the steps run by worker threads (--post-jobs), is accounted as well. The
+samples are written to FILE.folded in the collapsed stack format of
+flamegraph.pl and speedscope: one line per distinct stack, the frames from
+the thread name down to the innermost function separated by ';', followed
+by the number of samples.
+"""
+
+import os
+import sys
+import threading
+
+DEFAULT_PROFILE = 'bf-p4c.prof'
+DEFAULT_INTERVAL_MS = 5
+
+class StackSampler(object):
+    """
+    Sample the stacks of all the threads of the process
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.samples = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target = self._run, name = 'profiler', daemon = True)
+
+    @staticmethod
+    def _frame_name(frame):
+        code = frame.f_code
+        return '{}:{}'.format(os.path.basename(code.co_filename), code.co_name)
+
+    def _sample(self):
+        names = { t.ident: t.name for t in threading.enumerate() }
+        me = threading.get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._frame_name(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, 'thread-{}'.format(ident)))
+            key = ';'.join(reversed(stack))
+            self.samples[key] = self.samples.get(key, 0) + 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.samples.items()):
+                f.write('{} {}\n'.format(stack, count))
+
+def profiled(output, interval_ms, func, *args):
+    """
+    Return func(*args), profiling it into output (and output.folded)
+    """
+    import cProfile
+    profiler = cProfile.Profile()
+    sampler = None
+    if interval_ms > 0:
+        sampler = StackSampler(interval_ms / 1000.0)
+        sampler.start()
+    profiler.enable()
+    try:
+        return func(*args)
+    finally:
+        profiler.disable()
+        outputs = [output]
+        if sampler is not None:
+            sampler.stop()
+        try:
+            profiler.dump_stats(output)
+            if sampler is not None:
+                sampler.write(output + '.folded')
+                outputs.append(output + '.folded')
+            print("driver profile written to {}".format(' and '.join(outputs)), file=sys.stderr)
+        except OSError as e:
+            print("can not write the driver profile {}: {}".format(output, e), file=sys.stderr)
@@ -0,0 +1,303 @@
+# Copyright 2013-2021 Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials,
+# and your use of them is governed by the express license under which they
+# were provided to you ("License"). Unless the License provides otherwise,
+# you may not use, modify, copy, publish, distribute, disclose or transmit this
+# software or the related documents without Intel's prior written permission.
+#
+# This software and the related documents are provided as is, with no
+# express or implied warranties, other than those that are expressly stated
+# in the License.
+
+"""
+Speculative compilation (--race).
+
+'--race quick-phv-alloc,default' runs the compiler once per strategy,
+concurrently. A strategy is 'default', the compiler command as is, or a
+'+' separated list of compiler options without their leading dashes, e.g.
+'quick-phv-alloc+parser-bandwidth-opt'. Strategy <name> writes to
+<output_dir>/.race/<name>, with its output captured in <name>.log there.
+
+The first strategy that exits successfully with a manifest wins: the
+others are killed, and its outputs, schemas and log are moved in place.
+If all strategies fail, the first one listed is reported.
+
+The time saved is measured against the time 'default' takes to compile the
+program alone: the time it took in this race if it completed, otherwise
+the time it took the last time it completed, recorded per (source, target,
+arch) in race-history.json in the cache directory. Without either, the time
+saved is not known, and is left out of the summary.
+"""
+
+import fcntl
+import json
+import os
+import shutil
+import signal
+import subprocess
+import threading
+import time
+
+from p4c_src.driver import command_argv, command_line, current_step, wait_process
+
+RACE_DIR = '.race'
+_HISTORY_FILE = 'race-history.json'
+
+# compiler options that write files outside the output directory
+_FILE_OPTIONS = ('--bf-rt-schema', '--p4runtime-file', '--p4runtime-files')
+
+def race_dir(output_dir, strategy):
+    return os.path.join(output_dir, RACE_DIR, strategy)
+
+def default_history_file():
+    from p4c_src.cache import default_cache_dir
+    return os.path.join(default_cache_dir(), _HISTORY_FILE)
+
+def strategy_options(strategy):
+    if strategy == 'default':
+        return []
+    return ['--' + o for o in strategy.split('+') if o]
+
+def race_command(cmd, output_dir, strategy):
+    """
+    Return the compiler command cmd rewritten for strategy, writing all its
+    outputs to its scratch directory, and the map from the scratch files to
+    the files the compilation is expected to write
+    """
+    scratch = race_dir(output_dir, strategy)
+    files = {}
+    race_cmd = []
+    args = iter(cmd)
+    for arg in args:
+        option = arg.split(' ', 1)
+        if arg == '-o':
+            race_cmd += [arg, scratch]
+            next(args, None)
+        elif len(option) == 2 and option[0] in _FILE_OPTIONS:
+            paths = []
+            for path in option[1].split(','):
+                scratch_path = os.path.join(scratch, 'race-{}-{}'.format(len(files),
+                                                                          os.path.basename(path)))
+                files[scratch_path] = path
+                paths.append(scratch_path)
+            race_cmd.append('{} {}'.format(option[0], ','.join(paths)))
+        else:
+            race_cmd.append(arg)
+    return race_cmd + strategy_options(strategy), files
+
+class DurationHistory(object):
+    """
+    Time the default strategy took to compile, per (source, target, arch)
+    """
+    def __init__(self, history_file):
+        self.history_file = history_file
+
+    @staticmethod
+    def key(source, target, arch):
+        return json.dumps([os.path.abspath(source), target, arch])
+
+    def _load(self):
+        try:
+            with open(self.history_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def elapsed(self, key):
+        return self._load().get(key)
+
+    def record(self, key, elapsed):
+        try:
+            os.makedirs(os.path.dirname(self.history_file), exist_ok = True)
+            with open(self.history_file + '.lock', 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                history = self._load()
+                history[key] = elapsed
+                tmp = '{}.{}.tmp'.format(self.history_file, os.getpid())
+                with open(tmp, 'w') as f:
+                    json.dump(history, f, indent=2, sort_keys=True)
+                os.replace(tmp, self.history_file)
+        except OSError:
+            pass   # the history is only a hint
+
+class Contender(object):
+    def __init__(self, strategy, cmd, files, log):
+        self.strategy = strategy
+        self.cmd = cmd
+        self.files = files
+        self.log = log
+        self.process = None
+        self.returncode = None
+        self.status = 'pending'   # running, done, failed, killed
+        self.start = None
+        self.end = None
+
+    @property
+    def elapsed(self):
+        if self.start is None or self.end is None:
+            return None
+        return self.end - self.start
+
+class Race(object):
+    """
+    Run the contenders concurrently, and keep the first that succeeds
+    """
+    def __init__(self, contenders, output_dir, verbose = False, default_elapsed = None):
+        self.contenders = contenders
+        self.output_dir = output_dir
+        self.verbose = verbose
+        # the time 'default' took the last time it completed, if known
+        self.recorded_default_elapsed = default_elapsed
+        self.winner = None
+        self.start = None
+        self.end = None
+        self._cond = threading.Condition()
+
+    def _succeeded(self, contender):
+        scratch = race_dir(self.output_dir, contender.strategy)
+        return contender.returncode == 0 and \
+               os.path.isfile(os.path.join(scratch, 'manifest.json'))
+
+    def _wait(self, contender, step):
+        contender.returncode = wait_process(contender.process, step)
+        with self._cond:
+            contender.end = time.time()
+            if contender.status == 'running':
+                contender.status = 'done' if self._succeeded(contender) else 'failed'
+            self._cond.notify_all()
+
+    def _kill(self, contender):
+        contender.status = 'killed'
+        try:
+            os.killpg(contender.process.pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    def run(self):
+        """
+        Returns the return code of the winner, or of the first contender if
+        none succeeded
+        """
+        self.start = time.time()
+        step = current_step()
+        threads = []
+        for c in self.contenders:
+            os.makedirs(race_dir(self.output_dir, c.strategy), exist_ok = True)
+            if self.verbose:
+                print('running {}'.format(command_line(c.cmd)))
+            with open(c.log, 'w') as log:
+                try:
+                    c.process = subprocess.Popen(command_argv(c.cmd), stdout = log,
+                                                 stderr = subprocess.STDOUT,
+                                                 start_new_session = True)
+                except OSError as e:
+                    log.write("error invoking {}: {}\n".format(command_line(c.cmd), e))
+                    c.status = 'failed'
+                    c.returncode = 1
+                    continue
+            c.status = 'running'
+            c.start = time.time()
+            t = threading.Thread(target = self._wait, args = (c, step), daemon = True)
+            t.start()
+            threads.append(t)
+
+        try:
+            with self._cond:
+                while True:
+                    self.winner = next((c for c in self.contenders if c.status == 'done'), None)
+                    if self.winner is not None or \
+                       not any(c.status == 'running' for c in self.contenders):
+                        break
+                    self._cond.wait()
+                if self.winner is not None:
+                    for c in self.contenders:
+                        if c.status == 'running':
+                            self._kill(c)
+        except BaseException:
+            for c in self.contenders:
+                if c.status == 'running':
+                    self._kill(c)
+            raise
+        finally:
+            for t in threads:
+                t.join()
+            self.end = time.time()
+
+        return self.report().returncode
+
+    def report(self):
+        """
+        The contender whose outputs are kept
+        """
+        return self.winner or self.contenders[0]
+
+    def completed_default(self):
+        """
+        The 'default' contender if it compiled successfully
+        """
+        return next((c for c in self.contenders
+                     if c.strategy == 'default' and c.status == 'done'), None)
+
+    def default_elapsed(self):
+        """
+        The time 'default' takes to compile, None if not known
+        """
+        default = self.completed_default()
+        if default is not None:
+            return default.elapsed
+        return self.recorded_default_elapsed
+
+    def time_saved(self):
+        """
+        The time saved compared to compiling with 'default' alone, None if
+        not known
+        """
+        default_elapsed = self.default_elapsed()
+        if self.winner is None or default_elapsed is None:
+            return None
+        return max(0.0, default_elapsed - self.winner.elapsed)
+
+    def summary(self):
+        """
+        The description of the race recorded in the manifest
+        """
+        summary = { 'winner': None if self.winner is None else self.winner.strategy,
+                    'elapsed': self.end - self.start,
+                    'strategies': [ { 'strategy': c.strategy,
+                                      'status': c.status,
+                                      'returncode': c.returncode,
+                                      'elapsed': c.elapsed,
+                                      'elapsed_is_lower_bound': c.status == 'killed' }
+                                    for c in self.contenders ] }
+        time_saved = self.time_saved()
+        if time_saved is not None:
+            summary['default_elapsed'] = self.default_elapsed()
+            summary['time_saved'] = time_saved
+        return summary
+
+def _move(src, dst):
+    if os.path.isdir(dst) and not os.path.islink(dst):
+        shutil.rmtree(dst)
+    elif os.path.lexists(dst):
+        os.unlink(dst)
+    os.replace(src, dst)
+
+def keep_outputs(output_dir, contender):
+    """
+    Move the outputs of contender to their place
+    """
+    scratch = race_dir(output_dir, contender.strategy)
+    for scratch_path, path in contender.files.items():
+        if os.path.exists(scratch_path):
+            dirname = os.path.dirname(path)
+            if dirname:
+                os.makedirs(dirname, exist_ok = True)
+            shutil.move(scratch_path, path)
+    for entry in os.listdir(scratch):
+        if entry == os.path.basename(contender.log):
+            continue
+        _move(os.path.join(scratch, entry), os.path.join(output_dir, entry))
+
+def remove_race(output_dir):
+    shutil.rmtree(os.path.join(output_dir, RACE_DIR), ignore_errors = True)
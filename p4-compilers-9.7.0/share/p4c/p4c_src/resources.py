@@ -0,0 +1,157 @@
+# Copyright 2013-2021 Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials,
+# and your use of them is governed by the express license under which they
+# were provided to you ("License"). Unless the License provides otherwise,
+# you may not use, modify, copy, publish, distribute, disclose or transmit this
+# software or the related documents without Intel's prior written permission.
+#
+# This software and the related documents are provided as is, with no
+# express or implied warranties, other than those that are expressly stated
+# in the License.
+
+"""
+Merge of the deparser resources generated by the assembler into the
+resources.json generated by the compiler.
+
+resources.json can be tens of MB, while the deparser resources are a few
+KB. Instead of loading and dumping the whole document, the deparser node is
+spliced in as the first member of the "resources" object: the file is
+scanned only up to that object, and the rest is copied as is. The node is
+replaced if the merge is done again (e.g. when a compilation is resumed).
+
+With --defer-resources-merge the driver does not merge: resources.json is
+left as the compiler wrote it and resources_deparser.json is kept next to
+it. Consumers call load_resources(), which merges in memory when needed.
+"""
+
+import json
+import mmap
+import os
+import re
+import shutil
+
+from p4c_src import jsonio
+
+DEPARSER_FILE = 'resources_deparser.json'
+
+# strings (which may contain braces) and the structural characters of JSON
+_TOKEN = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"|[{}\[\]:,]')
+_WHITESPACE = b' \t\r\n'
+_DEPARSER_KEY = b'"deparser"'
+_COPY_SIZE = 1 << 20
+
+def deparser_file(resources_file):
+    return os.path.join(os.path.dirname(resources_file), DEPARSER_FILE)
+
+def _skip_whitespace(data, pos):
+    while pos < len(data) and data[pos] in _WHITESPACE:
+        pos += 1
+    return pos
+
+def _resources_object(data):
+    """
+    Return the offset just after the '{' opening the top level "resources"
+    object, or None
+    """
+    depth = 0
+    previous = None
+    key = None
+    for m in _TOKEN.finditer(data):
+        token = m.group()
+        if token in (b'{', b'['):
+            if token == b'{' and depth == 1 and previous == b':' and key == b'"resources"':
+                return m.end()
+            depth += 1
+        elif token in (b'}', b']'):
+            depth -= 1
+            if depth == 0:
+                return None
+        elif token[0:1] == b'"' and depth == 1 and previous in (b'{', b','):
+            key = token
+        previous = token
+    return None
+
+def _spliced_deparser(data, pos):
+    """
+    If the "resources" object starting at pos starts with a deparser node,
+    return the offset of its end, including the separator. Otherwise return pos.
+    """
+    start = _skip_whitespace(data, pos)
+    if data[start:start + len(_DEPARSER_KEY)] != _DEPARSER_KEY:
+        return pos
+    value = _skip_whitespace(data, start + len(_DEPARSER_KEY))
+    if data[value:value + 1] != b':':
+        return pos
+    value = _skip_whitespace(data, value + 1)
+    # the node is small, decode it from a growing window
+    size = 1 << 16
+    while True:
+        window = data[value:value + size]
+        try:
+            _, consumed = json.JSONDecoder().raw_decode(window.decode('utf-8'))
+            break
+        except (ValueError, UnicodeDecodeError):
+            if value + size >= len(data):
+                return pos
+            size *= 4
+    end = value + len(window.decode('utf-8')[:consumed].encode('utf-8'))
+    separator = _skip_whitespace(data, end)
+    if data[separator:separator + 1] == b',':
+        end = separator + 1
+    return end
+
+def splice_deparser(resources_file, deparser_data):
+    """
+    Add deparser_data as resources.deparser in resources_file, without
+    loading it. Returns False if the file does not have the expected
+    structure, in which case it is left untouched.
+    """
+    with open(resources_file, 'rb') as src:
+        if os.fstat(src.fileno()).st_size == 0:
+            return False
+        with mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            pos = _resources_object(data)
+            if pos is None:
+                return False
+            end = _spliced_deparser(data, pos)
+            following = data[_skip_whitespace(data, end):_skip_whitespace(data, end) + 1]
+            # indented as the member that follows
+            indent = data[pos:_skip_whitespace(data, pos)]
+            node = indent + b'"deparser": ' + jsonio.dumps(deparser_data).encode('utf-8')
+            if following != b'}':
+                node += b','
+            tmp = resources_file + '.tmp'
+            with open(tmp, 'wb') as dst:
+                dst.write(data[:pos])
+                dst.write(node)
+                src.seek(end)
+                shutil.copyfileobj(src, dst, _COPY_SIZE)
+    os.replace(tmp, resources_file)
+    return True
+
+def merge_deparser(resources_file, deparser_json, compact = False):
+    """
+    Merge the deparser resources in deparser_json into resources_file. The
+    spliced node is always compact, compact applies when the file is rewritten.
+    """
+    deparser_data = jsonio.load(deparser_json)
+    if splice_deparser(resources_file, deparser_data):
+        return
+    # not the layout generated by the compiler, merge in memory
+    resources_data = jsonio.load(resources_file)
+    resources_data["resources"]["deparser"] = deparser_data
+    jsonio.dump(resources_data, resources_file, **jsonio.layout(compact))
+
+def load_resources(resources_file):
+    """
+    Load resources_file, with the deparser resources merged if the merge
+    was deferred
+    """
+    resources_data = jsonio.load(resources_file)
+    try:
+        deparser_data = jsonio.load(deparser_file(resources_file))
+    except (OSError, ValueError):
+        return resources_data
+    resources_data.setdefault("resources", {})["deparser"] = deparser_data
+    return resources_data
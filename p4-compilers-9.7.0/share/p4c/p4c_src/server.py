@@ -0,0 +1,544 @@
+# Copyright 2013-2021 Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials,
+# and your use of them is governed by the express license under which they
+# were provided to you ("License"). Unless the License provides otherwise,
+# you may not use, modify, copy, publish, distribute, disclose or transmit this
+# software or the related documents without Intel's prior written permission.
+#
+# This software and the related documents are provided as is, with no
+# express or implied warranties, other than those that are expressly stated
+# in the License.
+
+"""
+Compile server for bf-p4c.
+
+'bf-p4c --server' keeps the driver, its configuration and the resolved tool
+paths loaded, and accepts compile requests on a Unix domain socket. Each
+request is run in a child forked from the fork server, a single threaded
+process forked from the server once it is warm and before it starts any
+thread, so children start warm, never inherit locks held by the threads of
+the server, and cannot leak state (working directory, environment,
+sys.exit) into it. Requests are scheduled on a bounded pool of workers;
+identical requests (same argv, working directory and environment) that
+arrive while one is in flight share its output and exit code.
+
+Requests run with the environment of the client, so the socket is only
+accessible to the user running the server (mode 0600), and connections from
+other users are refused; the client likewise only talks to a server run by
+its own user.
+
+Messages in both directions are frames of a one byte kind, a 4 byte big
+endian payload length and the payload:
+  R - request, JSON {argv, cwd, env, version, bin_dir}
+  O - data written by the compile to stdout
+  E - data written by the compile to stderr
+  X - exit code of the compile, as a decimal string
+  ! - the server refused the request; the client runs the compile itself
+The server sends the fork server F frames, JSON {argv, cwd, env}, with the
+stdout, stderr and exit status pipes of the compile attached.
+"""
+
+import json
+import os
+import socket
+import socketserver
+import struct
+import sys
+import threading
+
+_HEADER = struct.Struct('!cI')
+
+def default_socket_path():
+    """
+    Return the socket path: $P4C_SERVER_SOCKET, or bf-p4c.sock in the user's
+    runtime directory
+    """
+    path = os.environ.get('P4C_SERVER_SOCKET')
+    if path:
+        return path
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'bf-p4c.sock')
+    return '/tmp/bf-p4c-{}.sock'.format(os.getuid())
+
+def send_frame(sock, kind, payload):
+    sock.sendall(_HEADER.pack(kind, len(payload)) + payload)
+
+def _recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+def recv_frame(sock):
+    """
+    Return (kind, payload), or (None, None) if the peer closed the connection
+    """
+    header = _recv_exactly(sock, _HEADER.size)
+    if header is None:
+        return None, None
+    kind, size = _HEADER.unpack(header)
+    payload = _recv_exactly(sock, size)
+    if payload is None:
+        return None, None
+    return kind, payload
+
+def _exit_code(code):
+    """
+    Map a SystemExit code to a process exit status, the way the interpreter does
+    """
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code & 0xff
+    print(code, file=sys.stderr)
+    return 1
+
+def _peer_uid(sock):
+    """
+    Return the uid of the process at the other end of the Unix socket sock
+    """
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    _, uid, _ = struct.unpack('3i', creds)
+    return uid
+
+def _server_identity():
+    from p4c_src.main import get_version
+    return get_version(), os.environ.get('P4C_BIN_DIR')
+
+################################################################################
+# Client
+################################################################################
+
+def submit(socket_path, argv, verbose = False):
+    """
+    Run the compile described by argv on the server listening on socket_path,
+    forwarding its output to our stdout and stderr.
+
+    Returns the exit code of the compile, or None if there is no server or the
+    server refused the request, in which case the caller compiles locally.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError as e:
+        if verbose:
+            print("bf-p4c: no compile server at {}: {}".format(socket_path, e), file=sys.stderr)
+        sock.close()
+        return None
+    if _peer_uid(sock) != os.getuid():
+        # our environment is sent along with the request
+        print("bf-p4c: the compile server at {} is run by another user".format(socket_path),
+              file=sys.stderr)
+        sock.close()
+        return None
+
+    version, bin_dir = _server_identity()
+    request = { 'argv': list(argv),
+                'cwd': os.getcwd(),
+                'env': dict(os.environ),
+                'version': version,
+                'bin_dir': bin_dir }
+    out = { b'O': sys.stdout, b'E': sys.stderr }
+    try:
+        send_frame(sock, b'R', json.dumps(request).encode('utf-8'))
+        while True:
+            kind, payload = recv_frame(sock)
+            if kind is None:
+                print("bf-p4c: lost connection to the compile server", file=sys.stderr)
+                return 1
+            if kind in out:
+                stream = out[kind]
+                stream.flush()
+                stream.buffer.write(payload)
+                stream.buffer.flush()
+            elif kind == b'X':
+                return int(payload)
+            elif kind == b'!':
+                if verbose:
+                    print("bf-p4c: compile server refused the request: {}".format(
+                        payload.decode('utf-8', 'replace')), file=sys.stderr)
+                return None
+    except OSError as e:
+        print("bf-p4c: compile server error: {}".format(e), file=sys.stderr)
+        return 1
+    finally:
+        sock.close()
+
+################################################################################
+# Server
+################################################################################
+
+class CompileJob(object):
+    """
+    A request being compiled, and the output it produced so far.
+
+    Clients subscribe by reading frames from index 0; frames are kept until
+    the job completes, so a client deduplicated onto a running job still
+    receives all of its output.
+    """
+    def __init__(self, key, request, fork_server):
+        self.key = key
+        self.request = request
+        self._fork_server = fork_server
+        self._frames = []
+        self._done = False
+        self._cond = threading.Condition()
+
+    def emit(self, kind, payload, last = False):
+        with self._cond:
+            self._frames.append((kind, payload))
+            self._done = self._done or last
+            self._cond.notify_all()
+
+    def frames(self, start):
+        """
+        Wait for frames after start. Returns (frames, done).
+        """
+        with self._cond:
+            while start >= len(self._frames) and not self._done:
+                self._cond.wait()
+            return self._frames[start:], self._done
+
+    def run(self):
+        """
+        Have the fork server run the compile, and stream its output
+        """
+        import selectors
+        request = self.request
+        out_r, out_w = os.pipe()
+        err_r, err_w = os.pipe()
+        status_r, status_w = os.pipe()
+        try:
+            self._fork_server.fork(request['argv'], request['cwd'], request['env'],
+                                   out_w, err_w, status_w)
+        except BaseException:
+            for fd in (out_r, err_r, status_r):
+                os.close(fd)
+            raise
+        finally:
+            for fd in (out_w, err_w, status_w):
+                os.close(fd)
+
+        sel = selectors.DefaultSelector()
+        sel.register(out_r, selectors.EVENT_READ, b'O')
+        sel.register(err_r, selectors.EVENT_READ, b'E')
+        open_fds = 2
+        while open_fds:
+            for key, _ in sel.select():
+                data = os.read(key.fd, 65536)
+                if data:
+                    self.emit(key.data, data)
+                else:
+                    sel.unregister(key.fd)
+                    os.close(key.fd)
+                    open_fds -= 1
+        sel.close()
+
+        status = b''
+        while True:
+            data = os.read(status_r, 64)
+            if not data:
+                break
+            status += data
+        os.close(status_r)
+        if not status:
+            self.emit(b'E', b"bf-p4c server: the compile did not report its exit code\n")
+            status = b'1'
+        self.emit(b'X', status, last = True)
+
+def _exit_status(status):
+    rc = os.waitstatus_to_exitcode(status)
+    return 128 - rc if rc < 0 else rc
+
+def fork_driver(argv, out_fd, err_fd, cwd = None, env = None, new_group = False):
+    """
+    Fork a child that runs the driver for the command line argv (without the
+    program name), with stdout and stderr redirected to out_fd and err_fd.
+    The child runs in cwd, with the environment env, if they are given, and
+    in a new process group if new_group is set. Returns the pid of the child.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid != 0:
+        return pid
+
+    rc = 1
+    try:
+        if new_group:
+            os.setpgid(0, 0)
+        os.dup2(out_fd, 1)
+        os.dup2(err_fd, 2)
+        # Drop everything inherited from the parent: the listening socket,
+        # client connections and, most importantly, the pipes of children
+        # forked concurrently, whose readers would otherwise wait for us to exit.
+        os.closerange(3, os.sysconf('SC_OPEN_MAX'))
+        if cwd is not None:
+            os.chdir(cwd)
+        if env is not None:
+            os.environ.clear()
+            os.environ.update(env)
+        # the compile runs here, it must not be submitted to a server
+        os.environ.pop('P4C_SERVER_SOCKET', None)
+        sys.argv = [sys.argv[0]] + list(argv)
+
+        from p4c_src.main import compile_main, parse_early_options
+        try:
+            compile_main(parse_early_options())
+            rc = 0
+        except SystemExit as e:
+            rc = _exit_code(e.code)
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(rc)
+
+class ForkServer(object):
+    """
+    A single threaded child of the server that forks the compiles for it.
+
+    It must be started before the server starts any thread: a child forked
+    from a multithreaded process inherits the locks held by the other
+    threads (in malloc, stdio, logging, ...) without the threads that would
+    release them. Each compile is forked from a monitor process, which waits
+    for it and writes its exit code to the status pipe of the request.
+    """
+    def __init__(self):
+        self._sock, child_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.pid = os.fork()
+        if self.pid == 0:
+            self._sock.close()
+            _fork_server_main(child_sock)
+        child_sock.close()
+        self._lock = threading.Lock()
+
+    def fork(self, argv, cwd, env, out_fd, err_fd, status_fd):
+        """
+        Run the driver for argv in cwd with the environment env, its stdout
+        and stderr redirected to out_fd and err_fd. Its exit code is written
+        to status_fd. Raises OSError if the fork server is gone.
+        """
+        payload = json.dumps({ 'argv': argv, 'cwd': cwd, 'env': env }).encode('utf-8')
+        with self._lock:
+            socket.send_fds(self._sock, [_HEADER.pack(b'F', len(payload))],
+                            [out_fd, err_fd, status_fd])
+            self._sock.sendall(payload)
+
+    def close(self):
+        self._sock.close()
+        os.waitpid(self.pid, 0)
+
+def _fork_server_main(sock):
+    """
+    The loop of the fork server, which exits when the server closes sock
+    """
+    import signal
+    # the monitors are reaped by the kernel
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    try:
+        while True:
+            header, fds, _, _ = socket.recv_fds(sock, _HEADER.size, 3)
+            if not header:
+                break
+            rest = _recv_exactly(sock, _HEADER.size - len(header)) if len(header) < _HEADER.size \
+                   else b''
+            kind, size = _HEADER.unpack(header + rest)
+            payload = _recv_exactly(sock, size)
+            if payload is None or kind != b'F' or len(fds) != 3:
+                break
+            if os.fork() == 0:
+                sock.close()
+                _monitor(json.loads(payload.decode('utf-8')), *fds)
+            for fd in fds:
+                os.close(fd)
+    except (KeyboardInterrupt, OSError):
+        pass
+    finally:
+        os._exit(0)
+
+def _monitor(request, out_fd, err_fd, status_fd):
+    """
+    Run the compile described by request and write its exit code to status_fd
+    """
+    import signal
+    try:
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        pid = fork_driver(request['argv'], out_fd, err_fd, request['cwd'], request['env'])
+        os.close(out_fd)
+        os.close(err_fd)
+        _, status = os.waitpid(pid, 0)
+        os.write(status_fd, str(_exit_status(status)).encode('ascii'))
+    finally:
+        os._exit(0)
+
+class CompileServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, jobs, fork_server, verbose = False):
+        import concurrent.futures
+        self.jobs = jobs
+        self.fork_server = fork_server
+        self.verbose = verbose
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers = jobs)
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._identity = _server_identity()
+        socketserver.UnixStreamServer.__init__(self, socket_path, CompileRequestHandler)
+
+    def server_bind(self):
+        # no window where others could connect: create the socket 0600
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+        os.chmod(self.server_address, 0o600)
+
+    def log(self, msg):
+        if self.verbose:
+            print("bf-p4c server: {}".format(msg), file=sys.stderr)
+
+    def check_request(self, request):
+        """
+        Return why the request can not be served by this server, or None
+        """
+        version, bin_dir = self._identity
+        if request.get('version') != version or request.get('bin_dir') != bin_dir:
+            return "server runs bf-p4c {} from {}".format(version, bin_dir)
+        return None
+
+    def submit(self, request):
+        """
+        Return the job compiling request, starting it unless an identical
+        request is already in flight
+        """
+        key = json.dumps([request['argv'], request['cwd'], request['env']], sort_keys = True)
+        with self._lock:
+            job = self._inflight.get(key)
+            if job is not None:
+                self.log("joining in flight request {}".format(request['argv']))
+                return job
+            job = CompileJob(key, request, self.fork_server)
+            self._inflight[key] = job
+        self.log("compiling {} in {}".format(request['argv'], request['cwd']))
+        self._executor.submit(self._run, job)
+        return job
+
+    def _run(self, job):
+        try:
+            job.run()
+        except BaseException as e:
+            job.emit(b'E', "bf-p4c server: {}\n".format(e).encode('utf-8'))
+            job.emit(b'X', b'1', last = True)
+        finally:
+            with self._lock:
+                del self._inflight[job.key]
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        self._executor.shutdown(wait = False)
+
+class CompileRequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        uid = _peer_uid(self.request)
+        if uid != os.getuid():
+            self.server.log("refused a connection from uid {}".format(uid))
+            send_frame(self.request, b'!', "the server runs as another user".encode('utf-8'))
+            return
+        kind, payload = recv_frame(self.request)
+        if kind != b'R':
+            return
+        try:
+            request = json.loads(payload.decode('utf-8'))
+        except ValueError as e:
+            send_frame(self.request, b'!', "bad request: {}".format(e).encode('utf-8'))
+            return
+        reason = self.server.check_request(request)
+        if reason is not None:
+            send_frame(self.request, b'!', reason.encode('utf-8'))
+            return
+
+        job = self.server.submit(request)
+        start = 0
+        done = False
+        try:
+            while not done:
+                frames, done = job.frames(start)
+                start += len(frames)
+                for kind, payload in frames:
+                    send_frame(self.request, kind, payload)
+        except OSError:
+            # the client went away; the job keeps running for other clients
+            pass
+
+def _warm_up():
+    """
+    Load what every compile needs, so that forked children inherit it
+    """
+    import argparse
+    import glob
+    import p4c_src.barefoot as bfn
+    import p4c_src.config as config
+    from p4c_src.util import find_bin
+
+    parser = argparse.ArgumentParser(conflict_handler='resolve')
+    cfg = config.Config(config_prefix = "p4c")
+    for cf in glob.glob("{}/*.cfg".format(os.environ['P4C_CFG_PATH'])):
+        cfg.load_from_config(cf, parser)
+    bfn.findTools()
+    find_bin('cc')
+
+def serve(socket_path, jobs, verbose = False):
+    """
+    Run the compile server until interrupted. Returns the exit code.
+    """
+    import signal
+
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+            print("bf-p4c: a compile server is already listening on {}".format(socket_path),
+                  file=sys.stderr)
+            return 1
+        except OSError:
+            # stale socket of a server that did not shut down cleanly
+            os.unlink(socket_path)
+        finally:
+            probe.close()
+
+    _warm_up()
+    # before any thread is started
+    fork_server = ForkServer()
+    try:
+        server = CompileServer(socket_path, jobs, fork_server, verbose)
+    except BaseException:
+        fork_server.close()
+        raise
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print("bf-p4c: compile server listening on {} with {} workers".format(socket_path, jobs),
+          file=sys.stderr)
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.server_close()
+        fork_server.close()
+        try:
+            os.unlink(socket_path)
+        except OSError:
+            pass
+    return 0
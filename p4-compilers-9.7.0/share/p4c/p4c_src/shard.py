@@ -0,0 +1,140 @@
+# Copyright 2013-2021 Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials,
+# and your use of them is governed by the express license under which they
+# were provided to you ("License"). Unless the License provides otherwise,
+# you may not use, modify, copy, publish, distribute, disclose or transmit this
+# software or the related documents without Intel's prior written permission.
+#
+# This software and the related documents are provided as is, with no
+# express or implied warranties, other than those that are expressly stated
+# in the License.
+
+"""
+Pipe sharded compilation (--shard-pipes).
+
+The pipes of a program are compiled independently by the backend, so the
+compiler is run once per pipe, each instance skipping all other pipes with
+--skip-compilation. Shard <pipe> writes to <output_dir>/.shards/<pipe>.
+Only the first shard generates the runtime schemas (BF-RT and P4Runtime),
+which do not depend on the backend.
+
+--skip-compilation skips the pipes whose name contains one of the names it
+is given. A pipe whose name contains the name of another pipe would be
+skipped by its own shard (pipe10 by the shard skipping pipe1), so such
+programs are not sharded.
+
+Once all shards are done, the outputs are merged into the output directory:
+the first shard provides the program wide outputs, every shard its own pipe
+directory, and manifest.json lists each pipe as described by the shard
+that compiled it.
+"""
+
+import os
+import shutil
+
+from p4c_src import jsonio
+
+SHARDS_DIR = '.shards'
+
+# compiler options that write the runtime schemas; only the first shard keeps them
+_SCHEMA_OPTIONS = ('--bf-rt-schema ', '--p4runtime-file ', '--p4runtime-files ',
+                   '--p4runtime-format ')
+
+def shard_dir(output_dir, pipe):
+    return os.path.join(output_dir, SHARDS_DIR, pipe)
+
+def previous_pipes(output_dir):
+    """
+    Return the names of the pipes in the manifest left by a previous
+    compilation in output_dir, or an empty list
+    """
+    try:
+        manifest = jsonio.load(os.path.join(output_dir, 'manifest.json'))
+        return [p['pipe_name'] for p in manifest['programs'][0]['pipes']]
+    except (OSError, ValueError, KeyError, IndexError, TypeError):
+        return []
+
+def overlapping_pipes(pipes, skipped):
+    """
+    Return the pipes, out of pipes, that their shard would skip: those
+    whose name contains the name of another pipe, or of a pipe in skipped
+    """
+    names = set(pipes) | set(skipped)
+    return [p for p in pipes if any(n != p and n in p for n in names)]
+
+def shard_command(cmd, output_dir, pipe, pipes, skipped, first):
+    """
+    Return the compiler command cmd rewritten to compile only pipe, out of
+    pipes, into its shard directory. skipped are the pipes the user asked
+    to skip. Only the first shard generates the runtime schemas.
+    """
+    skip = [p for p in pipes if p != pipe] + [p for p in skipped if p not in pipes]
+    shard = []
+    args = iter(cmd)
+    for arg in args:
+        if arg == '-o':
+            shard += [arg, shard_dir(output_dir, pipe)]
+            next(args, None)
+        elif arg.startswith('--skip-compilation='):
+            continue
+        elif not first and arg.startswith(_SCHEMA_OPTIONS):
+            continue
+        else:
+            shard.append(arg)
+    return shard + ['--skip-compilation={}'.format(','.join(skip))]
+
+def _move(src, dst):
+    if os.path.isdir(dst) and not os.path.islink(dst):
+        shutil.rmtree(dst)
+    elif os.path.lexists(dst):
+        os.unlink(dst)
+    os.replace(src, dst)
+
+def merge_shards(output_dir, pipes, compact = False):
+    """
+    Merge the outputs of the shards compiling pipes into output_dir.
+    Returns False if there is nothing to merge (the first shard did not
+    produce a manifest), in which case output_dir is left untouched.
+    """
+    first = shard_dir(output_dir, pipes[0])
+    try:
+        manifest = jsonio.load(os.path.join(first, 'manifest.json'))
+    except (OSError, ValueError):
+        return False
+
+    # program wide outputs from the first shard, pipe outputs from their shard
+    for entry in os.listdir(first):
+        if entry == 'manifest.json' or (entry in pipes and entry != pipes[0]):
+            continue
+        _move(os.path.join(first, entry), os.path.join(output_dir, entry))
+    for pipe in pipes[1:]:
+        src = os.path.join(shard_dir(output_dir, pipe), pipe)
+        if os.path.exists(src):
+            _move(src, os.path.join(output_dir, pipe))
+
+    # and describe each pipe as the shard that compiled it did
+    try:
+        merged = manifest['programs'][0]['pipes']
+    except (KeyError, IndexError, TypeError):
+        merged = []
+    for i, entry in enumerate(merged):
+        pipe = entry.get('pipe_name')
+        if pipe not in pipes[1:]:
+            continue
+        try:
+            shard_manifest = jsonio.load(os.path.join(shard_dir(output_dir, pipe),
+                                                      'manifest.json'))
+            for shard_entry in shard_manifest['programs'][0]['pipes']:
+                if shard_entry.get('pipe_name') == pipe:
+                    merged[i] = shard_entry
+        except (OSError, ValueError, KeyError, IndexError, TypeError):
+            pass   # the shard failed, keep the pipe as skipped
+
+    manifest_file = os.path.join(output_dir, 'manifest.json')
+    jsonio.dump(manifest, manifest_file + '.tmp', **jsonio.layout(compact))
+    os.replace(manifest_file + '.tmp', manifest_file)
+    return True
+
+def remove_shards(output_dir):
+    shutil.rmtree(os.path.join(output_dir, SHARDS_DIR), ignore_errors = True)
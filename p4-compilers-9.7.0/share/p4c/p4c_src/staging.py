@@ -0,0 +1,118 @@
+# Copyright 2013-2021 Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials,
+# and your use of them is governed by the express license under which they
+# were provided to you ("License"). Unless the License provides otherwise,
+# you may not use, modify, copy, publish, distribute, disclose or transmit this
+# software or the related documents without Intel's prior written permission.
+#
+# This software and the related documents are provided as is, with no
+# express or implied warranties, other than those that are expressly stated
+# in the License.
+
+"""
+Staging of the outputs (--staging-dir).
+
+The compiler, the assembler and the tools that run after them write many
+small files, which is slow on network filesystems. With --staging-dir, the
+whole compilation writes to a scratch directory, by default in /dev/shm
+when it has room, and the outputs are published to the output directory
+when it ends, successfully or not.
+
+Publishing copies the outputs in bulk to a directory next to the outputs,
+on the same filesystem, then renames each of them in place, the manifest
+last, so that a manifest is only published once all the outputs it lists
+are in place. When the scratch directory is on the same filesystem as the
+output directory, the outputs are renamed directly.
+
+Publishing is not atomic. A file at the top of the output directory is
+replaced by a single rename, so readers see either its previous or its new
+version, but a directory there (the pipes, logs, ...) can not be renamed
+over: the previous one is moved aside first, and the directory is missing
+until the new one is renamed in place. Readers should wait for the
+manifest.
+"""
+
+import os
+import shutil
+import tempfile
+
+DEFAULT_ROOT = '/dev/shm'
+# free space required to stage in the default directory
+MIN_FREE = 1 << 30
+
+def staging_root(requested):
+    """
+    Return the directory to create the staging directory in, or None.
+    requested is the directory given to --staging-dir, or '' for the
+    default: $P4C_STAGING_DIR, or /dev/shm if it has MIN_FREE bytes free.
+    """
+    root = requested or os.environ.get('P4C_STAGING_DIR') or DEFAULT_ROOT
+    try:
+        free = shutil.disk_usage(root).free
+    except OSError:
+        return None
+    if not os.access(root, os.W_OK):
+        return None
+    if not requested and root == DEFAULT_ROOT and free < MIN_FREE:
+        return None
+    return root
+
+def create(root, output_dir):
+    """
+    Create a staging directory for output_dir in root. The caller removes
+    it with remove once the compilation ended, if it was not published:
+    compiles forked by the compile server and batch end with os._exit,
+    which does not run atexit handlers.
+    """
+    name = os.path.basename(os.path.abspath(output_dir))
+    return tempfile.mkdtemp(prefix = 'bf-p4c-{}-'.format(name), dir = root)
+
+def remove(staging_dir):
+    shutil.rmtree(staging_dir, ignore_errors = True)
+
+def published_path(path, staging_dir, output_dir):
+    """
+    Return the path that path in staging_dir has once published to output_dir
+    """
+    if path is None:
+        return None
+    relative = os.path.relpath(os.path.abspath(path), staging_dir)
+    if relative == os.curdir:
+        return output_dir
+    if relative.startswith(os.pardir + os.sep) or relative == os.pardir:
+        return path
+    return os.path.join(output_dir, relative)
+
+def publish(staging_dir, output_dir):
+    """
+    Move the contents of staging_dir to output_dir, entry by entry, and
+    remove staging_dir. Raises OSError.
+    """
+    os.makedirs(output_dir, exist_ok = True)
+    if os.stat(staging_dir).st_dev == os.stat(output_dir).st_dev:
+        source = staging_dir
+    else:
+        source = tempfile.mkdtemp(prefix = '.publish-', dir = output_dir)
+    replaced = tempfile.mkdtemp(prefix = '.replaced-', dir = output_dir)
+    try:
+        if source != staging_dir:
+            for entry in os.listdir(staging_dir):
+                src = os.path.join(staging_dir, entry)
+                if os.path.isdir(src) and not os.path.islink(src):
+                    shutil.copytree(src, os.path.join(source, entry), symlinks = True)
+                else:
+                    shutil.copy2(src, os.path.join(source, entry), follow_symlinks = False)
+        # the manifest last, once the outputs it lists are in place
+        for entry in sorted(os.listdir(source), key = lambda e: e == 'manifest.json'):
+            src = os.path.join(source, entry)
+            dst = os.path.join(output_dir, entry)
+            if os.path.lexists(dst) and (os.path.isdir(dst) or os.path.isdir(src)):
+                # a directory can not be replaced atomically, move it away first
+                os.rename(dst, os.path.join(replaced, entry))
+            os.replace(src, dst)
+    finally:
+        shutil.rmtree(replaced, ignore_errors = True)
+        if source != staging_dir:
+            shutil.rmtree(source, ignore_errors = True)
+    shutil.rmtree(staging_dir, ignore_errors = True)
@@ -12,7 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import inspect
+import atexit
+import functools
 import os
 import sys
 
@@ -21,18 +22,131 @@ def get_script_dir(follow_symlinks=True):
     if getattr(sys, 'frozen', False): # py2exe, PyInstaller, cx_Freeze
         path = os.path.abspath(sys.executable)
     else:
+        import inspect
         path = inspect.getabsfile(get_script_dir)
     if follow_symlinks:
         path = os.path.realpath(path)
     return os.path.dirname(path)
 
+class DirectoryIndex(object):
+    """
+    Directory listings used by the executable and configuration lookups.
+
+    Listings are memoized for the life of the process. If a path is given, the
+    listings are also persisted in that file and reused by later processes as
+    long as the modification time of the directory did not change.
+    """
+
+    def __init__(self, path = None):
+        self._path = path
+        self._dirs = {}
+        self._dirty = False
+        if path is not None:
+            import json
+            try:
+                with open(path) as f:
+                    self._dirs = json.load(f)
+            except (OSError, ValueError):
+                self._dirs = {}
+            atexit.register(self.save)
+
+    def listdir(self, directory):
+        """
+        Return the files and the directories to descend into, as os.walk
+        would, or None if directory can not be read
+        """
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            return None
+        entry = self._dirs.get(directory)
+        if entry is not None and entry[0] == mtime:
+            return entry[1], entry[2]
+
+        files = []
+        dirs = []
+        try:
+            with os.scandir(directory) as it:
+                for e in it:
+                    try:
+                        is_dir = e.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if not is_dir:
+                        files.append(e.name)
+                    elif not e.is_symlink():
+                        dirs.append(e.name)
+        except OSError:
+            return None
+        self._dirs[directory] = [mtime, files, dirs]
+        self._dirty = True
+        return files, dirs
+
+    def walk(self, top):
+        """
+        Top-down walk of top, yielding (root, files)
+        """
+        listing = self.listdir(top)
+        if listing is None:
+            return
+        files, dirs = listing
+        yield top, files
+        for d in dirs:
+            for res in self.walk(os.path.join(top, d)):
+                yield res
+
+    def save(self):
+        if self._path is None or not self._dirty:
+            return
+        import json
+        try:
+            tmp = "{}.{}".format(self._path, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(self._dirs, f)
+            os.replace(tmp, self._path)
+            self._dirty = False
+        except OSError:
+            pass
+
+_directory_index = None
+
+def directory_index():
+    """
+    The directory index of this process, persistent if $P4C_LOOKUP_INDEX names a file
+    """
+    global _directory_index
+    if _directory_index is None:
+        _directory_index = DirectoryIndex(os.environ.get('P4C_LOOKUP_INDEX') or None)
+    return _directory_index
+
+def _memoize_found(lookup):
+    """
+    Memoize the paths lookup finds, for the life of the process (the compile
+    server runs for days): lookups that found nothing are retried, and
+    paths that were removed since are looked up again
+    """
+    found = {}
+
+    @functools.wraps(lookup)
+    def memoized(*args):
+        path = found.get(args)
+        if path is None or not os.path.exists(path):
+            path = lookup(*args)
+            if path is None:
+                found.pop(args, None)
+            else:
+                found[args] = path
+        return path
+    memoized.cache_clear = found.clear
+    return memoized
+
 # recursive find, good for developer
+@_memoize_found
 def rec_find_bin(cwd, exe):
     found = None
-    for root, dirs, files in os.walk(cwd):
-        for f in files:
-            if f == exe:
-                return os.path.join(root, f)
+    for root, files in directory_index().walk(cwd):
+        if exe in files:
+            return os.path.join(root, exe)
     cwd = os.path.abspath(os.path.join(cwd, os.pardir))
     if cwd != "/":
         found = rec_find_bin(cwd, exe)
@@ -48,15 +162,25 @@ def getLocalCfg(config):
     """
     return use_rec_find(config)
 
+@_memoize_found
+def _find_bin(exe, path):
+    # The last PATH entry whose tree contains exe wins, so search backwards
+    # and stop at the first entry that has it
+    index = directory_index()
+    for pp in reversed(path.split(':')):
+        listing = index.listdir(pp)
+        if listing is None:
+            continue
+        if exe in listing[0]:
+            return os.path.join(pp, exe)
+        for root, files in index.walk(pp):
+            if exe in files:
+                return os.path.join(pp, exe)
+    return None
+
 # top-down find, good for deployment
 def find_bin(exe):
-    found_path = None
-    for pp in os.environ['PATH'].split(':'):
-        for root, dirs, files in os.walk(pp):
-            for ff in files:
-                if ff == exe:
-                    found_path = os.path.join(pp, ff)
-    return found_path
+    return _find_bin(exe, os.environ['PATH'])
 
 def find_file(directory, filename, binary=True):
     """
@@ -92,5 +216,5 @@ def find_file(directory, filename, binary=True):
                 if check_file(executable): return executable
 
         dir = os.path.dirname(dir)
-    print('File {} not found'.format(filename))
-    sys.exit(1)
+    from p4c_src.driver import DriverError
+    raise DriverError('File {} not found'.format(filename))
@@ -0,0 +1,93 @@
+# Copyright 2013-2021 Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials,
+# and your use of them is governed by the express license under which they
+# were provided to you ("License"). Unless the License provides otherwise,
+# you may not use, modify, copy, publish, distribute, disclose or transmit this
+# software or the related documents without Intel's prior written permission.
+#
+# This software and the related documents are provided as is, with no
+# express or implied warranties, other than those that are expressly stated
+# in the License.
+
+import json
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+from unittest import mock
+
+from p4c_src import admission
+from p4c_src.admission import AdmissionControl
+
+GB = 1 << 30
+
+class AdmissionTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.dir = os.path.join(self.tmp, 'admission')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _state(self):
+        with open(os.path.join(self.dir, 'admission.json')) as f:
+            return json.load(f)
+
+    def test_state_shared_by_all_users(self):
+        a = AdmissionControl(self.dir, GB)
+        a.acquire()
+        self.assertEqual(stat.S_IMODE(os.stat(self.dir).st_mode), 0o1777)
+        self.assertEqual(stat.S_IMODE(os.stat(a.state_file).st_mode), 0o666)
+        a.release()
+
+    def test_threads_of_one_driver_hold_a_ticket_each(self):
+        a = AdmissionControl(self.dir, GB)
+        b = AdmissionControl(self.dir, GB)
+        with mock.patch.object(admission, '_meminfo', return_value = 4 * GB), \
+             mock.patch.object(admission, '_tree_rss', return_value = {}):
+            a.acquire()
+            b.acquire()
+        self.assertNotEqual(a.ticket, b.ticket)
+        self.assertEqual(len(self._state()['admitted']), 2)
+        a.release()
+        self.assertEqual([e['ticket'] for e in self._state()['admitted']], [b.ticket])
+        b.release()
+        self.assertEqual(self._state()['admitted'], [])
+
+    def test_rss_of_a_driver_counted_once(self):
+        # two compilers of this driver reserved 2 GB each and use 3 GB in total:
+        # 1 GB of their reservations is not allocated yet
+        held = [AdmissionControl(self.dir, 2 * GB), AdmissionControl(self.dir, 2 * GB)]
+        with mock.patch.object(admission, '_meminfo', return_value = 8 * GB), \
+             mock.patch.object(admission, '_tree_rss', return_value = {}):
+            for a in held:
+                a.acquire()
+        rss = { os.getpid(): 3 * GB }
+        with mock.patch.object(admission, '_tree_rss', return_value = rss):
+            with mock.patch.object(admission, '_meminfo', return_value = 3 * GB):
+                c = AdmissionControl(self.dir, 2 * GB)
+                c._update(c._enqueue)
+                self.assertIsNone(c._update(c._try_admit))
+                c.release()
+            with mock.patch.object(admission, '_meminfo', return_value = 3 * GB - 1):
+                c = AdmissionControl(self.dir, 2 * GB)
+                c._update(c._enqueue)
+                self.assertIsNotNone(c._update(c._try_admit))
+                c.release()
+        for a in held:
+            a.release()
+
+    def test_waiting_in_arrival_order(self):
+        a = AdmissionControl(self.dir, GB)
+        b = AdmissionControl(self.dir, GB)
+        a._update(a._enqueue)
+        b._update(b._enqueue)
+        self.assertEqual(b._update(b._try_admit), "1 compilations ahead")
+        self.assertIsNone(a._update(a._try_admit))
+        a.release()
+        b.release()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+# Copyright 2013-2021 Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials,
+# and your use of them is governed by the express license under which they
+# were provided to you ("License"). Unless the License provides otherwise,
+# you may not use, modify, copy, publish, distribute, disclose or transmit this
+# software or the related documents without Intel's prior written permission.
+#
+# This software and the related documents are provided as is, with no
+# express or implied warranties, other than those that are expressly stated
+# in the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from p4c_src.cache import CacheKey, CompileCache
+
+def _key(*values):
+    key = CacheKey()
+    for i, v in enumerate(values):
+        key.add_string(str(i), v)
+    return key.hexdigest()
+
+class CacheKeyTest(unittest.TestCase):
+    def test_tagged_and_length_prefixed(self):
+        self.assertEqual(_key('a', 'b'), _key('a', 'b'))
+        self.assertNotEqual(_key('a', 'b'), _key('b', 'a'))
+        self.assertNotEqual(_key('ab', ''), _key('a', 'b'))
+
+    def test_file_contents(self):
+        with tempfile.NamedTemporaryFile('w', delete = False) as f:
+            f.write('control c() {}')
+        try:
+            k1 = CacheKey()
+            k1.add_file('source', f.name)
+            with open(f.name, 'a') as g:
+                g.write(' ')
+            k2 = CacheKey()
+            k2.add_file('source', f.name)
+            self.assertNotEqual(k1.hexdigest(), k2.hexdigest())
+        finally:
+            os.unlink(f.name)
+
+class CompileCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache = CompileCache(os.path.join(self.tmp, 'cache'), 1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _output(self, name, size = 100):
+        out = os.path.join(self.tmp, name)
+        os.makedirs(os.path.join(out, 'pipe'))
+        with open(os.path.join(out, 'pipe', 'tofino.bin'), 'wb') as f:
+            f.write(b'x' * size)
+        with open(os.path.join(out, 'manifest.json'), 'w') as f:
+            f.write(name)
+        return out
+
+    def test_miss_then_hit(self):
+        key = _key('t.p4')
+        restored = os.path.join(self.tmp, 'restored')
+        self.assertFalse(self.cache.lookup(key, restored))
+        self.cache.store(key, self._output('out'), { 'source': 't.p4' })
+        self.assertTrue(self.cache.lookup(key, restored))
+        with open(os.path.join(restored, 'manifest.json')) as f:
+            self.assertEqual(f.read(), 'out')
+        self.assertTrue(os.path.isfile(os.path.join(restored, 'pipe', 'tofino.bin')))
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['stores']), (1, 1, 1))
+
+    def test_store_keeps_the_first_entry(self):
+        key = _key('t.p4')
+        self.cache.store(key, self._output('first'), {})
+        self.cache.store(key, self._output('second'), {})
+        restored = os.path.join(self.tmp, 'restored')
+        self.assertTrue(self.cache.lookup(key, restored))
+        with open(os.path.join(restored, 'manifest.json')) as f:
+            self.assertEqual(f.read(), 'first')
+
+    def test_evicts_the_least_recently_used(self):
+        keys = [_key(name) for name in ('a', 'b', 'c')]
+        self.cache.max_size = 1 << 30
+        for i, key in enumerate(keys):
+            self.cache.store(key, self._output('out{}'.format(i), 10000), {})
+            meta = os.path.join(self.cache._entry_dir(key), 'meta.json')
+            os.utime(meta, (1000 + i, 1000 + i))
+        # a hit makes the oldest entry the most recently used
+        self.assertTrue(self.cache.lookup(keys[0], os.path.join(self.tmp, 'restored')))
+        self.cache.max_size = 25000
+        self.cache.evict()
+        self.assertTrue(os.path.isdir(self.cache._entry_dir(keys[0])))
+        self.assertFalse(os.path.isdir(self.cache._entry_dir(keys[1])))
+        self.assertTrue(os.path.isdir(self.cache._entry_dir(keys[2])))
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+# Copyright 2013-2021 Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials,
+# and your use of them is governed by the express license under which they
+# were provided to you ("License"). Unless the License provides otherwise,
+# you may not use, modify, copy, publish, distribute, disclose or transmit this
+# software or the related documents without Intel's prior written permission.
+#
+# This software and the related documents are provided as is, with no
+# express or implied warranties, other than those that are expressly stated
+# in the License.
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from p4c_src.capture import StepLog
+from p4c_src.driver import BackendDriver, Step, set_current_step
+
+def _printer(tag, lines):
+    # a list of arguments is taken as is, not split as a shell would
+    return [[sys.executable, '-c',
+             "import sys\nfor i in range({}):\n    sys.stdout.write('{} %d\\n' % i)\n"
+             "    sys.stdout.flush()".format(lines, tag)]]
+
+def _read(path):
+    with open(path) as f:
+        return f.read()
+
+class StepLogsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.driver = BackendDriver('tofino', 'tna')
+        self.driver._step_logs = self.tmp
+        self.driver._step_log_size = 1 << 20
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _run_concurrently(self, commands):
+        """
+        Run the commands, a list of (graph step, command name, command), each
+        in its own thread
+        """
+        rcs = {}
+        def run(step, name, cmd):
+            set_current_step(Step(step, None))
+            rcs[step, name] = self.driver.runCmd(name, cmd)
+        threads = [threading.Thread(target = run, args = c) for c in commands]
+        # the commands print to our stdout as well
+        with mock.patch('p4c_src.capture._echo'):
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.driver.closeStepLogs()
+        self.assertEqual(set(rcs.values()), {0})
+
+    def _expected(self, tag, lines):
+        return ''.join('{} {}\n'.format(tag, i) for i in range(lines))
+
+    def test_per_pipe_logs(self):
+        self._run_concurrently([('assembler:pipe0', 'assembler', _printer('pipe0', 2000)),
+                                ('assembler:pipe1', 'assembler', _printer('pipe1', 2000))])
+        self.assertEqual(sorted(os.listdir(self.tmp)),
+                         ['assembler.pipe0.log', 'assembler.pipe1.log'])
+        self.assertEqual(_read(os.path.join(self.tmp, 'assembler.pipe0.log')),
+                         self._expected('pipe0', 2000))
+        self.assertEqual(_read(os.path.join(self.tmp, 'assembler.pipe1.log')),
+                         self._expected('pipe1', 2000))
+
+    def test_concurrent_commands_share_a_log(self):
+        self._run_concurrently([('compiler', 'compiler', _printer('a', 2000)),
+                                ('other', 'compiler', _printer('b', 2000))])
+        lines = _read(os.path.join(self.tmp, 'compiler.log')).splitlines(True)
+        self.assertEqual(''.join(l for l in lines if l.startswith('a ')),
+                         self._expected('a', 2000))
+        self.assertEqual(''.join(l for l in lines if l.startswith('b ')),
+                         self._expected('b', 2000))
+
+    def test_size_capped_per_log(self):
+        self.driver._step_log_size = 1000
+        for tag in ('a', 'b', 'c'):
+            with mock.patch('p4c_src.capture._echo'):
+                self.assertEqual(self.driver.runCmd('verifier', _printer(tag, 1000)), 0)
+        self.driver.closeStepLogs()
+        log = _read(os.path.join(self.tmp, 'verifier.log'))
+        self.assertTrue(log.startswith('a 0\n'))
+        self.assertTrue(log.endswith('c 999\n'))
+        self.assertLess(len(log), 1100)
+
+class StepLogTest(unittest.TestCase):
+    def test_head_and_tail(self):
+        with tempfile.NamedTemporaryFile(delete = False) as f:
+            path = f.name
+        try:
+            log = StepLog(path, 10)
+            for i in range(10):
+                log.write(str(i).encode() * 3)
+            log.close()
+            log.close()
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), b'00011\n[... 20 bytes omitted ...]\n88999')
+        finally:
+            os.unlink(path)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+# Copyright 2013-2021 Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials,
+# and your use of them is governed by the express license under which they
+# were provided to you ("License"). Unless the License provides otherwise,
+# you may not use, modify, copy, publish, distribute, disclose or transmit this
+# software or the related documents without Intel's prior written permission.
+#
+# This software and the related documents are provided as is, with no
+# express or implied warranties, other than those that are expressly stated
+# in the License.
+
+import os
+import shutil
+import tempfile
+import types
+import unittest
+
+from p4c_src.barefoot import BarefootBackend
+from p4c_src.checkpoint import Checkpoint, ResumeError
+
+STAGES = ['compiler', 'assembler', 'p4c-gen-conf']
+
+class PlanTest(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.bfa = os.path.join(self.output_dir, 'pipe', 't.bfa')
+        os.makedirs(os.path.dirname(self.bfa))
+        with open(self.bfa, 'w') as f:
+            f.write('version: 1.0.0\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def _previous(self, *stages, key = 'k'):
+        """
+        Record a compilation with key in which stages completed
+        """
+        checkpoint = Checkpoint(self.output_dir, key)
+        checkpoint.begin([])
+        for stage in stages:
+            checkpoint.record(stage, [self.bfa] if stage == 'compiler' else [])
+
+    def test_resume_after_the_last_completed_stage(self):
+        self._previous('compiler', 'assembler')
+        self.assertEqual(Checkpoint(self.output_dir, 'k').plan(STAGES, ''),
+                         ['compiler', 'assembler'])
+
+    def test_resume_from_a_stage(self):
+        self._previous('compiler', 'assembler')
+        self.assertEqual(Checkpoint(self.output_dir, 'k').plan(STAGES, 'assembler'),
+                         ['compiler'])
+        self.assertEqual(Checkpoint(self.output_dir, 'k').plan(STAGES, 'preprocessor'), [])
+
+    def test_another_key_starts_over(self):
+        self._previous('compiler', 'assembler')
+        checkpoint = Checkpoint(self.output_dir, 'other')
+        self.assertIsNone(checkpoint.previous)
+        self.assertEqual(checkpoint.plan(STAGES, ''), [])
+        with self.assertRaises(ResumeError):
+            checkpoint.plan(STAGES, 'assembler')
+
+    def test_changed_outputs_are_not_reused(self):
+        self._previous('compiler', 'assembler')
+        with open(self.bfa, 'a') as f:
+            f.write('# edited\n')
+        checkpoint = Checkpoint(self.output_dir, 'k')
+        self.assertEqual(checkpoint.plan(STAGES, ''), [])
+        with self.assertRaises(ResumeError):
+            checkpoint.plan(STAGES, 'assembler')
+
+    def test_incomplete_stage(self):
+        self._previous('compiler')
+        with self.assertRaises(ResumeError):
+            Checkpoint(self.output_dir, 'k').plan(STAGES, 'p4c-gen-conf')
+
+    def test_unknown_stages(self):
+        checkpoint = Checkpoint(self.output_dir, 'k')
+        with self.assertRaises(ResumeError):
+            checkpoint.plan(STAGES, 'linker')
+        with self.assertRaises(ResumeError):
+            checkpoint.plan(STAGES, 'manifest-verifier')
+
+    def test_begin_keeps_the_skipped_stages(self):
+        self._previous('compiler', 'assembler')
+        checkpoint = Checkpoint(self.output_dir, 'k')
+        checkpoint.begin(checkpoint.plan(STAGES, 'assembler'))
+        self.assertEqual(Checkpoint(self.output_dir, 'k').plan(STAGES, ''), ['compiler'])
+
+class ResumedAssemblyTest(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_deparser_resources_from_the_checkpoint(self):
+        previous = Checkpoint(self.output_dir, 'k')
+        previous.begin([])
+        previous.record('assembler', deparser = { 'pipe0': { 'deparser': 1 } }, verified = True)
+        backend = types.SimpleNamespace(_checkpoint = Checkpoint(self.output_dir, 'k'))
+        pipe = types.SimpleNamespace(name = 'pipe0')
+        self.assertEqual(BarefootBackend.resumedAssembly(backend, pipe),
+                         { 'deparser': { 'deparser': 1 }, 'verified': True })
+
+    def test_summary_logging_skipped_without_incremental_assembly(self):
+        pipe = types.SimpleNamespace(name = 'pipe0', pipe_id = 0, context = 'ctx.json')
+        added = []
+        backend = types.SimpleNamespace(_verifier_rc = {}, _resume_skip = { 'summary_logging' },
+                                        _asm_skipped = {}, addSummaryLogs = added.append)
+        self.assertEqual(BarefootBackend.runPipeSummaryLogging(backend, pipe), 0)
+        self.assertEqual(added, [pipe])
+
+if __name__ == '__main__':
+    unittest.main()
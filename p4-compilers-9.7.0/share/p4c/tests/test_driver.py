@@ -0,0 +1,128 @@
+# Copyright 2013-2021 Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials,
+# and your use of them is governed by the express license under which they
+# were provided to you ("License"). Unless the License provides otherwise,
+# you may not use, modify, copy, publish, distribute, disclose or transmit this
+# software or the related documents without Intel's prior written permission.
+#
+# This software and the related documents are provided as is, with no
+# express or implied warranties, other than those that are expressly stated
+# in the License.
+
+import threading
+import unittest
+
+from p4c_src.driver import Step, StepGraph, command_argv, command_line
+
+class StepGraphTest(unittest.TestCase):
+    def setUp(self):
+        self.ran = []
+        self._lock = threading.Lock()
+
+    def action(self, name, rc = 0):
+        def run():
+            with self._lock:
+                self.ran.append(name)
+            return rc
+        return run
+
+    def step(self, name, rc = 0, **kwargs):
+        return Step(name, self.action(name, rc), **kwargs)
+
+    def test_added_order_with_one_job(self):
+        graph = StepGraph()
+        for name in ('a', 'b', 'c'):
+            graph.add(self.step(name))
+        graph.run()
+        self.assertEqual(self.ran, ['a', 'b', 'c'])
+        self.assertEqual(graph.rc(), 0)
+
+    def test_inputs_and_after_order_the_steps(self):
+        graph = StepGraph()
+        graph.add(self.step('assemble', inputs = ['bfa']))
+        graph.add(self.step('report', after = ['assemble']))
+        graph.add(self.step('compile', outputs = ['bfa']))
+        graph.run()
+        self.assertEqual(self.ran, ['compile', 'assemble', 'report'])
+        self.assertEqual([s.name for s in graph.dependencies(graph.get('assemble'))],
+                         ['compile'])
+
+    def test_failure_skips_the_dependent_steps(self):
+        graph = StepGraph()
+        graph.add(self.step('compile', rc = 2, outputs = ['bfa']))
+        graph.add(self.step('assemble', inputs = ['bfa'], outputs = ['bin']))
+        graph.add(self.step('archive', inputs = ['bin']))
+        graph.add(self.step('independent'))
+        graph.run()
+        self.assertEqual(self.ran, ['compile', 'independent'])
+        self.assertEqual(graph.get('assemble').state, 'skipped')
+        self.assertEqual(graph.get('archive').state, 'skipped')
+        self.assertEqual(graph.rc(), 2)
+
+    def test_always_runs_after_a_failure(self):
+        graph = StepGraph()
+        graph.add(self.step('compile', rc = 1, outputs = ['bfa']))
+        graph.add(self.step('assemble', inputs = ['bfa']))
+        graph.add(self.step('cleanup', after = ['compile', 'assemble'], always = True))
+        graph.run()
+        self.assertEqual(self.ran, ['compile', 'cleanup'])
+        self.assertEqual(graph.get('cleanup').state, 'done')
+
+    def test_steps_added_while_running(self):
+        graph = StepGraph()
+        def split():
+            for pipe in ('pipe0', 'pipe1'):
+                graph.add(self.step('assemble:' + pipe, inputs = ['manifest'],
+                                    outputs = ['bin:' + pipe]))
+            graph.add(self.step('conf', inputs = ['bin:pipe0', 'bin:pipe1']))
+            return 0
+        graph.add(Step('split', split, outputs = ['manifest']))
+        graph.run()
+        self.assertEqual(self.ran, ['assemble:pipe0', 'assemble:pipe1', 'conf'])
+
+    def test_concurrent_steps_respect_dependencies(self):
+        graph = StepGraph(jobs = 4)
+        graph.add(self.step('compile', outputs = ['bfa']))
+        for i in range(8):
+            graph.add(self.step('assemble{}'.format(i), inputs = ['bfa'], outputs = ['bin']))
+        graph.add(self.step('conf', inputs = ['bin']))
+        graph.run()
+        self.assertEqual(self.ran[0], 'compile')
+        self.assertEqual(self.ran[-1], 'conf')
+        self.assertEqual(len(self.ran), 10)
+
+    def test_exception_raised_once_running_steps_completed(self):
+        graph = StepGraph(jobs = 2)
+        def fail():
+            raise RuntimeError('boom')
+        graph.add(Step('fail', fail))
+        graph.add(self.step('other'))
+        with self.assertRaises(RuntimeError):
+            graph.run()
+        self.assertEqual(graph.get('fail').rc, 1)
+
+    def test_cycle(self):
+        graph = StepGraph()
+        graph.add(self.step('a', inputs = ['y'], outputs = ['x']))
+        graph.add(self.step('b', inputs = ['x'], outputs = ['y']))
+        with self.assertRaises(Exception):
+            graph.run()
+        self.assertEqual(self.ran, [])
+
+    def test_duplicate_step(self):
+        graph = StepGraph()
+        graph.add(self.step('a'))
+        with self.assertRaises(Exception):
+            graph.add(self.step('a'))
+
+class CommandTest(unittest.TestCase):
+    def test_argv(self):
+        cmd = ['p4c-barefoot', '--target tofino', ['-I', 'dir with spaces'], 't.p4']
+        self.assertEqual(command_argv(cmd), ['p4c-barefoot', '--target', 'tofino',
+                                             '-I', 'dir with spaces', 't.p4'])
+        self.assertEqual(command_line(cmd),
+                         "p4c-barefoot --target tofino -I 'dir with spaces' t.p4")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+# Copyright 2013-2021 Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials,
+# and your use of them is governed by the express license under which they
+# were provided to you ("License"). Unless the License provides otherwise,
+# you may not use, modify, copy, publish, distribute, disclose or transmit this
+# software or the related documents without Intel's prior written permission.
+#
+# This software and the related documents are provided as is, with no
+# express or implied warranties, other than those that are expressly stated
+# in the License.
+
+import types
+import unittest
+
+from p4c_src.fanout import _shared_outputs
+
+def _opts(**options):
+    opts = dict(bf_rt_schema = None, p4runtime_file = None, p4runtime_files = None,
+                depfile = None, archive = None)
+    opts.update(options)
+    return types.SimpleNamespace(**opts)
+
+class SharedOutputsTest(unittest.TestCase):
+    def test_defaults(self):
+        self.assertEqual(_shared_outputs(_opts()), [])
+        self.assertEqual(_shared_outputs(_opts(archive = '__default__')), [])
+
+    def test_per_target(self):
+        self.assertEqual(_shared_outputs(_opts(bf_rt_schema = 'out/{target}/bfrt.json',
+                                               p4runtime_files = 'a.{target}.pb,b.{target}.pb',
+                                               archive = 'prog-{target}')), [])
+
+    def test_shared(self):
+        self.assertEqual(_shared_outputs(_opts(bf_rt_schema = 'bfrt.json',
+                                               p4runtime_files = 'a.{target}.pb,b.pb',
+                                               depfile = 'prog.d', archive = 'prog')),
+                         ['--bf-rt-schema', '--p4runtime-files', '--depfile', '--archive'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+# Copyright 2013-2021 Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials,
+# and your use of them is governed by the express license under which they
+# were provided to you ("License"). Unless the License provides otherwise,
+# you may not use, modify, copy, publish, distribute, disclose or transmit this
+# software or the related documents without Intel's prior written permission.
+#
+# This software and the related documents are provided as is, with no
+# express or implied warranties, other than those that are expressly stated
+# in the License.
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from p4c_src import incremental
+
+CMD = ['bfas', '-vvvv', '-o', 'pipe']
+
+class StampTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.pipe_dir = os.path.join(self.tmp, 'pipe')
+        os.makedirs(os.path.join(self.pipe_dir, 'logs'))
+        self.bfa = os.path.join(self.pipe_dir, 't.bfa')
+        self._write(self.bfa, 'version: 1.0.0\n')
+        self.assembler = os.path.join(self.tmp, 'bfas')
+        self._write(self.assembler, '#!/bin/sh\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _write(self, path, text):
+        with open(path, 'w') as f:
+            f.write(text)
+
+    def _key(self, cmd = CMD):
+        return incremental.assembly_key(self.bfa, cmd, self.assembler)
+
+    def _assemble(self, verified = True):
+        """
+        Write the outputs of the assembler and its stamp
+        """
+        # file times are taken from a coarse clock, that lags behind time_ns
+        since = time.time_ns() - 1000000000
+        self._write(os.path.join(self.pipe_dir, 'context.json'), '{}')
+        self._write(os.path.join(self.pipe_dir, 'tofino.bin'), 'bin')
+        self._write(os.path.join(self.tmp, 'pipe', incremental.DEPARSER_RESOURCES),
+                    '{"deparser": 1}')
+        incremental.write_stamp(self.pipe_dir, self._key(), since, verified)
+
+    def test_same_key_and_outputs(self):
+        self._assemble()
+        stamp = incremental.load_stamp(self.pipe_dir, self._key())
+        self.assertIsNotNone(stamp)
+        self.assertEqual(sorted(stamp['outputs']), ['context.json', 'tofino.bin'])
+        self.assertTrue(stamp['verified'])
+
+    def test_changed_assembly(self):
+        self._assemble()
+        with open(self.bfa, 'a') as f:
+            f.write('# edited\n')
+        self.assertIsNone(incremental.load_stamp(self.pipe_dir, self._key()))
+
+    def test_changed_command(self):
+        self._assemble()
+        self.assertIsNone(incremental.load_stamp(self.pipe_dir, self._key(CMD + ['-g'])))
+
+    def test_changed_assembler(self):
+        key = self._key()
+        self._assemble()
+        st = os.stat(self.assembler)
+        os.utime(self.assembler, ns = (st.st_atime_ns, st.st_mtime_ns + 1000000000))
+        self.assertNotEqual(self._key(), key)
+        self.assertIsNone(incremental.load_stamp(self.pipe_dir, self._key()))
+
+    def test_touched_output(self):
+        self._assemble()
+        binary = os.path.join(self.pipe_dir, 'tofino.bin')
+        st = os.stat(binary)
+        os.utime(binary, ns = (st.st_atime_ns, st.st_mtime_ns + 1000000000))
+        self.assertIsNone(incremental.load_stamp(self.pipe_dir, self._key()))
+
+    def test_removed_output(self):
+        self._assemble()
+        os.unlink(os.path.join(self.pipe_dir, 'context.json'))
+        self.assertIsNone(incremental.load_stamp(self.pipe_dir, self._key()))
+
+    def test_removed_stamp(self):
+        self._assemble()
+        incremental.remove_stamp(self.pipe_dir)
+        self.assertIsNone(incremental.load_stamp(self.pipe_dir, self._key()))
+
+    def test_corrupt_stamp(self):
+        self._write(incremental.stamp_file(self.pipe_dir), '{"key": ')
+        self.assertIsNone(incremental.load_stamp(self.pipe_dir, self._key()))
+
+    def test_deparser_resources_restored(self):
+        self._assemble()
+        stamp = incremental.load_stamp(self.pipe_dir, self._key())
+        # the cleaner removes the logs of the pipe
+        shutil.rmtree(os.path.join(self.pipe_dir, 'logs'))
+        incremental.restore_deparser_resources(self.pipe_dir, stamp)
+        with open(os.path.join(self.pipe_dir, incremental.DEPARSER_RESOURCES)) as f:
+            self.assertEqual(json.load(f), { 'deparser': 1 })
+
+if __name__ == '__main__':
+    unittest.main()
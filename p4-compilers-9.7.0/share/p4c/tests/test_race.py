@@ -0,0 +1,99 @@
+# Copyright 2013-2021 Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials,
+# and your use of them is governed by the express license under which they
+# were provided to you ("License"). Unless the License provides otherwise,
+# you may not use, modify, copy, publish, distribute, disclose or transmit this
+# software or the related documents without Intel's prior written permission.
+#
+# This software and the related documents are provided as is, with no
+# express or implied warranties, other than those that are expressly stated
+# in the License.
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from p4c_src.race import Contender, DurationHistory, Race, race_command, race_dir
+
+def _compiler(output_dir, strategy, seconds):
+    """
+    A contender that compiles successfully in about seconds
+    """
+    manifest = os.path.join(race_dir(output_dir, strategy), 'manifest.json')
+    code = "import time\ntime.sleep({})\nopen({!r}, 'w').write('{{}}')".format(seconds, manifest)
+    log = os.path.join(output_dir, strategy + '.log')
+    return Contender(strategy, [[sys.executable, '-c', code]], {}, log)
+
+class DurationHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.history = DurationHistory(os.path.join(self.tmp, 'cache', 'race-history.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_record(self):
+        key = self.history.key('t.p4', 'tofino', 'tna')
+        self.assertIsNone(self.history.elapsed(key))
+        self.history.record(key, 12.5)
+        self.history.record(self.history.key('t.p4', 'tofino2', 't2na'), 30.0)
+        self.assertEqual(self.history.elapsed(key), 12.5)
+        self.assertEqual(self.history.key('t.p4', 'tofino', 'tna'),
+                         self.history.key(os.path.abspath('t.p4'), 'tofino', 'tna'))
+
+class TimeSavedTest(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def _race(self, contenders, default_elapsed = None):
+        race = Race(contenders, self.output_dir, default_elapsed = default_elapsed)
+        self.assertEqual(race.run(), 0)
+        return race
+
+    def test_unknown_without_history(self):
+        race = self._race([_compiler(self.output_dir, 'quick-phv-alloc', 0),
+                           _compiler(self.output_dir, 'default', 30)])
+        self.assertEqual(race.winner.strategy, 'quick-phv-alloc')
+        self.assertIsNone(race.completed_default())
+        self.assertIsNone(race.time_saved())
+        summary = race.summary()
+        self.assertNotIn('time_saved', summary)
+        self.assertEqual([s['status'] for s in summary['strategies']], ['done', 'killed'])
+
+    def test_against_the_recorded_default(self):
+        # compile with the default strategy alone first, as the history does
+        alone = self._race([_compiler(self.output_dir, 'default', 1)])
+        default_elapsed = alone.completed_default().elapsed
+        self.assertGreaterEqual(default_elapsed, 1)
+        race = self._race([_compiler(self.output_dir, 'quick-phv-alloc', 0),
+                           _compiler(self.output_dir, 'default', 30)], default_elapsed)
+        self.assertIsNone(race.completed_default())
+        summary = race.summary()
+        self.assertEqual(summary['default_elapsed'], default_elapsed)
+        self.assertEqual(summary['time_saved'], default_elapsed - race.winner.elapsed)
+        self.assertGreater(summary['time_saved'], 0.5)
+
+    def test_default_won(self):
+        race = self._race([_compiler(self.output_dir, 'quick-phv-alloc', 30),
+                           _compiler(self.output_dir, 'default', 0)], 100.0)
+        self.assertIs(race.completed_default(), race.winner)
+        self.assertEqual(race.default_elapsed(), race.winner.elapsed)
+        self.assertEqual(race.time_saved(), 0.0)
+
+class RaceCommandTest(unittest.TestCase):
+    def test_outputs_in_scratch(self):
+        cmd, files = race_command(['p4c-barefoot', '-o', 'out', '--bf-rt-schema out/bfrt.json',
+                                   'out/t.p4pp'], 'out', 'quick-phv-alloc')
+        self.assertEqual(cmd, ['p4c-barefoot', '-o', 'out/.race/quick-phv-alloc',
+                               '--bf-rt-schema out/.race/quick-phv-alloc/race-0-bfrt.json',
+                               'out/t.p4pp', '--quick-phv-alloc'])
+        self.assertEqual(files, { 'out/.race/quick-phv-alloc/race-0-bfrt.json': 'out/bfrt.json' })
+
+if __name__ == '__main__':
+    unittest.main()
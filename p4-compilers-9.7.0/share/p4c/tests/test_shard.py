@@ -0,0 +1,121 @@
+# Copyright 2013-2021 Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials,
+# and your use of them is governed by the express license under which they
+# were provided to you ("License"). Unless the License provides otherwise,
+# you may not use, modify, copy, publish, distribute, disclose or transmit this
+# software or the related documents without Intel's prior written permission.
+#
+# This software and the related documents are provided as is, with no
+# express or implied warranties, other than those that are expressly stated
+# in the License.
+
+import json
+import os
+import tempfile
+import types
+import unittest
+
+from p4c_src.barefoot import BarefootBackend
+from p4c_src.shard import merge_shards, overlapping_pipes, shard_command, shard_dir
+
+def _manifest(pipes, compiled):
+    return { 'programs': [ { 'pipes': [
+        { 'pipe_name': p, 'pipe_id': i,
+          'files': { 'context': { 'path': p + '/context.json' } } if p in compiled else {} }
+        for i, p in enumerate(pipes) ] } ] }
+
+class ShardCommandTest(unittest.TestCase):
+    cmd = ['p4c-barefoot', '--target tofino', '-o', 'out', '--bf-rt-schema out/bfrt.json',
+           '--skip-compilation=x', 'out/t.p4pp']
+
+    def test_first_shard(self):
+        self.assertEqual(shard_command(self.cmd, 'out', 'a', ['a', 'b'], ['x'], True),
+                         ['p4c-barefoot', '--target tofino', '-o', 'out/.shards/a',
+                          '--bf-rt-schema out/bfrt.json', 'out/t.p4pp',
+                          '--skip-compilation=b,x'])
+
+    def test_other_shards_skip_the_schemas(self):
+        self.assertEqual(shard_command(self.cmd, 'out', 'b', ['a', 'b'], [], False),
+                         ['p4c-barefoot', '--target tofino', '-o', 'out/.shards/b',
+                          'out/t.p4pp', '--skip-compilation=a'])
+
+class OverlappingPipesTest(unittest.TestCase):
+    def test_prefix(self):
+        self.assertEqual(overlapping_pipes(['pipe1', 'pipe10'], []), ['pipe10'])
+
+    def test_skipped_name(self):
+        self.assertEqual(overlapping_pipes(['ingress_a', 'b'], ['a']), ['ingress_a'])
+
+    def test_distinct(self):
+        self.assertEqual(overlapping_pipes(['pipe0', 'pipe1'], ['other']), [])
+
+    def _shard_pipes(self, pipes, skipped = ()):
+        backend = types.SimpleNamespace(_shard_pipes = pipes, skip_compilation = list(skipped),
+                                        _publish_dir = None)
+        return BarefootBackend.shardPipes(backend)
+
+    def test_overlapping_pipes_are_not_sharded(self):
+        self.assertEqual(self._shard_pipes(['pipe1', 'pipe10']), [])
+
+    def test_skipped_pipes_are_not_sharded(self):
+        self.assertEqual(self._shard_pipes(['pipe0', 'pipe1', 'pipe2'], ['pipe2']),
+                         ['pipe0', 'pipe1'])
+
+class MergeShardsTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.out = self._tmp.name
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with open(path, 'w') as f:
+            f.write(data if isinstance(data, str) else json.dumps(data))
+
+    def _shard(self, pipe, pipes, program_files = ()):
+        d = shard_dir(self.out, pipe)
+        self._write(os.path.join(d, 'manifest.json'), _manifest(pipes, [pipe]))
+        self._write(os.path.join(d, pipe, 'context.json'), pipe)
+        for f in program_files:
+            self._write(os.path.join(d, f), f)
+
+    def test_merge(self):
+        pipes = ['a', 'b']
+        self._shard('a', pipes, ['bfrt.json'])
+        self._shard('b', pipes)
+        self._write(os.path.join(self.out, 'b', 'stale.json'), 'stale')
+        self.assertTrue(merge_shards(self.out, pipes))
+        with open(os.path.join(self.out, 'manifest.json')) as f:
+            manifest = json.load(f)
+        entries = manifest['programs'][0]['pipes']
+        self.assertEqual([e['files'] for e in entries],
+                         [{ 'context': { 'path': p + '/context.json' } } for p in pipes])
+        for p in pipes:
+            with open(os.path.join(self.out, p, 'context.json')) as f:
+                self.assertEqual(f.read(), p)
+        self.assertTrue(os.path.exists(os.path.join(self.out, 'bfrt.json')))
+        self.assertFalse(os.path.exists(os.path.join(self.out, 'b', 'stale.json')))
+
+    def test_failed_shard_stays_skipped(self):
+        pipes = ['a', 'b']
+        self._shard('a', pipes)
+        self.assertTrue(merge_shards(self.out, pipes))
+        with open(os.path.join(self.out, 'manifest.json')) as f:
+            entries = json.load(f)['programs'][0]['pipes']
+        self.assertEqual(entries[1]['files'], {})
+
+    def test_nothing_to_merge(self):
+        self.assertFalse(merge_shards(self.out, ['a', 'b']))
+        self.assertEqual(os.listdir(self.out), [])
+
+    def test_compact(self):
+        self._shard('a', ['a'])
+        self.assertTrue(merge_shards(self.out, ['a'], compact = True))
+        with open(os.path.join(self.out, 'manifest.json')) as f:
+            self.assertNotIn('\n', f.read())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+# Copyright 2013-2021 Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials,
+# and your use of them is governed by the express license under which they
+# were provided to you ("License"). Unless the License provides otherwise,
+# you may not use, modify, copy, publish, distribute, disclose or transmit this
+# software or the related documents without Intel's prior written permission.
+#
+# This software and the related documents are provided as is, with no
+# express or implied warranties, other than those that are expressly stated
+# in the License.
+
+import os
+import shutil
+import tempfile
+import types
+import unittest
+
+from p4c_src import staging
+from p4c_src.barefoot import BarefootBackend
+
+def _write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    with open(path, 'w') as f:
+        f.write(text)
+
+def _read(path):
+    with open(path) as f:
+        return f.read()
+
+class StagingTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.output_dir = os.path.join(self.tmp, 'out')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_publish_replaces_the_outputs(self):
+        _write(os.path.join(self.output_dir, 'pipe', 'old.bfa'), 'old')
+        _write(os.path.join(self.output_dir, 'manifest.json'), 'old')
+        _write(os.path.join(self.output_dir, 'unrelated'), 'kept')
+        staging_dir = staging.create(self.tmp, self.output_dir)
+        _write(os.path.join(staging_dir, 'pipe', 'new.bfa'), 'new')
+        _write(os.path.join(staging_dir, 'manifest.json'), 'new')
+        staging.publish(staging_dir, self.output_dir)
+        self.assertFalse(os.path.exists(staging_dir))
+        self.assertEqual(os.listdir(os.path.join(self.output_dir, 'pipe')), ['new.bfa'])
+        self.assertEqual(_read(os.path.join(self.output_dir, 'manifest.json')), 'new')
+        self.assertEqual(_read(os.path.join(self.output_dir, 'unrelated')), 'kept')
+        self.assertEqual(sorted(os.listdir(self.output_dir)),
+                         ['manifest.json', 'pipe', 'unrelated'])
+
+    def test_published_path(self):
+        self.assertEqual(staging.published_path('/s/pipe/x.bfa', '/s', '/o'), '/o/pipe/x.bfa')
+        self.assertEqual(staging.published_path('/s', '/s', '/o'), '/o')
+        self.assertEqual(staging.published_path('/elsewhere/x', '/s', '/o'), '/elsewhere/x')
+        self.assertIsNone(staging.published_path(None, '/s', '/o'))
+
+    def test_cleanup_removes_the_staging_dir(self):
+        staging_dir = staging.create(self.tmp, self.output_dir)
+        _write(os.path.join(staging_dir, 'pipe', 'x.bfa'), 'x')
+        no_logs = lambda: None
+        BarefootBackend.cleanup(types.SimpleNamespace(_staging_dir = staging_dir,
+                                                      closeStepLogs = no_logs))
+        self.assertFalse(os.path.exists(staging_dir))
+        BarefootBackend.cleanup(types.SimpleNamespace(_staging_dir = None,
+                                                      closeStepLogs = no_logs))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+# Copyright 2013-2021 Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials,
+# and your use of them is governed by the express license under which they
+# were provided to you ("License"). Unless the License provides otherwise,
+# you may not use, modify, copy, publish, distribute, disclose or transmit this
+# software or the related documents without Intel's prior written permission.
+#
+# This software and the related documents are provided as is, with no
+# express or implied warranties, other than those that are expressly stated
+# in the License.
+
+"""
+The driver runs hundreds of times per SDE build: nothing that only a
+compilation needs may be loaded or looked up before a backend is selected.
+"""
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import p4c_src.barefoot as bfn
+from p4c_src import config
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'p4c_src')
+BF_P4C = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(SRC_DIR))),
+                      'bin', 'bf-p4c')
+
+# what --version must not load
+_HEAVY_MODULES = ('p4c_src.barefoot', 'p4c_src.driver', 'p4c_src.cache', 'subprocess',
+                  'packaging', 'concurrent.futures')
+
+# the time each command may take on top of starting the interpreter, in ms
+BUDGET_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'startup_budget.json')
+_RUNS = 10
+
+_PROBE = """
+import runpy, sys
+sys.argv = [{bf_p4c!r}] + {args!r}
+try:
+    runpy.run_path({bf_p4c!r}, run_name = '__main__')
+except SystemExit:
+    pass
+print(' '.join(m for m in {heavy!r} if m in sys.modules))
+"""
+
+def _best(args, cwd = None, check = True):
+    """
+    Return the shortest time args took over _RUNS runs, in ms
+    """
+    best = None
+    for _ in range(_RUNS):
+        start = time.perf_counter()
+        subprocess.run(args, cwd = cwd, check = check,
+                       stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+class LazyBackendTest(unittest.TestCase):
+    def test_configuration_constructs_no_backend(self):
+        parser = argparse.ArgumentParser(conflict_handler='resolve')
+        cfg = config.Config(config_prefix = 'p4c')
+        with mock.patch.object(bfn, '_tools', None), \
+             mock.patch.object(bfn, 'find_file', side_effect = AssertionError('tool lookup')), \
+             mock.patch.object(bfn.BarefootBackend, '__init__',
+                               side_effect = AssertionError('backend constructed')):
+            for cf in sorted(glob.glob(os.path.join(SRC_DIR, '*.cfg'))):
+                cfg.load_from_config(cf, parser)
+            self.assertIsNone(bfn._tools)
+        self.assertTrue(cfg.target)
+        self.assertTrue(all(isinstance(t, config.TargetDescriptor) for t in cfg.target))
+        self.assertIn('tofino-tna', [str(t) for t in cfg.target])
+
+    def test_version_loads_no_backend(self):
+        probe = _PROBE.format(bf_p4c = BF_P4C, args = ['--version'], heavy = _HEAVY_MODULES)
+        out = subprocess.run([sys.executable, '-c', probe], check = True,
+                             stdout = subprocess.PIPE, universal_newlines = True).stdout
+        lines = out.splitlines()
+        self.assertTrue(lines[0].startswith('p4c '), out)
+        self.assertEqual(lines[-1], '', "loaded by --version: " + lines[-1])
+
+class StartupTimeTest(unittest.TestCase):
+    """
+    Time the commands that do not compile against the budget checked in
+    next to this file. The best of several runs is kept, and the start-up of
+    the bare interpreter is subtracted, so that the budget holds on slower
+    machines too.
+    """
+    @classmethod
+    def setUpClass(cls):
+        with open(BUDGET_FILE) as f:
+            cls.budget = json.load(f)
+        cls.interpreter = _best([sys.executable, '-c', 'pass'])
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        with open(os.path.join(self.tmp, 't.p4'), 'w') as f:
+            f.write('#include <core.p4>\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _check(self, option, args, check = True):
+        elapsed = _best([sys.executable, BF_P4C] + args, self.tmp, check) - self.interpreter
+        self.assertLessEqual(elapsed, self.budget[option],
+                             "{} over its budget in {}".format(option, BUDGET_FILE))
+
+    def _needs_backend(self):
+        if not os.path.isfile(os.path.join(os.path.dirname(BF_P4C), 'bfas')):
+            self.skipTest('the backend is not installed')
+
+    def test_version(self):
+        self._check('--version', ['--version'])
+
+    def test_help_targets(self):
+        self._needs_backend()
+        self._check('--help-targets', ['--help-targets'])
+
+    def test_dry_run(self):
+        self._needs_backend()
+        # without the compiler outputs, the dry run ends with an error
+        self._check('-###', ['-###', 't.p4'], check = False)
+
+if __name__ == '__main__':
+    unittest.main()